@@ -0,0 +1,99 @@
+"""
+Compares the fast bond length reasonableness score (`bond_length_reasonableness_score(..., fast=True)`)
+with the CrystalNN-based score on a reference set of CIFs, and reports how often the two agree, and
+how long each takes.
+
+The reference set can be a .tar.gz of CIF files, such as the output of `bin/generate_cifs.py`, or a
+.csv file with a "cif" column, such as the benchmark files in `resources/benchmarks`, e.g.:
+python bin/bond_length_parity.py resources/benchmarks/perov_5/test.csv --limit 500
+"""
+import sys
+sys.path.append(".")
+import argparse
+import tarfile
+import time
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from crystallm import (
+    CIFAnalysis,
+    bond_length_reasonableness_score,
+)
+
+import warnings
+warnings.filterwarnings("ignore")
+
+
+def read_cifs(input_path):
+    if input_path.endswith(".csv"):
+        return pd.read_csv(input_path)["cif"].tolist()
+    cifs = []
+    with tarfile.open(input_path, "r:gz") as tar:
+        for member in tar.getmembers():
+            f = tar.extractfile(member)
+            if f is not None:
+                cifs.append(f.read().decode("utf-8"))
+    return cifs
+
+
+def timed_score(analysis, fast):
+    start = time.perf_counter()
+    try:
+        score = bond_length_reasonableness_score(analysis, fast=fast)
+    except Exception:
+        score = np.nan
+    return score, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the fast and the CrystalNN bond length "
+                                                 "reasonableness scores.")
+    parser.add_argument("cifs",
+                        help="Path to a .tar.gz file of CIF files, or to a .csv file with a 'cif' column.")
+    parser.add_argument("--limit", type=int, default=0,
+                        help="If > 0, only the first this many CIFs are compared.")
+    parser.add_argument("--cutoff", type=float, default=1.0,
+                        help="The bond length acceptability cutoff used to compare validity decisions.")
+    parser.add_argument("--out", "-o", action="store", required=False,
+                        help="Optional: path to a .csv file where the score of each CIF will be stored.")
+    args = parser.parse_args()
+
+    cifs = read_cifs(args.cifs)
+    if args.limit > 0:
+        cifs = cifs[:args.limit]
+
+    results = {"crystal_nn_score": [], "fast_score": [], "crystal_nn_time": [], "fast_time": []}
+    for cif in tqdm(cifs, desc="scoring CIFs..."):
+        analysis = CIFAnalysis(cif)
+        try:
+            # parse the CIF before timing, so that both scores are timed without parsing
+            analysis.structure
+        except Exception:
+            continue
+        crystal_nn_score, crystal_nn_time = timed_score(analysis, fast=False)
+        fast_score, fast_time = timed_score(analysis, fast=True)
+        results["crystal_nn_score"].append(crystal_nn_score)
+        results["fast_score"].append(fast_score)
+        results["crystal_nn_time"].append(crystal_nn_time)
+        results["fast_time"].append(fast_time)
+
+    df = pd.DataFrame(results)
+    both = df.dropna(subset=["crystal_nn_score", "fast_score"])
+    diff = (both["fast_score"] - both["crystal_nn_score"]).abs()
+    agree = (both["fast_score"] >= args.cutoff) == (both["crystal_nn_score"] >= args.cutoff)
+
+    print(f"CIFs compared: {len(both)}/{len(cifs)} "
+          f"(CrystalNN failed: {df['crystal_nn_score'].isna().sum()}, fast failed: {df['fast_score'].isna().sum()})")
+    print(f"identical scores: {(diff < 1e-9).sum()}/{len(both)} ({(diff < 1e-9).mean():.3f})")
+    print(f"mean absolute difference: {diff.mean():.4f}, max: {diff.max():.4f}")
+    print(f"same decision at cutoff {args.cutoff}: {agree.sum()}/{len(both)} ({agree.mean():.3f})")
+    print(f"reasonable (CrystalNN): {(both['crystal_nn_score'] >= args.cutoff).sum()}, "
+          f"reasonable (fast): {(both['fast_score'] >= args.cutoff).sum()}")
+    print(f"mean time per CIF: CrystalNN {df['crystal_nn_time'].mean() * 1000:.2f} ms, "
+          f"fast {df['fast_time'].mean() * 1000:.2f} ms "
+          f"({df['crystal_nn_time'].sum() / df['fast_time'].sum():.1f}x)")
+
+    if args.out:
+        df.to_csv(args.out)
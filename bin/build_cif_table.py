@@ -0,0 +1,66 @@
+"""
+Builds the table of the properties of each CIF of a corpus (its ID, formula, reduced formula, Z, space group,
+cell parameters, volume and number of tokens), stored as a .npz file alongside the corpus, so that scripts such
+as `bin/deduplicate.py` and `bin/merge_datasets.py` can read the properties instead of extracting them from
+the CIFs on every run, e.g.:
+python bin/build_cif_table.py cifs_v1_orig.pkl.gz --workers 8
+"""
+import sys
+sys.path.append(".")
+import argparse
+import gzip
+from tqdm import tqdm
+
+from crystallm import (
+    build_cif_table,
+    get_cif_table_geometry,
+    get_cif_table_path,
+    save_cif_table,
+)
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import warnings
+warnings.filterwarnings("ignore")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the table of the properties of CIF files.")
+    parser.add_argument("name", type=str,
+                        help="Path to the file with the CIFs. It is expected that the file contains the gzipped "
+                             "contents of a pickled Python list of tuples, of (id, cif) pairs.")
+    parser.add_argument("--out", "-o", action="store", default="",
+                        help="Optional: path to the .npz file where the table will be stored. By default, the "
+                             "table is stored alongside the CIFs, e.g. `cifs.table.npz` for `cifs.pkl.gz`.")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="The number of workers to use for processing. Default is 4.")
+    parser.add_argument("--no_tokens", action="store_true",
+                        help="Include this flag to skip counting the tokens of each CIF, which is the slowest "
+                             "part; the `n_tokens` column will then be -1.")
+    args = parser.parse_args()
+
+    cifs_fname = args.name
+    out_fname = args.out if args.out else get_cif_table_path(cifs_fname)
+
+    print(f"loading data from {cifs_fname}...")
+    with gzip.open(cifs_fname, "rb") as f:
+        cifs = pickle.load(f)
+
+    with tqdm(total=len(cifs), desc="extracting properties...") as pbar:
+        table = build_cif_table(cifs, workers=args.workers, count_tokens=not args.no_tokens, progress=pbar.update)
+
+    n_incomplete = sum(
+        (table[column] == "").sum() if table[column].dtype.kind == "U" else
+        (table[column] < 0).sum() if table[column].dtype.kind == "i" else 0
+        for column in ("formula", "reduced_formula", "space_group", "formula_units")
+    )
+    print(f"number of CIFs: {len(table['id']):,} (missing values: {n_incomplete:,})")
+    geometry = get_cif_table_geometry(table)
+    print(f"CIFs with cells that are not sensible: {(~geometry['sensible']).sum():,}, "
+          f"degenerate or incomplete: {geometry['degenerate'].sum():,}")
+
+    print(f"saving table to {out_fname}...")
+    save_cif_table(table, out_fname)
@@ -3,12 +3,15 @@ sys.path.append(".")
 import argparse
 from tqdm import tqdm
 import gzip
+import numpy as np
 
 from crystallm import (
     extract_formula_nonreduced,
     extract_space_group_symbol,
     extract_volume,
     extract_formula_units,
+    get_volumes_per_formula_unit,
+    load_cif_table,
 )
 
 try:
@@ -20,6 +23,28 @@ import warnings
 warnings.filterwarnings("ignore")
 
 
+def keys_and_vpfus_from_cifs(cifs):
+    for id, cif in tqdm(cifs):
+        formula = extract_formula_nonreduced(cif)
+        space_group = extract_space_group_symbol(cif)
+        formula_units = extract_formula_units(cif)
+        if formula_units == 0:
+            formula_units = 1
+        vpfu = extract_volume(cif) / formula_units
+        yield (formula, space_group), vpfu
+
+
+def keys_and_vpfus_from_table(table):
+    formula_units = table["formula_units"]
+    missing = (table["formula"] == "") | (table["space_group"] == "") | (formula_units < 0) | \
+        np.isnan(table["volume"])
+    if missing.any():
+        raise Exception(f"the properties of {missing.sum():,} CIFs could not be extracted, "
+                        f"e.g. the CIF with ID '{table['id'][missing.argmax()]}'")
+    vpfus = get_volumes_per_formula_unit(table["volume"], formula_units)
+    return zip(zip(table["formula"].tolist(), table["space_group"].tolist()), vpfus.tolist())
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Deduplicate CIF files.")
     parser.add_argument("name", type=str,
@@ -30,6 +55,10 @@ if __name__ == "__main__":
                         help="Path to the file where the deduplicated CIFs will be stored. "
                              "The file will contain the gzipped contents of a pickle dump. It is "
                              "recommended that the filename end in `.pkl.gz`.")
+    parser.add_argument("--table", type=str, default="",
+                        help="Optional: path to the table of the CIFs made with `bin/build_cif_table.py`. "
+                             "If given, the formulas, space groups, volumes and formula units are read from it, "
+                             "instead of being extracted from the CIFs.")
     args = parser.parse_args()
 
     cifs_fname = args.name
@@ -43,15 +72,13 @@ if __name__ == "__main__":
 
     lowest_vpfu = {}
 
-    for id, cif in tqdm(cifs):
-        formula = extract_formula_nonreduced(cif)
-        space_group = extract_space_group_symbol(cif)
-        formula_units = extract_formula_units(cif)
-        if formula_units == 0:
-            formula_units = 1
-        vpfu = extract_volume(cif) / formula_units
+    if args.table:
+        print(f"loading the table of the CIFs from {args.table}...")
+        keys_and_vpfus = keys_and_vpfus_from_table(load_cif_table(args.table, cifs))
+    else:
+        keys_and_vpfus = keys_and_vpfus_from_cifs(cifs)
 
-        key = (formula, space_group)
+    for (id, cif), (key, vpfu) in zip(cifs, keys_and_vpfus):
         if key not in lowest_vpfu:
             lowest_vpfu[key] = (id, cif, vpfu)
         else:
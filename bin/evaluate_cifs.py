@@ -10,18 +10,18 @@ import numpy as np
 import pandas as pd
 
 from crystallm import (
+    CIFAnalysis,
     CIFTokenizer,
+    SpaceGroupDetector,
     bond_length_reasonableness_score,
-    extract_data_formula,
-    extract_numeric_property,
     extract_space_group_symbol,
-    extract_volume,
-    get_unit_cell_volume,
+    get_unit_cell_volumes,
     is_atom_site_multiplicity_consistent,
+    is_formula_consistent,
     is_space_group_consistent,
     is_sensible,
-    is_valid,
     replace_symmetry_operators,
+    scan_cif_header,
 )
 
 import warnings
@@ -50,8 +50,10 @@ def progress_listener(queue, n):
             break
 
 
-def eval_cif(progress_queue, task_queue, result_queue, length_lo, length_hi, angle_lo, angle_hi, debug):
+def eval_cif(progress_queue, task_queue, result_queue, length_lo, length_hi, angle_lo, angle_hi, debug,
+             fast_bond_length_score, space_group_cache_path):
     tokenizer = CIFTokenizer()
+    space_group_detector = SpaceGroupDetector(db_path=space_group_cache_path)
     n_atom_site_multiplicity_consistent = 0
     n_space_group_consistent = 0
     bond_length_reasonableness_scores = []
@@ -69,33 +71,39 @@ def eval_cif(progress_queue, task_queue, result_queue, length_lo, length_hi, ang
 
             gen_len = len(tokenizer.tokenize_cif(cif))
 
+            # the scalar fields are found in one pass over the CIF; replacing
+            #  the symmetry operators below leaves them unchanged
+            header = scan_cif_header(cif)
+
             space_group_symbol = extract_space_group_symbol(cif)
             if space_group_symbol is not None and space_group_symbol != "P 1":
                 cif = replace_symmetry_operators(cif, space_group_symbol)
 
-            if is_atom_site_multiplicity_consistent(cif):
+            # the CIF is parsed once, and shared by all the checks
+            analysis = CIFAnalysis(cif)
+
+            atom_site_multiplicity_consistent = is_atom_site_multiplicity_consistent(analysis)
+            if atom_site_multiplicity_consistent:
                 n_atom_site_multiplicity_consistent += 1
 
-            if is_space_group_consistent(cif):
+            space_group_consistent = is_space_group_consistent(analysis, space_group_detector)
+            if space_group_consistent:
                 n_space_group_consistent += 1
 
-            score = bond_length_reasonableness_score(cif)
+            score = bond_length_reasonableness_score(analysis, fast=fast_bond_length_score)
             bond_length_reasonableness_scores.append(score)
 
-            a = extract_numeric_property(cif, "_cell_length_a")
-            b = extract_numeric_property(cif, "_cell_length_b")
-            c = extract_numeric_property(cif, "_cell_length_c")
-            alpha = extract_numeric_property(cif, "_cell_angle_alpha")
-            beta = extract_numeric_property(cif, "_cell_angle_beta")
-            gamma = extract_numeric_property(cif, "_cell_angle_gamma")
-            implied_vol = get_unit_cell_volume(a, b, c, alpha, beta, gamma)
+            # the implied volumes of all the CIFs are computed at once, once they are collected
+            cell_parameters = header.cell_parameters()
 
-            gen_vol = extract_volume(cif)
-            data_formula = extract_data_formula(cif)
+            gen_vol = header.require("_cell_volume", float)
+            data_formula = header.require("data_")
 
-            valid = is_valid(cif, bond_length_acceptability_cutoff=1.0)
+            # the same checks as `is_valid(cif, bond_length_acceptability_cutoff=1.0)`, reusing the results above
+            valid = is_formula_consistent(analysis) and atom_site_multiplicity_consistent and \
+                score >= 1.0 and space_group_consistent
 
-            is_valid_and_len.append((data_formula, space_group_symbol, valid, gen_len, implied_vol, gen_vol))
+            is_valid_and_len.append((data_formula, space_group_symbol, valid, gen_len, cell_parameters, gen_vol))
 
         except Exception as e:
             if debug:
@@ -103,6 +111,8 @@ def eval_cif(progress_queue, task_queue, result_queue, length_lo, length_hi, ang
 
         progress_queue.put(1)
 
+    space_group_detector.close()
+
     result = (
         n_atom_site_multiplicity_consistent,
         n_space_group_consistent,
@@ -129,6 +139,12 @@ if __name__ == "__main__":
                         help="The largest cell angle allowable for the sensibility check")
     parser.add_argument("--workers", type=int, default=2,
                         help="Number of workers to use for processing.")
+    parser.add_argument("--fast_bond_length_score", required=False, action="store_true",
+                        help="Include this flag to use the fast approximation of the bond length reasonableness score, "
+                             "instead of the CrystalNN-based score")
+    parser.add_argument("--space_group_cache_path", required=False, default=None,
+                        help="Optional: path to an SQLite database in which detected space groups are remembered, "
+                             "across workers and runs")
     parser.add_argument("--debug", required=False, action="store_true",
                         help="Include this flag to print exception messages if they occur during evaluation")
     args = parser.parse_args()
@@ -141,6 +157,8 @@ if __name__ == "__main__":
     angle_hi = args.angle_hi
     workers = args.workers
     debug = args.debug
+    fast_bond_length_score = args.fast_bond_length_score
+    space_group_cache_path = args.space_group_cache_path
 
     cifs = read_generated_cifs(gen_cifs_path)
 
@@ -158,7 +176,8 @@ if __name__ == "__main__":
     processes = [
         mp.Process(
             target=eval_cif,
-            args=(progress_queue, task_queue, result_queue, length_lo, length_hi, angle_lo, angle_hi, debug)
+            args=(progress_queue, task_queue, result_queue, length_lo, length_hi, angle_lo, angle_hi, debug,
+                  fast_bond_length_score, space_group_cache_path)
         ) for _ in range(workers)
     ]
     processes.append(watcher)
@@ -181,6 +200,15 @@ if __name__ == "__main__":
         bond_length_reasonableness_scores.extend(scores)
         is_valid_and_lens.extend(is_valid_and_len)
 
+    cell_parameters = np.array([row[4] for row in is_valid_and_lens], dtype=float).reshape(-1, 6)
+    implied_vols = get_unit_cell_volumes(*cell_parameters.T)
+    # CIFs whose cell angles do not form a cell are excluded, as `get_unit_cell_volume` raises for them
+    is_valid_and_lens = [
+        (comp, sg, valid, gen_len, implied_vol, gen_vol)
+        for (comp, sg, valid, gen_len, _, gen_vol), implied_vol in zip(is_valid_and_lens, implied_vols.tolist())
+        if not np.isnan(implied_vol)
+    ]
+
     n_valid = 0
     valid_gen_lens = []
     results_data = {
@@ -1,6 +1,8 @@
 import sys
 sys.path.append(".")
 import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 
 from contextlib import nullcontext
@@ -10,14 +12,22 @@ import torch
 from crystallm import (
     parse_config,
     CIFTokenizer,
+    AsyncMCTSEvaluator,
+    AsyncScorer,
+    CachingScorer,
     ContextSensitiveTreeBuilder,
+    ForwardBatcher,
     GPT,
     GPTConfig,
     GreedySelector,
+    PooledZMQScorer,
     MCTSEvaluator,
     MCTSSampler,
     PUCTSelector,
     RandomScorer,
+    RootParallelMCTSSampler,
+    SpaceGroupDetector,
+    Tracer,
     UCTSelector,
     ZMQScorer,
 )
@@ -42,12 +52,33 @@ class MCTSDefaults:
     scorer: str = "zmq"  # supported values: 'zmq', 'random'
     scorer_host: str = "localhost"  # required if `scorer` is 'zmq'
     scorer_port: int = 5555  # required if `scorer` is 'zmq'
+    scorer_endpoints: str = ""  # optional, if `scorer` is 'zmq': comma-separated host:port list of batch scorers
+    scorer_batch_size: int = 1  # the maximum number of CIFs sent to a scorer in one request
+    score_cache_size: int = 0  # if > 0, the number of scores of previously seen structures to keep in memory
+    score_cache_path: str = ""  # optional: path to an SQLite file in which scores are cached across runs
     use_context_sensitive_tree_builder: bool = True
     top_child_weight_cutoff: float = 0.99
     selector: str = "puct"  # valid values: 'puct', 'uct', 'greedy'
     n_space_groups: int = 0
     bypass_only_child: bool = False
     n_rollouts: int = 1  # the number of rollouts to perform per simulation
+    scorer_max_in_flight: int = 0  # if > 0, score CIFs asynchronously, with at most this many outstanding requests
+    stepwise: bool = False  # commit one move at a time, keeping the subtree of each move for the next decision
+    checkpoint_interval: int = 0  # if > 0, the number of simulations between snapshots of the search
+    resume: bool = False  # continue the search from the snapshot in `mcts_out_dir`, if there is one
+    prompts: str = ""  # optional: path to a .tar.gz of prompt .txt files (from `bin/make_prompts.py`), instead of `start`
+    n_concurrent_searches: int = 8  # if `prompts` is given, the number of searches run at the same time
+    n_workers: int = 1  # if > 1, the number of processes running independent searches from `start`, merged at the end
+    threads_per_worker: int = 1  # the number of threads used by PyTorch in each process, if `n_workers` > 1
+    value_rollout_depth: int = -1  # if >= 0, evaluate leaves with the model's value head, after a rollout of this many tokens
+    early_rollout_cutoff: bool = False  # stop a rollout as soon as its composition or atom site multiplicities are inconsistent
+    profile: bool = False  # print the time spent in each phase of the search at the end
+    trace_path: str = ""  # optional: path of a JSONL file to which each timed phase of the search is written
+    chrome_trace_path: str = ""  # optional: path of a file to which the timed phases are written in the Chrome trace format
+    evaluator_processes: int = 0  # if > 0, the number of processes validating the rollouts of a simulation, if `n_rollouts` > 1
+    fast_bond_length_score: bool = False  # check bond lengths with the fast approximation of the CrystalNN-based score
+    space_group_cache_size: int = 10000  # the number of detected space groups remembered in memory
+    space_group_cache_path: str = ""  # optional: path to an SQLite database in which detected space groups are remembered
 
 
 if __name__ == "__main__":
@@ -56,6 +87,22 @@ if __name__ == "__main__":
     print("Using configuration:")
     print(OmegaConf.to_yaml(C))
 
+    if C.n_workers > 1:
+        if C.profile or C.trace_path or C.chrome_trace_path:
+            # the workers are separate processes, which would share a single trace file, and whose phases
+            #  are not recorded by the tracer of this process
+            raise Exception("profile, trace_path and chrome_trace_path are not supported with n_workers > 1")
+        # the root-parallel search runs a single search from `start` in each worker
+        unsupported = [name for name, given in (("stepwise", C.stepwise),
+                                                ("checkpoint_interval", C.checkpoint_interval > 0),
+                                                ("resume", C.resume),
+                                                ("prompts", bool(C.prompts))) if given]
+        if unsupported:
+            raise Exception(f"{', '.join(unsupported)} not supported with n_workers > 1")
+        if "cuda" in C.device:
+            # the workers are forked once the model is on the device, and CUDA cannot be used after a fork
+            raise Exception("n_workers > 1 requires device=cpu")
+
     torch.manual_seed(C.seed)
     torch.cuda.manual_seed(C.seed)
     torch.backends.cuda.matmul.allow_tf32 = True  # allow tf32 on matmul
@@ -85,26 +132,59 @@ if __name__ == "__main__":
     if C.compile:
         model = torch.compile(model)  # requires PyTorch 2.0 (optional)
 
-    prompt = C.start
-    if prompt.startswith("FILE:"):
-        with open(prompt[5:], "r", encoding="utf-8") as f:
-            prompt = f.read()
+    tracer = Tracer(
+        enabled=C.profile or bool(C.trace_path) or bool(C.chrome_trace_path),
+        trace_path=C.trace_path or None,
+        keep_events=bool(C.chrome_trace_path),
+    )
 
-    cif_scorer = None
-    if C.scorer == "zmq":
-        cif_scorer = ZMQScorer(host=C.scorer_host, port=C.scorer_port)
-    elif C.scorer == "random":
-        cif_scorer = RandomScorer()
-    else:
-        raise Exception(f"unsupported scorer: {C.scorer}")
+    def make_scorer():
+        if C.scorer == "zmq" and C.scorer_endpoints:
+            scorer = PooledZMQScorer(endpoints=C.scorer_endpoints.split(","), batch_size=C.scorer_batch_size)
+        elif C.scorer == "zmq":
+            scorer = ZMQScorer(host=C.scorer_host, port=C.scorer_port)
+        elif C.scorer == "random":
+            scorer = RandomScorer()
+        else:
+            raise Exception(f"unsupported scorer: {C.scorer}")
+        return scorer
 
-    evaluator = MCTSEvaluator(
-        scorer=cif_scorer,
-        tokenizer=tokenizer,
-        bond_length_acceptability_cutoff=C.bond_length_acceptability_cutoff,
-        reward_k=C.reward_k,
-        out_dir=C.mcts_out_dir,
-    )
+    def with_cache(scorer):
+        if C.score_cache_size > 0 or C.score_cache_path:
+            return CachingScorer(scorer, maxsize=C.score_cache_size, db_path=C.score_cache_path or None)
+        return scorer
+
+    scorer_workers = len(C.scorer_endpoints.split(",")) if C.scorer == "zmq" and C.scorer_endpoints else 1
+
+    def make_space_group_detector():
+        return SpaceGroupDetector(maxsize=C.space_group_cache_size, db_path=C.space_group_cache_path or None)
+
+    def make_evaluator(scorer, out_dir, space_group_detector):
+        if C.scorer_max_in_flight > 0:
+            return AsyncMCTSEvaluator(
+                scorer=scorer,
+                tokenizer=tokenizer,
+                bond_length_acceptability_cutoff=C.bond_length_acceptability_cutoff,
+                reward_k=C.reward_k,
+                out_dir=out_dir,
+                max_in_flight=C.scorer_max_in_flight,
+                scorer_workers=scorer_workers,
+                scorer_batch_size=C.scorer_batch_size,
+                tracer=tracer,
+                fast_bond_length_score=C.fast_bond_length_score,
+                space_group_detector=space_group_detector,
+            )
+        return MCTSEvaluator(
+            scorer=scorer,
+            tokenizer=tokenizer,
+            bond_length_acceptability_cutoff=C.bond_length_acceptability_cutoff,
+            reward_k=C.reward_k,
+            out_dir=out_dir,
+            tracer=tracer,
+            n_processes=C.evaluator_processes,
+            fast_bond_length_score=C.fast_bond_length_score,
+            space_group_detector=space_group_detector,
+        )
 
     tree_builder = ContextSensitiveTreeBuilder(
         tokenizer=tokenizer,
@@ -122,17 +202,111 @@ if __name__ == "__main__":
     else:
         raise Exception(f"unsupported selector: {C.selector}")
 
-    sampler = MCTSSampler(
-        model=model,
-        config=gptconf,
-        width=C.tree_width,
-        max_depth=C.max_depth,
-        eval_function=evaluator,
-        node_selector=node_selector,
-        tokenizer=tokenizer,
-        temperature=C.temperature,
-        device=C.device,
-        tree_builder=tree_builder,
-    )
+    def make_sampler(scorer, out_dir, space_group_detector, batcher=None):
+        return MCTSSampler(
+            model=model,
+            config=gptconf,
+            width=C.tree_width,
+            max_depth=C.max_depth,
+            eval_function=make_evaluator(scorer, out_dir, space_group_detector),
+            node_selector=node_selector,
+            tokenizer=tokenizer,
+            temperature=C.temperature,
+            device=C.device,
+            tree_builder=tree_builder,
+            batcher=batcher,
+            value_rollout_depth=C.value_rollout_depth if C.value_rollout_depth >= 0 else None,
+            early_cutoff=C.early_rollout_cutoff,
+            tracer=tracer,
+        )
+
+    def make_worker_sampler(worker_id):
+        # each worker process connects to the scorer and the space group database itself, and writes to its own directory
+        return make_sampler(with_cache(make_scorer()), os.path.join(C.mcts_out_dir, f"worker_{worker_id}"),
+                            make_space_group_detector())
+
+    def run_search(prompt, scorer, out_dir, space_group_detector, batcher=None):
+        sampler = make_sampler(scorer, out_dir, space_group_detector, batcher)
+
+        if C.stepwise:
+            sampler.start_stepwise(prompt)
+            while sampler.step(C.num_simulations, n_rollouts=C.n_rollouts) is not None:
+                pass
+        else:
+            checkpoint_path = None
+            if C.checkpoint_interval > 0 or C.resume:
+                os.makedirs(out_dir, exist_ok=True)
+                checkpoint_path = os.path.join(out_dir, "mcts_checkpoint.pt")
+            sampler.search(prompt, C.num_simulations, stepwise=False, n_rollouts=C.n_rollouts,
+                           checkpoint_path=checkpoint_path, checkpoint_interval=C.checkpoint_interval,
+                           resume=C.resume)
+
+        sampler.close()
+
+    prompt = C.start
+    if prompt.startswith("FILE:"):
+        with open(prompt[5:], "r", encoding="utf-8") as f:
+            prompt = f.read()
+
+    if C.n_workers > 1:
+        print(f"running a root-parallel search with {C.n_workers} worker processes...")
+        model.share_memory()
+        root_parallel_sampler = RootParallelMCTSSampler(make_worker_sampler, n_workers=C.n_workers, seed=C.seed,
+                                                        threads_per_worker=C.threads_per_worker)
+        move = root_parallel_sampler.search(prompt, C.num_simulations, n_rollouts=C.n_rollouts)
+        print(f"most visited move: {repr(decode(move[-1:]))}")
+        best_sequence = root_parallel_sampler.get_best_sequence()
+        if best_sequence is not None:
+            print(f"best reward: {best_sequence[1]}")
+        sys.exit(0)
+
+    cif_scorer = with_cache(make_scorer())
+    space_group_detector = make_space_group_detector()
+    pooled_scorer = cif_scorer.scorer if isinstance(cif_scorer, CachingScorer) else cif_scorer
+    pooled_scorer = pooled_scorer if isinstance(pooled_scorer, PooledZMQScorer) else None
+
+    if C.prompts:
+        prompts = []
+        with tarfile.open(C.prompts, "r:gz") as tar:
+            for member in tar.getmembers():
+                f = tar.extractfile(member)
+                if f is not None:
+                    cif_id = os.path.basename(member.name).replace(".txt", "")
+                    prompts.append((cif_id, f.read().decode("utf-8")))
+        print(f"running {len(prompts)} searches, {C.n_concurrent_searches} at a time...")
+
+        # the searches share one model, whose forward passes are batched, and one scorer
+        batcher = ForwardBatcher(model, max_batch_size=C.n_concurrent_searches)
+        shared_scorer = AsyncScorer(cif_scorer, max_in_flight=max(C.n_concurrent_searches, C.scorer_max_in_flight),
+                                    workers=scorer_workers, batch_size=C.scorer_batch_size)
+        with ThreadPoolExecutor(max_workers=C.n_concurrent_searches) as executor:
+            futures = [executor.submit(run_search, prompt, shared_scorer, os.path.join(C.mcts_out_dir, cif_id),
+                                       space_group_detector, batcher)
+                       for cif_id, prompt in prompts]
+            for future in futures:
+                future.result()
+        shared_scorer.close()
+        batcher.close()
+        print(f"mean language model batch size: {batcher.mean_batch_size:.2f}")
+    else:
+        run_search(prompt, cif_scorer, C.mcts_out_dir, space_group_detector)
+
+    if pooled_scorer is not None:
+        for endpoint, histogram in pooled_scorer.latency_histograms().items():
+            print(f"scorer latency for {endpoint}: {histogram}")
+
+    if isinstance(cif_scorer, CachingScorer):
+        info = cif_scorer.cache_info()
+        print(f"score cache: {info.hits} hits ({info.disk_hits} from disk), {info.misses} misses, "
+              f"hit rate: {cif_scorer.hit_rate:.3f}")
+        cif_scorer.close()
+
+    info = space_group_detector.cache_info()
+    print(f"space group cache: {info.hits} hits ({info.disk_hits} from disk), {info.misses} misses")
+    space_group_detector.close()
 
-    sampler.search(prompt, C.num_simulations, stepwise=False, n_rollouts=C.n_rollouts)
+    if tracer.enabled:
+        tracer.close()
+        print(tracer.summary())
+        if C.chrome_trace_path:
+            tracer.write_chrome_trace(C.chrome_trace_path)
@@ -8,6 +8,8 @@ from crystallm import (
     extract_formula_nonreduced,
     extract_formula_units,
     extract_space_group_symbol,
+    get_cif_table_path,
+    load_cif_table,
 )
 
 import warnings
@@ -20,12 +22,21 @@ def load_cifs(fname):
         return pickle.load(f)
 
 
-def load_cifs_multi(fnames):
-    cifs = []
+def load_cifs_multi(fnames, use_tables=False):
+    cifs, tables = [], []
     if fnames:
         for fname in fnames:
-            cifs.extend(load_cifs(fname))
-    return cifs
+            file_cifs = load_cifs(fname)
+            cifs.extend(file_cifs)
+            if use_tables:
+                tables.append(load_table(fname, file_cifs))
+    return cifs, tables
+
+
+def load_table(fname, cifs):
+    table_fname = get_cif_table_path(fname)
+    print(f"loading the table of the CIFs from {table_fname}...")
+    return load_cif_table(table_fname, cifs)
 
 
 def extract_key(cif):
@@ -36,11 +47,22 @@ def extract_key(cif):
     return reduced_comp, Z, space_group
 
 
-def extract_all_keys_to_cifs(cifs):
+def keys_from_tables(tables):
+    for table in tables:
+        for key in zip(table["reduced_formula"].tolist(), table["formula_units"].tolist(),
+                       table["space_group"].tolist()):
+            # a missing value means that the property could not be extracted when the table was built
+            yield None if key[0] == "" or key[1] < 0 or key[2] == "" else key
+
+
+def extract_all_keys_to_cifs(cifs, tables=None):
     keys_to_cifs = {}
-    for id, cif in tqdm(cifs, desc="extracting keys..."):
+    keys = keys_from_tables(tables) if tables is not None else None
+    for id, cif in tqdm(cifs, desc="extracting keys..." if tables is None else "reading keys..."):
         try:
-            key = extract_key(cif)
+            key = extract_key(cif) if keys is None else next(keys)
+            if key is None:
+                raise Exception("the table has no key for this CIF")
             if key in keys_to_cifs:
                 print(f"WARNING: key already exists: {key}")
             keys_to_cifs[key] = (id, cif)
@@ -73,6 +95,10 @@ if __name__ == '__main__':
                         help="Path to the file where the merged CIFs will be stored. "
                              "The file will contain the gzipped contents of a pickle dump. It is "
                              "recommended that the filename end in `.pkl.gz`.")
+    parser.add_argument("--tables", action="store_true",
+                        help="Include this flag to read the reduced formulas, Z, and space groups from the table "
+                             "stored alongside each file of CIFs, made with `bin/build_cif_table.py`, instead of "
+                             "extracting them from the CIFs.")
 
     args = parser.parse_args()
 
@@ -82,17 +108,18 @@ if __name__ == '__main__':
     out_fname = args.out
 
     base_cifs = load_cifs(base_fname)
-    include_cifs = load_cifs_multi(include_fnames)
-    exclude_cifs = load_cifs_multi(exclude_fnames)
+    base_tables = [load_table(base_fname, base_cifs)] if args.tables else None
+    include_cifs, include_tables = load_cifs_multi(include_fnames, args.tables)
+    exclude_cifs, exclude_tables = load_cifs_multi(exclude_fnames, args.tables)
 
     print(f"total base CIFs: {len(base_cifs):,}")
     print(f"total CIFs to include: {len(include_cifs):,}")
     print(f"total CIFs to exclude: {len(exclude_cifs):,}")
 
     # create map {(reduced comp, Z, spacegroup) -> (id, cif)}
-    base_keys_to_cifs = extract_all_keys_to_cifs(base_cifs)
-    include_keys_to_cifs = extract_all_keys_to_cifs(include_cifs)
-    exclude_keys_to_cifs = extract_all_keys_to_cifs(exclude_cifs)
+    base_keys_to_cifs = extract_all_keys_to_cifs(base_cifs, base_tables)
+    include_keys_to_cifs = extract_all_keys_to_cifs(include_cifs, include_tables if args.tables else None)
+    exclude_keys_to_cifs = extract_all_keys_to_cifs(exclude_cifs, exclude_tables if args.tables else None)
 
     base_keys = set(base_keys_to_cifs)
     include_keys = set(include_keys_to_cifs)
@@ -6,13 +6,7 @@ from tqdm import tqdm
 import multiprocessing as mp
 from queue import Empty
 
-from crystallm import (
-    semisymmetrize_cif,
-    replace_data_formula_with_nonreduced_formula,
-    add_atomic_props_block,
-    round_numbers,
-    extract_formula_units,
-)
+from crystallm import preprocess_cif
 
 try:
     import cPickle as pickle
@@ -44,15 +38,8 @@ def augment_cif(progress_queue, task_queue, result_queue, oxi, decimal_places):
             break
 
         try:
-            formula_units = extract_formula_units(cif_str)
-            # exclude CIFs with formula units (Z) = 0, which are erroneous
-            if formula_units == 0:
-                raise Exception()
-
-            cif_str = replace_data_formula_with_nonreduced_formula(cif_str)
-            cif_str = semisymmetrize_cif(cif_str)
-            cif_str = add_atomic_props_block(cif_str, oxi)
-            cif_str = round_numbers(cif_str, decimal_places=decimal_places)
+            # CIFs with formula units (Z) = 0, which are erroneous, are excluded
+            cif_str = preprocess_cif(cif_str, oxi, decimal_places)
             augmented_cifs.append((id, cif_str))
         except Exception:
             pass
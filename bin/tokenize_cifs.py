@@ -28,13 +28,14 @@ def progress_listener(queue, n):
         pbar.update(message)
 
 
-def tokenize(chunk_of_cifs, queue=None):
-    tokenizer = CIFTokenizer()
+def tokenize(chunk_of_cifs, engine, queue=None):
+    tokenizer = CIFTokenizer(engine=engine)
     tokenized = []
     for cif in tqdm(chunk_of_cifs, disable=queue is not None, desc="tokenizing..."):
         if queue:
             queue.put(1)
-        tokenized.append(tokenizer.tokenize_cif(cif))
+        # the tokens are encoded as they are found, as a uint16 array
+        tokenized.append(tokenizer.tokenize_to_ids(cif))
     return tokenized
 
 
@@ -67,12 +68,16 @@ if __name__ == "__main__":
                         help="Output directory to store processed files.")
     parser.add_argument("--workers", type=int, default=4,
                         help="Number of workers to use for processing.")
+    parser.add_argument("--engine", choices=["regex", "trie"], default="trie",
+                        help="How the CIFs are split into tokens. Both engines give the same tokens; "
+                             "the trie engine is faster. Default is 'trie'.")
     args = parser.parse_args()
 
     train_fname = args.train_fname
     val_fname = args.val_fname
     out_dir = args.out_dir
     workers = args.workers
+    engine = args.engine
 
     has_val = len(val_fname) > 0
 
@@ -105,7 +110,7 @@ if __name__ == "__main__":
     jobs = []
     for i in range(workers):
         chunk = chunks[i]
-        job = pool.apply_async(tokenize, (chunk, queue))
+        job = pool.apply_async(tokenize, (chunk, engine, queue))
         jobs.append(job)
 
     tokenized_cifs_train = []
@@ -116,8 +121,11 @@ if __name__ == "__main__":
     pool.close()
     pool.join()
 
+    tokenizer = CIFTokenizer()
+    unk_id = tokenizer.token_to_id["<unk>"]
+
     lens = [len(t) for t in tokenized_cifs_train]
-    unk_counts = [t.count("<unk>") for t in tokenized_cifs_train]
+    unk_counts = [(t == unk_id).sum() for t in tokenized_cifs_train]
     print(f"train min tokenized length: {np.min(lens):,}")
     print(f"train max tokenized length: {np.max(lens):,}")
     print(f"train mean tokenized length: {np.mean(lens):.2f} +/- {np.std(lens):.2f}")
@@ -125,39 +133,27 @@ if __name__ == "__main__":
 
     if has_val:
         # tokenize the validation CIFs
-        tokenized_cifs_val = tokenize(cifs_val)
+        tokenized_cifs_val = tokenize(cifs_val, engine)
 
         lens = [len(t) for t in tokenized_cifs_val]
-        unk_counts = [t.count("<unk>") for t in tokenized_cifs_val]
+        unk_counts = [(t == unk_id).sum() for t in tokenized_cifs_val]
         print(f"val min tokenized length: {np.min(lens):,}")
         print(f"val max tokenized length: {np.max(lens):,}")
         print(f"val mean tokenized length: {np.mean(lens):.2f} +/- {np.std(lens):.2f}")
         print(f"val total unk counts: {np.sum(unk_counts)}")
 
-    # create a single stream of tokens that will be the dataset
-    train_data = []
-    for t in tqdm(tokenized_cifs_train, desc="concatenating train tokens..."):
-        train_data.extend(t)
-
-    if has_val:
-        val_data = []
-        for t in tqdm(tokenized_cifs_val, desc="concatenating val tokens..."):
-            val_data.extend(t)
-
-    print("encoding...")
-    tokenizer = CIFTokenizer()
-    train_ids = tokenizer.encode(train_data)
+    # create a single stream of token ids that will be the dataset
+    print("concatenating tokens...")
+    train_ids = np.concatenate(tokenized_cifs_train) if tokenized_cifs_train else np.array([], dtype=np.uint16)
     print(f"train has {len(train_ids):,} tokens")
     if has_val:
-        val_ids = tokenizer.encode(val_data)
+        val_ids = np.concatenate(tokenized_cifs_val) if tokenized_cifs_val else np.array([], dtype=np.uint16)
         print(f"val has {len(val_ids):,} tokens")
     print(f"vocab size: {len(tokenizer.token_to_id)}")
 
     print("exporting to .bin files...")
-    train_ids = np.array(train_ids, dtype=np.uint16)
     train_ids.tofile(os.path.join(out_dir, "train.bin"))
     if has_val:
-        val_ids = np.array(val_ids, dtype=np.uint16)
         val_ids.tofile(os.path.join(out_dir, "val.bin"))
 
     # save the meta information as well, to help us encode/decode later
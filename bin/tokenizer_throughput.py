@@ -0,0 +1,61 @@
+"""
+Measures the throughput of `CIFTokenizer.tokenize_to_ids`, with each of the "regex" and "trie" engines, against
+that of tokenizing and encoding with the previous implementation of `CIFTokenizer.tokenize_cif`, which rebuilt
+its patterns on every call, on a set of CIFs, such as the benchmark files in `resources/benchmarks`, e.g.:
+python bin/tokenizer_throughput.py resources/benchmarks/perov_5/test.csv resources/benchmarks/carbon_24/test.csv
+"""
+import sys
+sys.path.append(".")
+import argparse
+import re
+import time
+
+import pandas as pd
+
+from crystallm import CIFTokenizer
+from crystallm._tokenizer import SPACE_GROUPS, UNK_TOKEN
+
+
+def previous_tokenize_cif(tokenizer, cif_string, single_spaces=True):
+    # the implementation of `CIFTokenizer.tokenize_cif` that rebuilt its patterns on every call
+    spacegroups = "|".join(SPACE_GROUPS)
+    cif_string = re.sub(fr'(_symmetry_space_group_name_H-M *\b({spacegroups}))\n', r'\1_sg\n', cif_string)
+    token_pattern = '|'.join(tokenizer._escaped_tokens)
+    full_pattern = f'({token_pattern}|\\w+|[\\.,;!?])'
+    if single_spaces:
+        cif_string = re.sub(r'[ \t]+', ' ', cif_string)
+    tokens = re.findall(full_pattern, cif_string)
+    tokens = [token if token in tokenizer._tokens else UNK_TOKEN for token in tokens]
+    return tokens
+
+
+def timed(fn, cifs):
+    start = time.perf_counter()
+    n_tokens = sum(len(fn(cif)) for cif in cifs)
+    return n_tokens, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the throughput of the CIF tokenizer.")
+    parser.add_argument("cifs", nargs="+",
+                        help="Paths to .csv files with a 'cif' column.")
+    parser.add_argument("--limit", type=int, default=0,
+                        help="If > 0, only the first this many CIFs of each file are tokenized.")
+    args = parser.parse_args()
+
+    cifs = []
+    for path in args.cifs:
+        file_cifs = pd.read_csv(path)["cif"].tolist()
+        cifs.extend(file_cifs[:args.limit] if args.limit > 0 else file_cifs)
+
+    tokenizer = CIFTokenizer()
+
+    n_tokens, previous_time = timed(lambda cif: tokenizer.encode(previous_tokenize_cif(tokenizer, cif)), cifs)
+    print(f"CIFs: {len(cifs):,}, tokens: {n_tokens:,}")
+    print(f"previous tokenize_cif and encode: {n_tokens / previous_time:,.0f} tokens/s, "
+          f"{len(cifs) / previous_time * 3600:,.0f} CIFs/hour")
+
+    for engine in ("regex", "trie"):
+        _, time_s = timed(CIFTokenizer(engine=engine).tokenize_to_ids, cifs)
+        print(f"tokenize_to_ids with the {engine} engine: {n_tokens / time_s:,.0f} tokens/s, "
+              f"{len(cifs) / time_s * 3600:,.0f} CIFs/hour ({previous_time / time_s:.1f}x)")
@@ -0,0 +1,184 @@
+"""
+Trains a value head on top of a trained model, to estimate the reward of a (partial) CIF,
+so that MCTS can evaluate leaves without complete rollouts (see the `value_rollout_depth`
+option of `bin/mcts.py`). The weights of the model itself are frozen.
+
+The training examples are prefixes of generated CIFs, each labelled with the validity of the
+complete CIF, as determined by the checks of `bin/evaluate_cifs.py` (1 for a valid CIF, -1 for
+an invalid one). The CIFs are used as the model generated them, as are the rollouts that MCTS
+evaluates. (The CIFs written by MCTS are not suitable: they have been post-processed, and they
+are all valid.)
+"""
+import sys
+sys.path.append(".")
+import os
+import random
+import tarfile
+from dataclasses import dataclass
+
+from omegaconf import OmegaConf
+import numpy as np
+import torch
+from torch.nn import functional as F
+from tqdm import tqdm
+
+from crystallm import (
+    parse_config,
+    CIFTokenizer,
+    GPT,
+    GPTConfig,
+    extract_space_group_symbol,
+    is_sensible,
+    is_valid,
+    replace_symmetry_operators,
+)
+
+import warnings
+warnings.filterwarnings("ignore")
+
+
+@dataclass
+class ValueHeadDefaults:
+    out_dir: str = "out"  # path to the folder containing the model checkpoint file
+    value_out_dir: str = "out_value"  # path to the folder where the checkpoint with the value head will be stored
+    gen_cifs: str = ""  # path to a .tar.gz of generated CIFs, labelled by validity
+    prefixes_per_cif: int = 8  # the number of random prefixes of each CIF used as examples, besides the whole CIF
+    val_fraction: float = 0.1  # the fraction of CIFs held out for validation
+    batch_size: int = 64
+    max_iters: int = 2000
+    eval_interval: int = 100
+    learning_rate: float = 1e-3
+    weight_decay: float = 0.0
+    seed: int = 1337
+    device: str = "cuda"  # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+
+
+def get_validity_label(cif):
+    try:
+        if not is_sensible(cif):
+            return -1.
+        space_group_symbol = extract_space_group_symbol(cif)
+        if space_group_symbol is not None and space_group_symbol != "P 1":
+            cif = replace_symmetry_operators(cif, space_group_symbol)
+        return 1. if is_valid(cif, bond_length_acceptability_cutoff=1.0) else -1.
+    except Exception:
+        return -1.
+
+
+def read_validity_labels(gen_cifs_path):
+    examples = []
+    with tarfile.open(gen_cifs_path, "r:gz") as tar:
+        for member in tqdm(tar.getmembers(), desc="labelling generated CIFs..."):
+            f = tar.extractfile(member)
+            if f is not None:
+                cif = f.read().decode("utf-8")
+                examples.append((cif, get_validity_label(cif)))
+    return examples
+
+
+def make_prefixes(token_ids, target, n_prefixes, block_size, rng):
+    lengths = [len(token_ids)] + [rng.randint(1, len(token_ids)) for _ in range(n_prefixes)]
+    # the model sees at most the last `block_size` tokens of a prefix
+    return [(token_ids[max(0, n - block_size):n], target) for n in lengths]
+
+
+def to_batch(examples, device):
+    sequences = [torch.tensor(ids, dtype=torch.long) for ids, _ in examples]
+    idx = torch.nn.utils.rnn.pad_sequence(sequences, batch_first=True).to(device)
+    lengths = torch.tensor([len(ids) for ids, _ in examples], device=device)
+    targets = torch.tensor([target for _, target in examples], dtype=torch.float32, device=device)
+    return idx, lengths, targets
+
+
+if __name__ == "__main__":
+    C = parse_config(ValueHeadDefaults)
+
+    print("Using configuration:")
+    print(OmegaConf.to_yaml(C))
+
+    if not C.gen_cifs:
+        raise Exception("the 'gen_cifs' option is required")
+
+    rng = random.Random(C.seed)
+    torch.manual_seed(C.seed)
+
+    tokenizer = CIFTokenizer()
+
+    checkpoint = torch.load(os.path.join(C.out_dir, "ckpt.pt"), map_location=C.device)
+    model_args = dict(checkpoint["model_args"])
+    model_args["value_head"] = True
+    gptconf = GPTConfig(**model_args)
+    model = GPT(gptconf)
+    state_dict = checkpoint["model"]
+    unwanted_prefix = "_orig_mod."
+    for k, v in list(state_dict.items()):
+        if k.startswith(unwanted_prefix):
+            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    if unexpected or any(not k.startswith("value_head.") for k in missing):
+        raise Exception(f"the checkpoint does not match the model: missing {missing}, unexpected {unexpected}")
+    model.to(C.device)
+
+    # only the value head is trained
+    for name, p in model.named_parameters():
+        p.requires_grad = name.startswith("value_head.")
+
+    labelled_cifs = read_validity_labels(C.gen_cifs)
+    print(f"read {len(labelled_cifs):,} labelled CIFs "
+          f"(mean target: {np.mean([target for _, target in labelled_cifs]):.3f})")
+
+    rng.shuffle(labelled_cifs)
+    n_val = int(len(labelled_cifs) * C.val_fraction)
+    splits = {"val": labelled_cifs[:n_val], "train": labelled_cifs[n_val:]}
+    examples = {}
+    for split, cifs in splits.items():
+        examples[split] = []
+        n_skipped = 0
+        for cif, target in cifs:
+            token_ids = tokenizer.tokenize_to_ids(cif).tolist()
+            if len(token_ids) < 2:
+                # an empty, or nearly empty, file has no prefixes to learn from
+                n_skipped += 1
+                continue
+            examples[split].extend(make_prefixes(token_ids, target, C.prefixes_per_cif, gptconf.block_size, rng))
+        print(f"{split}: {len(examples[split]):,} examples from {len(cifs) - n_skipped:,} CIFs "
+              f"({n_skipped:,} skipped, with fewer than 2 tokens)")
+
+    @torch.no_grad()
+    def estimate_loss(split):
+        model.eval()
+        losses = []
+        for i in range(0, len(examples[split]), C.batch_size):
+            idx, lengths, targets = to_batch(examples[split][i:i+C.batch_size], C.device)
+            losses.append(F.mse_loss(model.value(idx, lengths), targets, reduction="sum").item())
+        model.value_head.train()
+        return sum(losses) / max(len(examples[split]), 1)
+
+    optimizer = torch.optim.AdamW(model.value_head.parameters(), lr=C.learning_rate, weight_decay=C.weight_decay)
+
+    os.makedirs(C.value_out_dir, exist_ok=True)
+    best_val_loss = float("inf")
+    # the frozen model stays in eval mode, without dropout, as it is when MCTS uses the value head
+    model.eval()
+    model.value_head.train()
+    for iter_num in range(1, C.max_iters + 1):
+        idx, lengths, targets = to_batch(rng.sample(examples["train"], min(C.batch_size, len(examples["train"]))),
+                                         C.device)
+        loss = F.mse_loss(model.value(idx, lengths, frozen=True), targets)
+        optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        optimizer.step()
+
+        if iter_num % C.eval_interval == 0 or iter_num == C.max_iters:
+            val_loss = estimate_loss("val") if examples["val"] else loss.item()
+            print(f"iter {iter_num}: train loss {loss.item():.4f}, val loss {val_loss:.4f}")
+            if val_loss < best_val_loss:
+                best_val_loss = val_loss
+                print(f"saving checkpoint to {C.value_out_dir}...")
+                torch.save({
+                    "model": model.state_dict(),
+                    "model_args": model_args,
+                    "iter_num": iter_num,
+                    "best_val_loss": best_val_loss,
+                    "config": dict(C),
+                }, os.path.join(C.value_out_dir, "ckpt.pt"))
@@ -1,6 +1,9 @@
 from ._tokenizer import CIFTokenizer
 
 from ._metrics import (
+    CIFAnalysis,
+    SpaceGroupDetector,
+    are_sensible,
     bond_length_reasonableness_score,
     is_space_group_consistent,
     is_atom_site_multiplicity_consistent,
@@ -9,6 +12,11 @@ from ._metrics import (
     is_valid,
 )
 
+from ._validation import (
+    ValidationResult,
+    validate_many,
+)
+
 from ._model import (
     GPT,
     GPTConfig,
@@ -17,7 +25,9 @@ from ._model import (
 from ._utils import (
     array_split,
     add_atomic_props_block,
+    are_cells_degenerate,
     embeddings_from_csv,
+    extract_atom_site_rows,
     extract_data_formula,
     extract_formula_nonreduced,
     extract_formula_units,
@@ -26,16 +36,50 @@ from ._utils import (
     extract_volume,
     get_atomic_props_block,
     get_atomic_props_block_for_formula,
+    get_canonical_cif_hash,
+    get_canonical_structure_hash,
+    get_element_props_table,
+    get_symmetry_operators_block,
     get_unit_cell_volume,
+    get_unit_cell_volumes,
+    get_volumes_per_formula_unit,
+    preprocess_cif,
     remove_atom_props_block,
     replace_data_formula_with_nonreduced_formula,
     replace_symmetry_operators,
     round_numbers,
+    scan_cif_header,
     semisymmetrize_cif,
+    CIFHeader,
+)
+
+from ._cif_table import (
+    CIF_TABLE_COLUMNS,
+    build_cif_table,
+    get_cif_properties,
+    get_cif_table_geometry,
+    get_cif_table_path,
+    load_cif_table,
+    save_cif_table,
+)
+
+from ._tracing import (
+    PhaseStats,
+    Tracer,
+)
+
+from ._cache import (
+    CacheInfo,
+    LRUCache,
+    SQLiteStore,
 )
 
 from ._scorer import (
+    AsyncScorer,
+    CachingScorer,
     CIFScorer,
+    LatencyHistogram,
+    PooledZMQScorer,
     RandomScorer,
     ZMQScorer,
 )
@@ -43,10 +87,17 @@ from ._scorer import (
 from ._configuration import parse_config
 
 from ._mcts import (
+    AsyncMCTSEvaluator,
     ContextSensitiveTreeBuilder,
+    ForwardBatcher,
     GreedySelector,
     MCTSSampler,
     MCTSEvaluator,
+    MCTSNode,
+    MCTSTree,
     PUCTSelector,
+    RootParallelMCTSSampler,
+    RolloutChecker,
+    RunningStats,
     UCTSelector,
 )
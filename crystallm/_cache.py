@@ -0,0 +1,81 @@
+import sqlite3
+import threading
+from collections import OrderedDict, namedtuple
+
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "disk_hits", "misses", "maxsize", "currsize"])
+
+
+class LRUCache:
+
+    def __init__(self, maxsize: int = 10000):
+        """
+        A bounded in-memory mapping which evicts the least recently used entry when full.
+        The cache is safe to use from several threads.
+
+        :param maxsize: the maximum number of entries held; if 0, nothing is held
+        """
+        self._maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def maxsize(self) -> int:
+        return self._maxsize
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        if self._maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+
+class SQLiteStore:
+
+    def __init__(self, path: str, table: str):
+        """
+        A persistent mapping from string keys to values, held in a table of an SQLite database.
+        Several processes may share the same database file. The store is safe to use from
+        several threads.
+
+        :param path: the path to the SQLite database file, which is created if it does not exist
+        :param table: the name of the table holding the entries
+        """
+        if not table.isidentifier():
+            raise ValueError(f"invalid table name: {table}")
+        self._table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30., check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value)")
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            row = self._conn.execute(f"SELECT value FROM {self._table} WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def put(self, key: str, value):
+        with self._lock, self._conn:
+            self._conn.execute(f"INSERT OR REPLACE INTO {self._table} (key, value) VALUES (?, ?)", (key, value))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {self._table}").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
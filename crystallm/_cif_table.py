@@ -0,0 +1,178 @@
+import multiprocessing as mp
+from typing import Dict, List, Tuple
+
+import numpy as np
+from pymatgen.core import Composition
+
+from ._metrics import are_sensible
+from ._tokenizer import CIFTokenizer
+from ._utils import (
+    are_cells_degenerate,
+    array_split,
+    get_unit_cell_volumes,
+    get_volumes_per_formula_unit,
+    scan_cif_header,
+)
+
+# the columns of a CIF table, and the value of each when it could not be extracted from a CIF
+CIF_TABLE_COLUMNS = {
+    "id": "",
+    "formula": "",  # the _chemical_formula_sum value
+    "reduced_formula": "",
+    "formula_units": -1,
+    "space_group": "",
+    "a": np.nan,
+    "b": np.nan,
+    "c": np.nan,
+    "alpha": np.nan,
+    "beta": np.nan,
+    "gamma": np.nan,
+    "volume": np.nan,
+    "n_tokens": -1,
+}
+
+_DTYPES = {
+    "id": str,
+    "formula": str,
+    "reduced_formula": str,
+    "space_group": str,
+    "formula_units": np.int32,
+    "n_tokens": np.int32,
+}
+
+
+def get_cif_properties(id: str, cif: str, tokenizer: CIFTokenizer = None) -> Dict:
+    """
+    Returns the values of the columns of a CIF table for the given CIF. A value that cannot be extracted
+    is replaced by the missing value of its column (see `CIF_TABLE_COLUMNS`).
+
+    :param id: the ID of the CIF
+    :param cif: the CIF
+    :param tokenizer: optional: the tokenizer used to count the tokens of the CIF; if not given,
+                      the tokens are not counted
+    :returns: a dict of column name to value
+    """
+    row = dict(CIF_TABLE_COLUMNS)
+    row["id"] = id
+    header = scan_cif_header(cif)
+    for column, tag in (("formula", "_chemical_formula_sum"), ("space_group", "_symmetry_space_group_name_H-M")):
+        row[column] = header.get(tag) or ""
+    for column in ("a", "b", "c", "alpha", "beta", "gamma", "volume"):
+        try:
+            value = getattr(header, column)
+        except ValueError:
+            value = None
+        row[column] = np.nan if value is None else value
+    try:
+        formula_units = header.formula_units
+    except ValueError:
+        formula_units = None
+    row["formula_units"] = -1 if formula_units is None else formula_units
+    if row["formula"]:
+        try:
+            row["reduced_formula"] = Composition(row["formula"]).reduced_formula
+        except Exception:
+            pass
+    if tokenizer is not None:
+        row["n_tokens"] = len(tokenizer.tokenize_cif(cif))
+    return row
+
+
+def _get_properties_of_chunk(chunk, count_tokens):
+    tokenizer = CIFTokenizer(engine="trie") if count_tokens else None
+    return [get_cif_properties(id, cif, tokenizer) for id, cif in chunk]
+
+
+def build_cif_table(cifs: List[Tuple[str, str]], workers: int = 1, chunk_size: int = 10_000,
+                    count_tokens: bool = True, progress=None) -> Dict[str, np.ndarray]:
+    """
+    Extracts the properties of each CIF of a corpus into a table, with a NumPy array for each of the
+    columns in `CIF_TABLE_COLUMNS`, the rows being in the order of the CIFs.
+
+    :param cifs: a list of (id, CIF) pairs, such as the contents of a .pkl.gz file of CIFs
+    :param workers: the number of processes used to extract the properties
+    :param chunk_size: the number of CIFs sent to a process at a time
+    :param count_tokens: whether the tokens of each CIF are counted (the slowest part); if not,
+                         the "n_tokens" column is -1
+    :param progress: optional: a callable, such as `tqdm.update`, called with the number of CIFs
+                     of each chunk as it completes
+    :returns: a dict of column name to array
+    """
+    chunks = array_split(cifs, max(1, -(-len(cifs) // chunk_size)))
+    rows = []
+    if workers > 1:
+        with mp.Pool(workers) as pool:
+            jobs = [pool.apply_async(_get_properties_of_chunk, (chunk, count_tokens)) for chunk in chunks]
+            for job in jobs:
+                chunk_rows = job.get()
+                rows.extend(chunk_rows)
+                if progress is not None:
+                    progress(len(chunk_rows))
+    else:
+        for chunk in chunks:
+            rows.extend(_get_properties_of_chunk(chunk, count_tokens))
+            if progress is not None:
+                progress(len(chunk))
+    return {
+        column: np.array([row[column] for row in rows], dtype=_DTYPES.get(column, np.float64))
+        for column in CIF_TABLE_COLUMNS
+    }
+
+
+def get_cif_table_geometry(table: Dict[str, np.ndarray], length_lo: float = 0.5, length_hi: float = 1000.,
+                           angle_lo: float = 10., angle_hi: float = 170.) -> Dict[str, np.ndarray]:
+    """
+    Computes the geometric properties of the cells of a CIF table, for all of its rows at once.
+
+    :param table: a CIF table, as returned by `build_cif_table` or `load_cif_table`
+    :param length_lo: the smallest cell length allowable for the sensibility check
+    :param length_hi: the largest cell length allowable for the sensibility check
+    :param angle_lo: the smallest cell angle allowable for the sensibility check
+    :param angle_hi: the largest cell angle allowable for the sensibility check
+    :returns: a dict with the arrays: "implied_volume", the volume implied by the cell parameters (NaN if
+              they are missing or do not form a cell); "vpfu", the stated volume per formula unit (NaN if
+              the volume or Z is missing); "sensible", whether the cell passes `is_sensible`; and
+              "degenerate", whether the cell does not enclose a volume (see `are_cells_degenerate`)
+    """
+    cell_parameters = [table[column] for column in ("a", "b", "c", "alpha", "beta", "gamma")]
+    return {
+        "implied_volume": get_unit_cell_volumes(*cell_parameters),
+        "vpfu": get_volumes_per_formula_unit(table["volume"], table["formula_units"]),
+        "sensible": are_sensible(*cell_parameters, length_lo, length_hi, angle_lo, angle_hi),
+        "degenerate": are_cells_degenerate(*cell_parameters),
+    }
+
+
+def get_cif_table_path(corpus_path: str) -> str:
+    """
+    Returns the path of the table of the given .pkl.gz corpus, which is stored alongside it,
+    e.g. "cifs_v1_dedup.table.npz" for "cifs_v1_dedup.pkl.gz".
+    """
+    for extension in (".pkl.gz", ".pkl"):
+        if corpus_path.endswith(extension):
+            return corpus_path[:-len(extension)] + ".table.npz"
+    return corpus_path + ".table.npz"
+
+
+def save_cif_table(table: Dict[str, np.ndarray], path: str):
+    np.savez_compressed(path, **table)
+
+
+def load_cif_table(path: str, cifs: List[Tuple[str, str]] = None) -> Dict[str, np.ndarray]:
+    """
+    Loads a table written by `save_cif_table`.
+
+    :param path: the path of the .npz file
+    :param cifs: optional: the (id, CIF) pairs the table is expected to describe; an exception
+                 is raised if their IDs are not those of the table, in the same order
+    :returns: a dict of column name to array
+    """
+    with np.load(path) as f:
+        table = {column: f[column] for column in f.files}
+    missing = [column for column in CIF_TABLE_COLUMNS if column not in table]
+    if missing:
+        raise Exception(f"the table in {path} is missing the columns: {missing}")
+    if cifs is not None:
+        if len(cifs) != len(table["id"]) or any(str(id) != table_id for (id, _), table_id in zip(cifs, table["id"])):
+            raise Exception(f"the table in {path} does not describe the given CIFs; it may need to be rebuilt")
+    return table
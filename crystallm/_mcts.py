@@ -1,84 +1,271 @@
 import os
+import queue
 import random
+import re
 import math
+import threading
+import time
 from math import sqrt, log
 import traceback
-from typing import List, Tuple, Union
+import multiprocessing as mp
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, List, Tuple, Union
 
 import numpy as np
 import torch
 from torch.nn import functional as F
+from pymatgen.core import Composition
 
 from crystallm import (
+    Tracer,
     GPT,
     GPTConfig,
+    AsyncScorer,
     CIFTokenizer,
     CIFScorer,
+    CIFAnalysis,
+    SpaceGroupDetector,
     bond_length_reasonableness_score,
     is_formula_consistent,
     is_space_group_consistent,
     is_atom_site_multiplicity_consistent,
-    extract_space_group_symbol,
     replace_symmetry_operators,
     remove_atom_props_block,
-    extract_numeric_property,
+    scan_cif_header,
     get_unit_cell_volume,
 )
 
 
+class RunningStats:
+
+    def __init__(self):
+        """
+        The count, mean, variance, minimum and maximum of a stream of numbers, updated in constant
+        time per number with Welford's algorithm.
+        """
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, x: float):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        self.min = min(self.min, x)
+        self.max = max(self.max, x)
+
+    @property
+    def std(self) -> float:
+        """
+        The population standard deviation, as computed by `np.std`.
+        """
+        return sqrt(self.m2 / self.count) if self.count > 0 else 0.
+
+    def all_equal(self) -> bool:
+        return self.count > 0 and self.min == self.max
+
+    def state_dict(self) -> dict:
+        return {"count": self.count, "mean": self.mean, "m2": self.m2, "min": self.min, "max": self.max}
+
+    def load_state_dict(self, state: dict):
+        self.count = int(state["count"])
+        self.mean = float(state["mean"])
+        self.m2 = float(state["m2"])
+        self.min = float(state["min"])
+        self.max = float(state["max"])
+
+
+def _postprocess_cif(cif_str):
+    # try to calculate the implied volume, to weed out very bad generations;
+    #  an exception will be thrown if a value is missing, or the volume is nonsensical
+    header = scan_cif_header(cif_str)
+    get_unit_cell_volume(*header.cell_parameters())
+
+    # replace the symmetry operators with the correct operators
+    space_group_symbol = header.space_group
+    if space_group_symbol is None:
+        raise Exception(f"could not extract space group from:\n{cif_str}")
+    if space_group_symbol != "P 1":
+        cif_str = replace_symmetry_operators(cif_str, space_group_symbol)
+
+    # remove atom props
+    cif_str = remove_atom_props_block(cif_str)
+
+    return cif_str
+
+
+def _validate_cif(generated_cif, bond_length_acceptability_cutoff, tracer: Tracer, fast_bond_length_score=False,
+                  space_group_detector: SpaceGroupDetector = None):
+    # the CIF is parsed once, by the first check, and shared by the others
+    analysis = CIFAnalysis(generated_cif)
+
+    with tracer.span("check_formula"):
+        formula_consistent = is_formula_consistent(analysis)
+    if not formula_consistent:
+        msg = "the generated CIF is inconsistent in terms of composition"
+        return False, msg, None
+
+    with tracer.span("check_multiplicity"):
+        multiplicity_consistent = is_atom_site_multiplicity_consistent(analysis)
+    if not multiplicity_consistent:
+        msg = "the generated CIF is inconsistent in terms of atom site multiplicity"
+        return False, msg, None
+
+    with tracer.span("check_bond_length"):
+        bond_length_score = bond_length_reasonableness_score(analysis, fast=fast_bond_length_score)
+    if bond_length_score < bond_length_acceptability_cutoff:
+        msg = f"unreasonable bond lengths detected " \
+              f"({(1 - bond_length_score) * 100:.0f}% of bond lengths were found to be unreasonable)"
+        return False, msg, bond_length_score
+
+    with tracer.span("check_space_group"):
+        space_group_consistent = is_space_group_consistent(analysis, space_group_detector)
+    if not space_group_consistent:
+        msg = "the generated CIF is inconsistent in terms of space group"
+        return False, msg, None
+
+    return True, "", None
+
+
+# the worker's copy of the SpaceGroupDetector of the evaluator that owns the pool, if it has one
+_worker_space_group_detector = None
+
+
+def _init_prepare_worker(space_group_detector: SpaceGroupDetector):
+    global _worker_space_group_detector
+    _worker_space_group_detector = space_group_detector
+
+
+def _prepare_cif(cif, bond_length_acceptability_cutoff,
+                 fast_bond_length_score=False) -> Tuple[Union[str, None], Union[float, None], str]:
+    """
+    Post-processes and validates a decoded CIF, in a worker process of an evaluator's pool. Space groups
+    are detected with the worker's copy of the evaluator's SpaceGroupDetector, which has its own
+    in-memory cache and shares the evaluator's database, if any; without a detector, every space group
+    is detected anew.
+
+    :returns: a 3-tuple of the post-processed CIF (or None), the reward for an invalid CIF (or None),
+              and a message describing why the CIF is invalid
+    """
+    try:
+        cif = _postprocess_cif(cif)
+        valid, msg, bond_length_score = _validate_cif(cif, bond_length_acceptability_cutoff, Tracer(enabled=False),
+                                                      fast_bond_length_score, _worker_space_group_detector)
+        if not valid:
+            return None, -(1 - bond_length_score) if bond_length_score is not None else -1.0, f"CIF invalid: {msg}"
+    except Exception as e:
+        return None, -1.0, f"exception while post-processing and validating: {e}\n{traceback.format_exc()}"
+    return cif, None, ""
+
+
 class MCTSEvaluator:
     def __init__(self, scorer: CIFScorer, tokenizer: CIFTokenizer,
-                 bond_length_acceptability_cutoff=1.0, reward_k=2.0, out_dir=None):
+                 bond_length_acceptability_cutoff=1.0, reward_k=2.0, out_dir=None, tracer: Tracer = None,
+                 n_processes: int = 0, results_buffer_size: int = 16, fast_bond_length_score: bool = False,
+                 space_group_detector: SpaceGroupDetector = None):
+        """
+        :param fast_bond_length_score: if True, the bond lengths are checked with the fast approximation
+                                       of the bond length reasonableness score, instead of with CrystalNN
+        :param space_group_detector: optional: the SpaceGroupDetector used to check the space group of valid CIFs,
+                                     e.g. to share its cache between evaluators; by default, the space group of
+                                     each CIF is detected anew
+        :param n_processes: if > 0, the number of worker processes used by `evaluate_batch` to
+                            post-process and validate the rollouts of a batch; the workers use the
+                            module-level post-processing and validation, so it cannot be combined with
+                            a subclass that overrides `_postprocess` or `_is_valid`
+        :param results_buffer_size: the number of rows of results.csv held in memory before they
+                                    are appended to the file; call `flush()` or `close()` to write
+                                    the remaining rows
+        """
+        if n_processes > 0 and (type(self)._postprocess is not MCTSEvaluator._postprocess or
+                                type(self)._is_valid is not MCTSEvaluator._is_valid):
+            raise ValueError(f"n_processes > 0 cannot be used with {type(self).__name__}, "
+                             f"as it overrides _postprocess or _is_valid")
+        self._tracer = tracer if tracer is not None else Tracer(enabled=False)
         self._scorer = scorer
         self._tokenizer = tokenizer
         self._bond_length_acceptability_cutoff = bond_length_acceptability_cutoff
         self._k = reward_k
         self._out_dir = out_dir
         self._num_valid = 0
-        self._all_scores = []
-        self._all_cifs = []
+        self._score_stats = RunningStats()
+        self._n_processes = n_processes
+        self._pool = None
+        self._results_buffer_size = results_buffer_size
+        self._results_rows = []
+        self._results_csv_ready = False
+        self._fast_bond_length_score = fast_bond_length_score
+        self._space_group_detector = space_group_detector
+
+    def state_dict(self) -> dict:
+        """
+        Returns the statistics of the evaluator that must survive a restart of the search:
+        the statistics of the scores observed so far, which determine the rewards, and the number
+        of valid CIFs, which determines the names of the files written.
+        The state of the scorer is included if it has any (e.g. the random number generator of a
+        RandomScorer), as is the length of results.csv, so that the rows and CIFs written after
+        the snapshot can be discarded when the search is resumed. The buffered rows should be
+        written with `flush()` first.
+        """
+        state = {
+            "score_stats": self._score_stats.state_dict(),
+            "num_valid": self._num_valid,
+        }
+        scorer = self._stateful_scorer()
+        if scorer is not None:
+            state["scorer"] = scorer.state_dict()
+        if self._out_dir is not None:
+            csv_fname = os.path.join(self._out_dir, "results.csv")
+            state["results_csv_size"] = os.path.getsize(csv_fname) if os.path.exists(csv_fname) else 0
+        return state
+
+    def load_state_dict(self, state: dict):
+        if "all_scores" in state:
+            # a snapshot written before the statistics were kept incrementally
+            self._score_stats = RunningStats()
+            for score in state["all_scores"].tolist():
+                self._score_stats.add(score)
+        else:
+            self._score_stats.load_state_dict(state["score_stats"])
+        self._num_valid = int(state["num_valid"])
+        scorer = self._stateful_scorer()
+        if scorer is not None and "scorer" in state:
+            scorer.load_state_dict(state["scorer"])
+        if self._out_dir is not None and "results_csv_size" in state:
+            self._discard_results_after_snapshot(state["results_csv_size"])
+
+    def _stateful_scorer(self):
+        # the scorer, or the scorer it wraps (e.g. in a CachingScorer), that has state to be saved, if any
+        scorer = self._scorer
+        while scorer is not None and not hasattr(scorer, "state_dict"):
+            scorer = getattr(scorer, "scorer", None)
+        return scorer
+
+    def _discard_results_after_snapshot(self, results_csv_size):
+        # the rows and CIFs written after the snapshot will be written again by the resumed search
+        csv_fname = os.path.join(self._out_dir, "results.csv")
+        if os.path.exists(csv_fname) and os.path.getsize(csv_fname) > results_csv_size:
+            if results_csv_size == 0:
+                # results.csv did not exist yet; it is created again, with its header, when needed
+                os.remove(csv_fname)
+            else:
+                with open(csv_fname, "r+") as f:
+                    f.truncate(results_csv_size)
+        if os.path.isdir(self._out_dir):
+            for fname in os.listdir(self._out_dir):
+                match = re.fullmatch(r"generated_(\d+)\.cif", fname)
+                if match and int(match.group(1)) > self._num_valid:
+                    os.remove(os.path.join(self._out_dir, fname))
 
     def _postprocess(self, cif_str):
-        # try to calculate the implied volume, to weed out very bad generations;
-        #  an exception will be thrown if a value is missing, or the volume is nonsensical
-        a = extract_numeric_property(cif_str, "_cell_length_a")
-        b = extract_numeric_property(cif_str, "_cell_length_b")
-        c = extract_numeric_property(cif_str, "_cell_length_c")
-        alpha = extract_numeric_property(cif_str, "_cell_angle_alpha")
-        beta = extract_numeric_property(cif_str, "_cell_angle_beta")
-        gamma = extract_numeric_property(cif_str, "_cell_angle_gamma")
-        get_unit_cell_volume(a, b, c, alpha, beta, gamma)
-
-        # replace the symmetry operators with the correct operators
-        space_group_symbol = extract_space_group_symbol(cif_str)
-        if space_group_symbol is not None and space_group_symbol != "P 1":
-            cif_str = replace_symmetry_operators(cif_str, space_group_symbol)
-
-        # remove atom props
-        cif_str = remove_atom_props_block(cif_str)
-
-        return cif_str
+        return _postprocess_cif(cif_str)
 
     def _is_valid(self, generated_cif):
-        if not is_formula_consistent(generated_cif):
-            msg = "the generated CIF is inconsistent in terms of composition"
-            return False, msg, None
-
-        if not is_atom_site_multiplicity_consistent(generated_cif):
-            msg = "the generated CIF is inconsistent in terms of atom site multiplicity"
-            return False, msg, None
-
-        bond_length_score = bond_length_reasonableness_score(generated_cif)
-        if bond_length_score < self._bond_length_acceptability_cutoff:
-            msg = f"unreasonable bond lengths detected " \
-                  f"({(1 - bond_length_score) * 100:.0f}% of bond lengths were found to be unreasonable)"
-            return False, msg, bond_length_score
-
-        if not is_space_group_consistent(generated_cif):
-            msg = "the generated CIF is inconsistent in terms of space group"
-            return False, msg, None
-
-        return True, "", None
+        return _validate_cif(generated_cif, self._bond_length_acceptability_cutoff, self._tracer,
+                             self._fast_bond_length_score, self._space_group_detector)
 
     def _get_reward(self, score):
         """
@@ -91,19 +278,27 @@ class MCTSEvaluator:
         If higher scores are better, then provide a negative k value. If
         lower scores are better, provide a positive k value.
         """
-        self._all_scores.append(score)
-        if len(self._all_scores) == 1 or len(np.unique(self._all_scores)) == 1:
+        self._score_stats.add(score)
+        sigma = self._score_stats.std
+        if self._score_stats.count == 1 or self._score_stats.all_equal() or sigma == 0:
             # when we only have a single sample, or all scores are the same, the reward should be 0.5
             return 0.5
-        mu = np.mean(self._all_scores)
-        sigma = np.std(self._all_scores)
+        mu = self._score_stats.mean
         return 1 / (1 + math.e**(self._k*((score - mu)/sigma)))
 
     def _write_cif_to_file(self, cif, score, reward, id, iter_num):
         if self._out_dir is not None:
 
-            if not os.path.exists(self._out_dir):
-                os.makedirs(self._out_dir)
+            if not self._results_csv_ready:
+                os.makedirs(self._out_dir, exist_ok=True)
+
+                # create .csv to keep track of results
+                csv_fname = os.path.join(self._out_dir, "results.csv")
+                if not os.path.exists(csv_fname):
+                    print(f"creating {csv_fname} as it does not exist...")
+                    with open(csv_fname, "wt") as f:
+                        f.write("file,iteration,score,reward\n")
+                self._results_csv_ready = True
 
             cif_file = f"generated_{id}.cif"
             cif_fname = os.path.join(self._out_dir, cif_file)
@@ -112,80 +307,472 @@ class MCTSEvaluator:
                 with open(cif_fname, "wt") as f:
                     f.write(cif)
 
-                # create .csv to keep track of results
-                csv_file = "results.csv"
-                csv_fname = os.path.join(self._out_dir, csv_file)
-                if not os.path.exists(csv_fname):
-                    print(f"creating {csv_fname} as it does not exist...")
-                    with open(csv_fname, "wt") as f:
-                        f.write("file,iteration,score,reward\n")
-
                 # update .csv
-                with open(csv_fname, "a") as f:
-                    f.write(f"{cif_file},{iter_num},{score},{reward}\n")
+                self._results_rows.append(f"{cif_file},{iter_num},{score},{reward}\n")
+                if len(self._results_rows) >= self._results_buffer_size:
+                    self.flush()
 
             else:
                 print(f"CIF not written to file as it already exists: {cif_fname}")
 
-    def __call__(self, token_sequence, iter_num):
+    def flush(self):
+        """
+        Appends the buffered rows to results.csv.
+        """
+        if self._results_rows:
+            with open(os.path.join(self._out_dir, "results.csv"), "a") as f:
+                f.writelines(self._results_rows)
+            self._results_rows = []
+
+    def _prepare(self, token_sequence) -> Tuple[Union[str, None], Union[float, None]]:
+        """
+        Decodes, post-processes and validates the given token sequence.
+
+        :param token_sequence: the token ids of a rollout
+        :returns: a 2-tuple of the post-processed CIF and None, if the CIF is valid, or a 2-tuple
+                  of None and the (negative) reward for the invalid CIF
+        """
         cif = self._tokenizer.decode(token_sequence)
 
         try:
-            cif = self._postprocess(cif)
+            with self._tracer.span("postprocess"):
+                cif = self._postprocess(cif)
             valid, msg, bond_length_score = self._is_valid(cif)
             if not valid:
                 print(f"CIF invalid: {msg}")
                 if bond_length_score is not None:
-                    return -(1 - bond_length_score)
+                    return None, -(1 - bond_length_score)
                 else:
-                    return -1.0
+                    return None, -1.0
         except Exception as e:
             print(f"exception while post-processing and validating: {e}")
             print(traceback.format_exc())
+            return None, -1.0
+
+        return cif, None
+
+    def _prepare_batch(self, token_sequences) -> List[Tuple[Union[str, None], Union[float, None]]]:
+        if self._n_processes <= 0 or len(token_sequences) < 2:
+            return [self._prepare(token_sequence) for token_sequence in token_sequences]
+
+        if self._pool is None:
+            # worker processes are spawned, rather than forked, as the parent may hold CUDA state and threads
+            self._pool = ProcessPoolExecutor(max_workers=self._n_processes, mp_context=mp.get_context("spawn"),
+                                             initializer=_init_prepare_worker,
+                                             initargs=(self._space_group_detector,))
+        cifs = [self._tokenizer.decode(token_sequence) for token_sequence in token_sequences]
+        prepared = []
+        with self._tracer.span("postprocess_and_validate_batch"):
+            results = list(self._pool.map(_prepare_cif, cifs, [self._bond_length_acceptability_cutoff] * len(cifs),
+                                          [self._fast_bond_length_score] * len(cifs)))
+        for cif, reward, msg in results:
+            if msg:
+                print(msg)
+            prepared.append((cif, reward))
+        return prepared
+
+    def _finish(self, cif, score, id, iter_num):
+        if math.isnan(score):
+            print(f"reward cannot be computed as score is nan")
             return -1.0
 
+        reward = self._get_reward(score)
+        print(f"computed reward: {reward}")
+
+        self._write_cif_to_file(cif, score, reward, id, iter_num)
+
+        return reward
+
+    def __call__(self, token_sequence, iter_num):
+        cif, reward = self._prepare(token_sequence)
+        if cif is None:
+            return reward
+
         self._num_valid += 1
 
         try:
             print("invoking external scorer...")
-            score = self._scorer.score(cif)
+            with self._tracer.span("score"):
+                score = self._scorer.score(cif)
             print(f"external scorer returned score: {score}")
         except Exception as e:
             print(f"exception while scoring: {e}")
             print(traceback.format_exc())
             return -1.0
 
-        if math.isnan(score):
-            print(f"reward cannot be computed as score is nan")
+        return self._finish(cif, score, self._num_valid, iter_num)
+
+    def evaluate_batch(self, token_sequences: List[List[int]], iter_num: int) -> List[float]:
+        """
+        Evaluates several rollouts in one call. The rollouts are post-processed and validated (across
+        the evaluator's worker processes, if it has any), and the valid CIFs are sent to the scorer
+        together, as one batch. The rewards are the same as those returned by calling the evaluator on
+        each rollout in turn.
+
+        :param token_sequences: the token ids of the rollouts
+        :param iter_num: the simulation the rollouts belong to
+        :returns: the reward of each rollout
+        """
+        rewards = []
+        valid = []
+        for i, (cif, reward) in enumerate(self._prepare_batch(token_sequences)):
+            rewards.append(reward)
+            if cif is not None:
+                self._num_valid += 1
+                valid.append((i, cif, self._num_valid))
+        if not valid:
+            return rewards
+
+        try:
+            print(f"invoking external scorer with {len(valid)} CIF(s)...")
+            with self._tracer.span("score"):
+                scores = self._scorer.score_batch([cif for _, cif, _ in valid])
+            print(f"external scorer returned scores: {scores}")
+        except Exception as e:
+            print(f"exception while scoring: {e}")
+            print(traceback.format_exc())
+            scores = [None] * len(valid)
+
+        for (i, cif, id), score in zip(valid, scores):
+            rewards[i] = -1.0 if score is None else self._finish(cif, score, id, iter_num)
+        return rewards
+
+    def close(self):
+        """
+        Writes the buffered results, and shuts down the worker processes, if there are any.
+        """
+        self.flush()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+class PendingReward:
+    def __init__(self, reward: float = None, evaluator: "AsyncMCTSEvaluator" = None, cif: str = None,
+                 id: int = None, iter_num: int = None, score_future: Future = None):
+        """
+        The reward for a rollout which may still be waiting on the external scorer. The reward is
+        computed, at most once, by the thread that calls `result()`, so that the evaluator's running
+        statistics are only ever updated from the search thread.
+        """
+        self._reward = reward
+        self._evaluator = evaluator
+        self._cif = cif
+        self._id = id
+        self._iter_num = iter_num
+        self._score_future = score_future
+
+    def done(self) -> bool:
+        return self._reward is not None or self._score_future.done()
+
+    def result(self) -> float:
+        """
+        Returns the reward, blocking until the external scorer has replied if necessary.
+        """
+        if self._reward is None:
+            self._reward = self._evaluator._complete(self._cif, self._score_future, self._id, self._iter_num)
+        return self._reward
+
+
+class AsyncMCTSEvaluator(MCTSEvaluator):
+    def __init__(self, scorer: CIFScorer, tokenizer: CIFTokenizer,
+                 bond_length_acceptability_cutoff=1.0, reward_k=2.0, out_dir=None,
+                 max_in_flight=8, scorer_workers=1, scorer_batch_size=1, provisional_reward=0.5,
+                 tracer: Tracer = None, results_buffer_size: int = 16, fast_bond_length_score: bool = False,
+                 space_group_detector: SpaceGroupDetector = None):
+        """
+        An MCTSEvaluator which does not wait for the external scorer. Rollouts are post-processed and
+        validated immediately, but valid CIFs are queued for scoring, and a PendingReward is returned.
+        The search uses the provisional reward in place of any reward that is not yet available, and
+        corrects its statistics once the reward arrives. The default provisional reward of 0.5 is the
+        reward of a valid CIF that scores at the running mean.
+
+        :param max_in_flight: the maximum number of scoring requests that may be outstanding
+        :param scorer_workers: the number of threads invoking the scorer; must be 1 for the ZMQScorer
+        :param scorer_batch_size: the maximum number of queued CIFs sent to the scorer together
+        :param provisional_reward: the reward assumed for a valid CIF until its score is available
+        """
+        super().__init__(scorer, tokenizer, bond_length_acceptability_cutoff, reward_k, out_dir, tracer,
+                         results_buffer_size=results_buffer_size, fast_bond_length_score=fast_bond_length_score,
+                         space_group_detector=space_group_detector)
+        self._async_scorer = AsyncScorer(scorer, max_in_flight=max_in_flight, workers=scorer_workers,
+                                         batch_size=scorer_batch_size)
+        self._provisional_reward = provisional_reward
+
+    @property
+    def provisional_reward(self) -> float:
+        return self._provisional_reward
+
+    def submit(self, token_sequence, iter_num) -> PendingReward:
+        cif, reward = self._prepare(token_sequence)
+        if cif is None:
+            return PendingReward(reward=reward)
+
+        self._num_valid += 1
+
+        print("submitting CIF to external scorer...")
+        score_future = self._async_scorer.submit(cif)
+        if self._tracer.enabled:
+            # the latency includes the time spent waiting in the queue for a worker
+            submitted = time.perf_counter()
+            score_future.add_done_callback(
+                lambda _: self._tracer.record("score", time.perf_counter() - submitted, start=submitted))
+        return PendingReward(evaluator=self, cif=cif, id=self._num_valid, iter_num=iter_num,
+                             score_future=score_future)
+
+    def _complete(self, cif, score_future, id, iter_num):
+        try:
+            score = score_future.result()
+            print(f"external scorer returned score: {score}")
+        except Exception as e:
+            print(f"exception while scoring: {e}")
+            print(traceback.format_exc())
             return -1.0
 
-        reward = self._get_reward(score)
-        print(f"computed reward: {reward}")
+        return self._finish(cif, score, id, iter_num)
 
-        self._write_cif_to_file(cif, score, reward, self._num_valid, iter_num)
+    def close(self):
+        self._async_scorer.close()
+        super().close()
 
-        return reward
+
+class ForwardBatcher:
+
+    def __init__(self, model: GPT, max_batch_size: int = 32, max_wait_ms: float = 2.):
+        """
+        Shares a model between several searches running in different threads. Each request for the
+        next-token logits of a sequence is queued, and a background thread runs the queued requests
+        through the model together, as one padded batch.
+
+        :param model: the model
+        :param max_batch_size: the maximum number of sequences forwarded together
+        :param max_wait_ms: the time, in milliseconds, to wait for more requests after the first
+                            request of a batch arrives
+        """
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be at least 1, got: {max_batch_size}")
+        self._model = model
+        self._max_batch_size = max_batch_size
+        self._max_wait_s = max_wait_ms / 1000
+        self._requests = queue.Queue()
+        self._n_batches = 0
+        self._n_requests = 0
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def next_token_logits(self, idx: torch.Tensor) -> torch.Tensor:
+        """
+        Returns the logits of the next token, blocking until the batch containing the request has
+        been forwarded.
+
+        :param idx: a (1, t) tensor of token ids
+        :returns: a (1, vocab_size) tensor of logits
+        """
+        future = Future()
+        self._requests.put((idx[0], future))
+        return future.result()
+
+    @property
+    def mean_batch_size(self) -> float:
+        """
+        The mean number of sequences forwarded together so far.
+        """
+        return self._n_requests / self._n_batches if self._n_batches > 0 else 0.
+
+    def close(self):
+        self._requests.put(None)
+        self._thread.join()
+
+    def _work(self):
+        stop = False
+        while not stop:
+            request = self._requests.get()
+            if request is None:
+                break
+            requests = [request]
+            deadline = time.time() + self._max_wait_s
+            while len(requests) < self._max_batch_size:
+                try:
+                    request = self._requests.get(timeout=max(deadline - time.time(), 0.))
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                requests.append(request)
+            self._forward(requests)
+
+    def _forward(self, requests):
+        self._n_batches += 1
+        self._n_requests += len(requests)
+        try:
+            sequences = [idx for idx, _ in requests]
+            lengths = torch.tensor([len(idx) for idx in sequences], device=sequences[0].device)
+            padded = torch.nn.utils.rnn.pad_sequence(sequences, batch_first=True)
+            with torch.no_grad():
+                logits = self._model.forward_last(padded, lengths)
+        except Exception as e:
+            for _, future in requests:
+                future.set_exception(e)
+            return
+        for i, (_, future) in enumerate(requests):
+            future.set_result(logits[i:i+1])
+
+
+class RolloutChecker:
+    _DATA_FORMULA = re.compile(r"data_([A-Za-z0-9]+)")
+
+    def __init__(self, tokenizer: CIFTokenizer):
+        """
+        Follows the tokens of a rollout as they are sampled, and decides, as early as possible, whether
+        the CIF would fail the composition or atom site multiplicity checks of the MCTSEvaluator. Both
+        are decided by the `_chemical_formula_*` lines and the atom site loop, long before the end of
+        the CIF. The checker only reports a CIF invalid when the failure is certain; anything it cannot
+        interpret is left to the evaluator.
+
+        :param tokenizer: the tokenizer used to decode the token ids
+        """
+        self._tokenizer = tokenizer
+        self.reset()
+
+    def reset(self):
+        self.invalid = False
+        self.reason = None
+        self._line = []
+        self._data_formula = None
+        self._formula_sum = None
+        self._formula_structural = None
+        self._expected_atoms = None
+        self._formula_checked = False
+        self._loop_headers = None
+        self._in_loop_rows = False
+        self._actual_atoms = {}
+
+    def update_all(self, token_ids: List[int]) -> bool:
+        for token_id in token_ids:
+            if self.update(token_id):
+                break
+        return self.invalid
+
+    def update(self, token_id: int) -> bool:
+        """
+        Adds a token to the CIF, and returns True if the CIF is now known to be invalid.
+        """
+        if self.invalid:
+            return True
+        token = self._tokenizer.decode([token_id])
+        if token != "\n":
+            self._line.append(token)
+            return False
+        line = "".join(self._line)
+        self._line = []
+        self._check_line(line.strip())
+        return self.invalid
+
+    def _fail(self, reason: str):
+        self.invalid = True
+        self.reason = reason
+
+    @staticmethod
+    def _value(line: str, key: str) -> str:
+        value = line[len(key):].strip()
+        if len(value) > 1 and value[0] == value[-1] and value[0] in "'\"":
+            value = value[1:-1]
+        return value
+
+    def _check_line(self, line: str):
+        if line.startswith("_chemical_formula_sum") or line.startswith("_chemical_formula_structural") or \
+                line.startswith("loop_") or line.startswith("data_") or line == "":
+            self._in_loop_rows = False
+
+        if self._data_formula is None and line.startswith("data_"):
+            match = self._DATA_FORMULA.fullmatch(line)
+            self._data_formula = match.group(1) if match else ""
+        elif line.startswith("_chemical_formula_sum") and self._formula_sum is None:
+            self._formula_sum = self._value(line, "_chemical_formula_sum")
+            try:
+                self._expected_atoms = Composition(self._formula_sum).as_dict()
+            except Exception:
+                self._expected_atoms = None
+        elif line.startswith("_chemical_formula_structural") and self._formula_structural is None:
+            self._formula_structural = self._value(line, "_chemical_formula_structural")
+        elif line.startswith("loop_"):
+            self._loop_headers = []
+        elif line.startswith("_") and self._loop_headers is not None and not self._in_loop_rows:
+            self._loop_headers.append(line.split()[0])
+        elif line and self._loop_headers:
+            self._in_loop_rows = True
+            self._check_atom_site_row(line)
+
+        if not self._formula_checked and self._data_formula and self._formula_sum is not None and \
+                self._formula_structural is not None:
+            self._formula_checked = True
+            self._check_formula()
+
+    def _check_formula(self):
+        try:
+            reduced_formulas = {Composition(f).reduced_formula
+                                for f in (self._data_formula, self._formula_sum, self._formula_structural)}
+        except Exception:
+            return
+        if len(reduced_formulas) > 1:
+            self._fail("the generated CIF is inconsistent in terms of composition")
+
+    def _check_atom_site_row(self, line: str):
+        headers = self._loop_headers
+        if "_atom_site_type_symbol" not in headers or "_atom_site_symmetry_multiplicity" not in headers:
+            return
+        if self._expected_atoms is None:
+            return
+        values = line.split()
+        if len(values) != len(headers):
+            return
+        atom_type = values[headers.index("_atom_site_type_symbol")]
+        try:
+            multiplicity = int(values[headers.index("_atom_site_symmetry_multiplicity")])
+        except ValueError:
+            return
+        if multiplicity < 0:
+            return
+        # the counts only grow as rows are added, so an excess can never be made good
+        self._actual_atoms[atom_type] = self._actual_atoms.get(atom_type, 0) + multiplicity
+        if atom_type not in self._expected_atoms or self._actual_atoms[atom_type] > self._expected_atoms[atom_type]:
+            self._fail("the generated CIF is inconsistent in terms of atom site multiplicity")
 
 
 class MCTSLanguageModel:
-    def __init__(self, model: GPT, config: GPTConfig, child_ids: List[int], device: str, temperature: float):
+    def __init__(self, model: GPT, config: GPTConfig, child_ids: List[int], device: str, temperature: float,
+                 batcher: ForwardBatcher = None, tracer: Tracer = None):
         self._model = model
         self._model.eval()
         self._config = config
         self._child_ids = child_ids
         self._device = device
         self._temperature = temperature
+        self._batcher = batcher
+        self._tracer = tracer if tracer is not None else Tracer(enabled=False)
 
-    def rollout(self, rollout_state: List[int], width: int, max_depth: int, newline_id: int) -> List[int]:
+    def _next_token_logits(self, idx_cond: torch.Tensor) -> torch.Tensor:
+        with self._tracer.span("lm_forward"):
+            if self._batcher is not None:
+                return self._batcher.next_token_logits(idx_cond)
+            logits, _ = self._model(idx_cond)
+            return logits[:, -1, :]
+
+    def rollout(self, rollout_state: List[int], width: int, max_depth: int, newline_id: int,
+                checker: RolloutChecker = None) -> List[int]:
         idx = (torch.tensor(rollout_state, dtype=torch.long, device=self._device)[None, ...])
         prev_id = None
+        if checker is not None:
+            checker.reset()
+            if checker.update_all(rollout_state):
+                return idx[0].tolist()
         for _ in range(max_depth):
             # if the sequence context is growing too long we must crop it at block_size
             idx_cond = idx if idx.size(1) <= self._config.block_size else idx[:, -self._config.block_size:]
-            # forward the model to get the logits for the index in the sequence
-            logits, _ = self._model(idx_cond)
-            # pluck the logits at the final step and scale by desired temperature
-            logits = logits[:, -1, :] / self._temperature
+            # forward the model to get the logits for the index in the sequence,
+            #  and scale the logits at the final step by desired temperature
+            logits = self._next_token_logits(idx_cond) / self._temperature
             # optionally crop the logits to only the top k options
             if width is not None:
                 v, _ = torch.topk(logits, min(width, logits.size(-1)))
@@ -200,6 +787,9 @@ class MCTSLanguageModel:
             if prev_id is not None and prev_id == newline_id and idx_next.item() == newline_id:
                 break
             prev_id = idx_next.item()
+            # stop as soon as the CIF is known to be invalid
+            if checker is not None and checker.update(prev_id):
+                break
         return idx[0].tolist()
 
     def top_n_vocab_with_weights(self, n: int, token_sequence: List[int]) -> Tuple[List[int], List[float]]:
@@ -207,10 +797,9 @@ class MCTSLanguageModel:
 
         # if the sequence context is growing too long we must crop it at block_size
         idx_cond = idx if idx.size(1) <= self._config.block_size else idx[:, -self._config.block_size:]
-        # forward the model to get the logits for the index in the sequence
-        logits, _ = self._model(idx_cond)
-        # pluck the logits at the final step and scale by desired temperature
-        logits = logits[:, -1, :] / self._temperature
+        # forward the model to get the logits for the index in the sequence,
+        #  and scale the logits at the final step by desired temperature
+        logits = self._next_token_logits(idx_cond) / self._temperature
 
         dist = torch.distributions.categorical.Categorical(logits=logits)
 
@@ -228,6 +817,15 @@ class MCTSLanguageModel:
 
         return top_n_child_ids, top_n_weights
 
+    def value(self, token_sequence: List[int]) -> float:
+        """
+        Returns the model's value head estimate of the reward of the given sequence.
+        """
+        idx = (torch.tensor(token_sequence, dtype=torch.long, device=self._device)[None, ...])
+        idx_cond = idx if idx.size(1) <= self._config.block_size else idx[:, -self._config.block_size:]
+        with torch.no_grad():
+            return self._model.value(idx_cond).item()
+
     @staticmethod
     def _normalize(log_probs: List[float]) -> List[float]:
         probs = [math.exp(lp) for lp in log_probs]
@@ -284,73 +882,431 @@ class ContextSensitiveTreeBuilder:
         return top_n_child_ids, top_n_weights
 
 
-class MCTSNode:
+class MCTSTree:
     def __init__(
         self,
-        state: List[int],
+        root_state: List[int],
         language_model: MCTSLanguageModel,
         width: int,
         max_depth: int,
         newline_id: int,
-        parent: "MCTSNode" = None,
         tree_builder: ContextSensitiveTreeBuilder = None,
+        capacity: int = 1024,
     ):
-        self.state = state
-        self._newline_id = newline_id
+        """
+        A search tree stored in flat NumPy arrays indexed by node id. Rather than a copy of its
+        token sequence, each node holds the id of its parent and the tokens it appends to the
+        parent's sequence (usually a single token), so that the full state of a node is rebuilt
+        on demand by walking up to the root. Visits, wins and priors are held in arrays.
+
+        When a node is expanded, all of its candidate children are allocated at once, as a block of
+        consecutive ids, and a child is "tried" once it has been added to the search. The order in
+        which the children of a node were tried is recorded, to preserve the tie-breaking behaviour
+        of the selectors, which consider the tried children in that order.
+
+        :param root_state: the token ids of the root node
+        :param capacity: the number of nodes for which space is initially allocated
+        """
         self._lm = language_model
         self._width = width
         self._max_depth = max_depth
-        self.wins = 0.0
-        self.visits = 0.0
-        self.prob = None
-        self.parent = parent
+        self._newline_id = newline_id
         self.tree_builder = tree_builder
-        self.children = []
-        self.untried_moves, self.child_weight_map = self._get_child_states()
+
+        self._root_state = list(root_state)
+        self._n_nodes = 0
+        self._n_tokens = 0
+        self._parent = np.empty(capacity, dtype=np.int32)
+        self._visits = np.empty(capacity, dtype=np.float64)
+        self._wins = np.empty(capacity, dtype=np.float64)
+        self._prior = np.empty(capacity, dtype=np.float64)
+        self._depth = np.empty(capacity, dtype=np.int32)
+        self._delta_start = np.empty(capacity, dtype=np.int64)
+        self._delta_len = np.empty(capacity, dtype=np.int16)
+        self._first_child = np.empty(capacity, dtype=np.int32)
+        self._n_children = np.empty(capacity, dtype=np.int32)
+        self._n_tried = np.empty(capacity, dtype=np.int32)
+        self._tried_rank = np.empty(capacity, dtype=np.int32)
+        self._tokens = np.empty(capacity, dtype=np.uint16)
+
+        root = self._allocate(1)
+        self._parent[root] = -1
+        self._prior[root] = np.nan
+        self._depth[root] = len(self._root_state)
+        self._delta_start[root] = 0
+        self._delta_len[root] = 0
+        self._tried_rank[root] = 0
+        self._expand(root)
+
+    @property
+    def root(self) -> "MCTSNode":
+        return MCTSNode(self, 0)
+
+    def __len__(self):
+        return self._n_nodes
+
+    @property
+    def visits(self) -> np.ndarray:
+        return self._visits[:self._n_nodes]
+
+    @property
+    def wins(self) -> np.ndarray:
+        return self._wins[:self._n_nodes]
+
+    @property
+    def priors(self) -> np.ndarray:
+        return self._prior[:self._n_nodes]
+
+    @property
+    def parents(self) -> np.ndarray:
+        return self._parent[:self._n_nodes]
+
+    def nbytes(self) -> int:
+        """
+        Returns the number of bytes allocated for the arrays of the tree.
+        """
+        return sum(getattr(self, name).nbytes for name in self._ARRAYS) + self._tokens.nbytes
+
+    def state(self, node_id: int) -> List[int]:
+        """
+        Reconstructs the token ids of the given node.
+        """
+        deltas = []
+        while node_id > 0:
+            start = self._delta_start[node_id]
+            deltas.append(self._tokens[start:start + self._delta_len[node_id]])
+            node_id = self._parent[node_id]
+        if not deltas:
+            return list(self._root_state)
+        deltas.reverse()
+        return self._root_state + np.concatenate(deltas).tolist()
+
+    def depth(self, node_id: int) -> int:
+        """
+        Returns the number of tokens in the state of the given node.
+        """
+        return int(self._depth[node_id])
+
+    def parent(self, node_id: int) -> int:
+        return int(self._parent[node_id])
+
+    def prior(self, node_id: int) -> float:
+        return float(self._prior[node_id])
+
+    def child_range(self, node_id: int) -> Tuple[int, int]:
+        """
+        Returns the ids delimiting the block of (tried and untried) children of the given node,
+        as a half-open range.
+        """
+        first = int(self._first_child[node_id])
+        return first, first + int(self._n_children[node_id])
+
+    def tried_children(self, node_id: int) -> List[int]:
+        """
+        Returns the ids of the children of the given node that have been tried, in the order
+        in which they were tried.
+        """
+        return self.tried_children_array(node_id).tolist()
+
+    def tried_children_array(self, node_id: int) -> np.ndarray:
+        """
+        Returns the ids of the children of the given node that have been tried, in the order
+        in which they were tried, as an array that can be used to index the node statistics.
+        """
+        first, end = self.child_range(node_id)
+        ids = np.empty(self._n_tried[node_id], dtype=np.int64)
+        if len(ids) > 0:
+            ranks = self._tried_rank[first:end]
+            tried = np.flatnonzero(ranks >= 0)
+            ids[ranks[tried]] = first + tried
+        return ids
+
+    def untried_children(self, node_id: int) -> List[int]:
+        """
+        Returns the ids of the children of the given node that have not yet been tried, in
+        the order in which they were proposed.
+        """
+        first, end = self.child_range(node_id)
+        return (first + np.flatnonzero(self._tried_rank[first:end] < 0)).tolist()
+
+    def has_untried_children(self, node_id: int) -> bool:
+        return self._n_tried[node_id] < self._n_children[node_id]
+
+    def has_tried_children(self, node_id: int) -> bool:
+        return self._n_tried[node_id] > 0
+
+    def try_child(self, child_id: int):
+        """
+        Adds the given untried child to the search, and expands it.
+        """
+        parent = self._parent[child_id]
+        if self._tried_rank[child_id] >= 0:
+            raise Exception(f"node {child_id} has already been tried")
+        self._tried_rank[child_id] = self._n_tried[parent]
+        self._n_tried[parent] += 1
+        self._expand(child_id)
+
+    def _expand(self, node_id: int):
+        self._first_child[node_id] = self._n_nodes
+        self._n_children[node_id] = 0
+        self._n_tried[node_id] = 0
+        self._visits[node_id] = 0.
+        self._wins[node_id] = 0.
+
+        if self._depth[node_id] >= self._max_depth:
+            return
+        state = self.state(node_id)
+        if MCTSNode.is_complete(state, self._newline_id):
+            return
+
+        top_n_child_ids, top_n_weights = self._lm.top_n_vocab_with_weights(self._width, state)
+        if self.tree_builder is not None:
+            top_n_child_ids, top_n_weights = self.tree_builder.get_child_ids_and_weights(
+                state, top_n_child_ids, top_n_weights, self._lm, self._width, self._newline_id)
+
+        n = len(top_n_child_ids)
+        deltas = [ids if type(ids) == list else [ids] for ids in top_n_child_ids]
+        first = self._allocate(n)
+        self._first_child[node_id] = first
+        self._n_children[node_id] = n
+        for i, delta in enumerate(deltas):
+            child_id = first + i
+            start = self._append_tokens(delta)
+            self._parent[child_id] = node_id
+            self._prior[child_id] = top_n_weights[i]
+            self._depth[child_id] = self._depth[node_id] + len(delta)
+            self._delta_start[child_id] = start
+            self._delta_len[child_id] = len(delta)
+            self._tried_rank[child_id] = -1
+            self._first_child[child_id] = -1
+            self._n_children[child_id] = 0
+            self._n_tried[child_id] = 0
+            self._visits[child_id] = 0.
+            self._wins[child_id] = 0.
+
+    _ARRAYS = ("_parent", "_visits", "_wins", "_prior", "_depth", "_delta_start", "_delta_len",
+               "_first_child", "_n_children", "_n_tried", "_tried_rank")
+
+    def state_dict(self) -> dict:
+        """
+        Returns the contents of the tree as a dict of arrays, trimmed to the nodes and tokens in use.
+        """
+        state = {name.lstrip("_"): getattr(self, name)[:self._n_nodes].copy() for name in self._ARRAYS}
+        state["tokens"] = self._tokens[:self._n_tokens].copy()
+        state["root_state"] = np.asarray(self._root_state, dtype=np.int64)
+        return state
+
+    @staticmethod
+    def from_state_dict(
+        state: dict,
+        language_model: MCTSLanguageModel,
+        width: int,
+        max_depth: int,
+        newline_id: int,
+        tree_builder: ContextSensitiveTreeBuilder = None,
+    ) -> "MCTSTree":
+        """
+        Recreates a tree from the result of state_dict(), without calling the language model.
+        """
+        tree = MCTSTree.__new__(MCTSTree)
+        tree._lm = language_model
+        tree._width = width
+        tree._max_depth = max_depth
+        tree._newline_id = newline_id
+        tree.tree_builder = tree_builder
+        tree._root_state = state["root_state"].tolist()
+        for name in MCTSTree._ARRAYS:
+            setattr(tree, name, np.array(state[name.lstrip("_")]))
+        tree._n_nodes = len(tree._parent)
+        tree._tokens = np.array(state["tokens"])
+        tree._n_tokens = len(tree._tokens)
+        return tree
+
+    def subtree(self, node_id: int) -> "MCTSTree":
+        """
+        Returns a new tree rooted at the given node, holding the node's descendants together
+        with their statistics and proposed children, so that a search can continue from
+        the node without repeating the work already done beneath it. The rest of the tree is
+        discarded.
+
+        :param node_id: the id of the node that becomes the root of the new tree
+        :returns: a new MCTSTree
+        """
+        tree = MCTSTree.__new__(MCTSTree)
+        tree._lm = self._lm
+        tree._width = self._width
+        tree._max_depth = self._max_depth
+        tree._newline_id = self._newline_id
+        tree.tree_builder = self.tree_builder
+        tree._root_state = self.state(node_id)
+        tree._n_nodes = 0
+        tree._n_tokens = 0
+        capacity = max(len(self._parent) // 2, 1)
+        for name in self._ARRAYS:
+            setattr(tree, name, np.empty(capacity, dtype=getattr(self, name).dtype))
+        tree._tokens = np.empty(max(len(self._tokens) // 2, 1), dtype=self._tokens.dtype)
+
+        root = tree._allocate(1)
+        tree._parent[root] = -1
+        tree._prior[root] = np.nan
+        tree._depth[root] = self._depth[node_id]
+        tree._delta_start[root] = 0
+        tree._delta_len[root] = 0
+        tree._tried_rank[root] = 0
+
+        # copy the nodes breadth-first, allocating the children of each node as one block
+        queue = [(node_id, root)]
+        for old_id, new_id in queue:
+            tree._visits[new_id] = self._visits[old_id]
+            tree._wins[new_id] = self._wins[old_id]
+            tree._n_tried[new_id] = self._n_tried[old_id]
+            n_children = int(self._n_children[old_id])
+            tree._n_children[new_id] = n_children
+            if n_children == 0:
+                tree._first_child[new_id] = tree._n_nodes
+                continue
+            old_first = int(self._first_child[old_id])
+            new_first = tree._allocate(n_children)
+            tree._first_child[new_id] = new_first
+            for i in range(n_children):
+                old_child, new_child = old_first + i, new_first + i
+                start = self._delta_start[old_child]
+                delta = self._tokens[start:start + self._delta_len[old_child]]
+                tree._delta_start[new_child] = tree._append_tokens(delta)
+                tree._delta_len[new_child] = len(delta)
+                tree._parent[new_child] = new_id
+                tree._prior[new_child] = self._prior[old_child]
+                tree._depth[new_child] = self._depth[old_child]
+                tree._tried_rank[new_child] = self._tried_rank[old_child]
+                if self._tried_rank[old_child] >= 0:
+                    queue.append((old_child, new_child))
+                else:
+                    tree._first_child[new_child] = -1
+                    tree._n_children[new_child] = 0
+                    tree._n_tried[new_child] = 0
+                    tree._visits[new_child] = 0.
+                    tree._wins[new_child] = 0.
+        return tree
+
+    def _allocate(self, n: int) -> int:
+        first = self._n_nodes
+        required = first + n
+        capacity = len(self._parent)
+        if required > capacity:
+            new_capacity = max(required, 2 * capacity)
+            for name in self._ARRAYS:
+                old = getattr(self, name)
+                new = np.empty(new_capacity, dtype=old.dtype)
+                new[:capacity] = old
+                setattr(self, name, new)
+        self._n_nodes = required
+        return first
+
+    def _append_tokens(self, tokens: List[int]) -> int:
+        start = self._n_tokens
+        required = start + len(tokens)
+        if required > len(self._tokens):
+            new = np.empty(max(required, 2 * len(self._tokens)), dtype=self._tokens.dtype)
+            new[:start] = self._tokens[:start]
+            self._tokens = new
+        self._tokens[start:required] = tokens
+        self._n_tokens = required
+        return start
+
+
+class MCTSNode:
+    __slots__ = ("tree", "id")
+
+    def __init__(self, tree: MCTSTree, node_id: int):
+        """
+        A lightweight view of a node of an MCTSTree. Views are created on demand, and two views
+        of the same node are equal.
+        """
+        self.tree = tree
+        self.id = node_id
+
+    def __eq__(self, other):
+        return isinstance(other, MCTSNode) and self.tree is other.tree and self.id == other.id
+
+    def __hash__(self):
+        return hash((id(self.tree), self.id))
 
     @staticmethod
     def is_complete(state: List[int], newline_id: int):
         return len(state) > 1 and state[-2:] == [newline_id, newline_id]
 
-    def _get_child_states(self):
-        child_states = []
-        child_state_weight_map = {}
-        if len(self.state) < self._max_depth and not self.is_complete(self.state, self._newline_id):
-            top_n_child_ids, top_n_weights = self._lm.top_n_vocab_with_weights(self._width, self.state)
-            if self.tree_builder is not None:
-                top_n_child_ids, top_n_weights = self.tree_builder.get_child_ids_and_weights(
-                    self.state, top_n_child_ids, top_n_weights, self._lm, self._width, self._newline_id)
-            for i in range(len(top_n_child_ids)):
-                if type(top_n_child_ids[i]) == list:
-                    child_state = self.state + top_n_child_ids[i]
-                else:
-                    child_state = self.state + [top_n_child_ids[i]]
-                child_states.append(child_state)
-                child_state_weight_map[tuple(child_state)] = top_n_weights[i]
-        return child_states, child_state_weight_map
+    @property
+    def state(self) -> List[int]:
+        return self.tree.state(self.id)
+
+    @property
+    def visits(self) -> float:
+        return float(self.tree._visits[self.id])
+
+    @visits.setter
+    def visits(self, value: float):
+        self.tree._visits[self.id] = value
+
+    @property
+    def wins(self) -> float:
+        return float(self.tree._wins[self.id])
+
+    @wins.setter
+    def wins(self, value: float):
+        self.tree._wins[self.id] = value
+
+    @property
+    def prob(self) -> Union[float, None]:
+        prior = self.tree.prior(self.id)
+        return None if math.isnan(prior) else prior
+
+    @property
+    def parent(self) -> Union["MCTSNode", None]:
+        parent_id = self.tree.parent(self.id)
+        return None if parent_id < 0 else MCTSNode(self.tree, parent_id)
+
+    @property
+    def children(self) -> List["MCTSNode"]:
+        return [MCTSNode(self.tree, c) for c in self.tree.tried_children(self.id)]
+
+    @property
+    def untried_moves(self) -> List[List[int]]:
+        return [self.tree.state(c) for c in self.tree.untried_children(self.id)]
 
     def has_untried_moves(self):
-        return self.untried_moves != []
+        return self.tree.has_untried_children(self.id)
 
-    def select_untried_move(self):
-        return random.choice(self.untried_moves)
+    def select_untried_move(self) -> "MCTSNode":
+        return MCTSNode(self.tree, random.choice(self.tree.untried_children(self.id)))
 
-    def add_child(self, child_state, language_model, width, max_depth, newline_id):
-        child = MCTSNode(child_state, language_model, width, max_depth, newline_id,
-                         parent=self, tree_builder=self.tree_builder)
-        child.prob = self.child_weight_map[tuple(child_state)]
-        self.children.append(child)
-        self.untried_moves.remove(child_state)
+    def add_child(self, child: "MCTSNode") -> "MCTSNode":
+        self.tree.try_child(child.id)
         return child
 
     def has_children(self):
-        return self.children != []
+        return self.tree.has_tried_children(self.id)
 
 
 class MCTSNodeSelector:
     def select_node(self, nodes: List[MCTSNode]) -> MCTSNode:
         pass
 
+    def select_child(self, tree: MCTSTree, node_id: int) -> int:
+        """
+        Returns the id of the selected child, among the tried children of the given node.
+        Subclasses may override this to operate directly on the statistics of the tree.
+        """
+        return self.select_node(MCTSNode(tree, node_id).children).id
+
+
+def _first_argmax(values: np.ndarray) -> int:
+    # np.argmax returns the first occurrence of the maximum, as the selectors always have,
+    #  but it treats NaN as the maximum, whereas a NaN is never selected by the scalar loop
+    #  unless it comes first
+    if np.isnan(values[0]):
+        return 0
+    return int(np.argmax(np.where(np.isnan(values), -math.inf, values)))
+
 
 class PUCTSelector(MCTSNodeSelector):
 
@@ -367,6 +1323,21 @@ class PUCTSelector(MCTSNodeSelector):
                 selected_node = node
         return selected_node
 
+    def select_child(self, tree: MCTSTree, node_id: int) -> int:
+        ids = tree.tried_children_array(node_id)
+        visits = tree.visits[ids]
+        unvisited = visits == 0
+        if unvisited[0]:
+            return int(ids[0])
+        priors = tree.priors[ids]
+        if np.isnan(priors[~unvisited]).any():
+            raise Exception("node has no action prob: %s" % tree.state(int(ids[np.isnan(priors)][0])))
+        # the terms are grouped as in _puct, so that the values are identical
+        with np.errstate(divide="ignore", invalid="ignore"):
+            puct = tree.wins[ids] / visits + (self._cpuct * priors) * (sqrt(tree.visits[node_id]) / (1 + visits))
+        puct[unvisited] = math.inf
+        return int(ids[_first_argmax(puct)])
+
     def _puct(self, node: MCTSNode) -> float:
         if node.visits == 0:
             return math.inf
@@ -411,6 +1382,22 @@ class UCTSelector(MCTSNodeSelector):
                 selected_node = node
         return selected_node
 
+    def select_child(self, tree: MCTSTree, node_id: int) -> int:
+        ids = tree.tried_children_array(node_id)
+        visits = tree.visits[ids]
+        unvisited = visits == 0
+        if unvisited[0]:
+            return int(ids[0])
+        priors = tree.priors[ids]
+        if np.isnan(priors[~unvisited]).any():
+            raise Exception("node has no action prob: %s" % tree.state(int(ids[np.isnan(priors)][0])))
+        # the log of the parent visits is shared by all children, and is computed once, as in _uct
+        log_parent_visits = log(tree.visits[node_id])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            uct = (tree.wins[ids] / visits) + self._c * np.sqrt(log_parent_visits / visits)
+        uct[unvisited] = math.inf
+        return int(ids[_first_argmax(uct)])
+
     def _uct(self, node: MCTSNode) -> float:
         if node.visits == 0:
             return math.inf
@@ -433,7 +1420,23 @@ class MCTSSampler:
         temperature: float,
         device: str,
         tree_builder=None,
+        batcher: ForwardBatcher = None,
+        value_rollout_depth: int = None,
+        early_cutoff: bool = False,
+        tracer: Tracer = None,
     ):
+        """
+        :param value_rollout_depth: optional: if given, leaves are evaluated with the model's value head,
+                                    instead of with the evaluator, after a rollout of at most this many
+                                    tokens (or directly, if 0); rollouts that complete the CIF are still
+                                    evaluated with the evaluator. The model must have a value head.
+        :param early_cutoff: if True, a rollout is stopped as soon as the CIF is known to fail the composition
+                             or atom site multiplicity checks, and is given the reward of -1.0 that the
+                             evaluator would give it, without being evaluated
+        :param tracer: optional: a Tracer recording the time spent in each phase of the search
+        """
+        if value_rollout_depth is not None and getattr(model, "value_head", None) is None:
+            raise ValueError("value_rollout_depth requires a model with a value head")
         self._width = width
         self._max_depth = max_depth
         self._eval_function = eval_function
@@ -441,54 +1444,345 @@ class MCTSSampler:
         self._node_selector = node_selector
         self._tokenizer = tokenizer
         child_ids = list(range(len(self._tokenizer.token_to_id)))
-        self._lm = MCTSLanguageModel(model, config, child_ids=child_ids, temperature=temperature, device=device)
+        self._tracer = tracer if tracer is not None else Tracer(enabled=False)
+        self._lm = MCTSLanguageModel(model, config, child_ids=child_ids, temperature=temperature, device=device,
+                                     batcher=batcher, tracer=self._tracer)
         self._newline_id = self._tokenizer.token_to_id["\n"]
         self._tree_builder = tree_builder
+        self._is_async = isinstance(eval_function, AsyncMCTSEvaluator)
+        self._pending = []
+        self._tree = None
+        self._iter_num = 0
+        self._value_rollout_depth = value_rollout_depth
+        self._checker = RolloutChecker(tokenizer) if early_cutoff else None
+
+    def search(self, start: str, num_simulations: int, stepwise: bool = False, n_rollouts: int = 1,
+               checkpoint_path: str = None, checkpoint_interval: int = 0, resume: bool = False):
+        """
+        Performs the given number of simulations from the given prompt, and returns the state of the
+        most visited child of the root.
 
-    def search(self, start: str, num_simulations: int, stepwise: bool = False, n_rollouts: int = 1):
-        state = self._tokenizer.encode(self._tokenizer.tokenize_cif(start))
-        root_node = MCTSNode(state, self._lm, self._width, self._max_depth, self._newline_id,
-                             tree_builder=self._tree_builder)
-
-        if stepwise and len(root_node.untried_moves) == 1:
+        :param checkpoint_path: optional: the path of the file to which snapshots of the search are written
+        :param checkpoint_interval: if > 0, a snapshot is written after every this many simulations,
+                                    and after the last simulation
+        :param resume: if True, and a snapshot exists at `checkpoint_path`, the search continues from it
+        """
+        completed = 0
+        if resume and checkpoint_path is not None and os.path.exists(checkpoint_path):
+            tree, completed = self._load_checkpoint(checkpoint_path, start)
+            print(f"resuming search from {checkpoint_path} after {completed} simulations...")
+        else:
+            tree = self._new_tree(start)
+        root_node = tree.root
+
+        if stepwise and len(tree.untried_children(root_node.id)) == 1:
             child_state = root_node.untried_moves[0]
             print(f"returning {repr(self._tokenizer.decode([child_state[-1]]))} as it is the only child")
             return child_state
 
+        self._tree = tree
+        self._simulate(tree, num_simulations - completed, n_rollouts, first_iter_num=completed + 1,
+                       checkpoint_path=checkpoint_path, checkpoint_interval=checkpoint_interval)
+
+        # return the move that was most visited
+        return self._most_visited_child(tree).state
+
+    def start_stepwise(self, start: str) -> MCTSTree:
+        """
+        Begins a stepwise search from the given prompt. Each subsequent call to step() commits
+        one move, and the search continues from the subtree beneath it.
+
+        :param start: the prompt
+        :returns: the search tree
+        """
+        self._tree = self._new_tree(start)
+        self._iter_num = 0
+        return self._tree
+
+    def step(self, num_simulations: int, n_rollouts: int = 1) -> Union[List[int], None]:
+        """
+        Performs the given number of simulations from the current root, commits the most visited
+        move, and promotes the subtree of the chosen child to be the new root, so that the visits
+        and values gathered beneath it, and the children proposed by the language model, are kept
+        for the next decision. If the root has only one child, it is committed without simulating.
+
+        :param num_simulations: the number of simulations to perform
+        :param n_rollouts: the number of rollouts performed in each simulation
+        :returns: the token ids of the new root, or None if the root has no children and the
+                  stepwise search is over
+        """
+        if self._tree is None:
+            raise Exception("start_stepwise() must be called before step()")
+        tree = self._tree
+        root_node = tree.root
+        first, end = tree.child_range(root_node.id)
+
+        if end - first == 0:
+            return None
+
+        if end - first == 1:
+            child_node = MCTSNode(tree, first)
+            if not root_node.has_children():
+                child_node = root_node.add_child(child_node)
+            print(f"committing {repr(self._tokenizer.decode(child_node.state[-1:]))} as it is the only child")
+        else:
+            self._simulate(tree, num_simulations, n_rollouts, first_iter_num=self._iter_num + 1)
+            self._iter_num += num_simulations
+            child_node = self._most_visited_child(tree)
+
+        self._tree = tree.subtree(child_node.id)
+        print(f"committed move; the new root has {int(self._tree.root.visits)} visits")
+        return self._tree.root.state
+
+    @property
+    def tree(self) -> Union[MCTSTree, None]:
+        """
+        The tree of the current stepwise search, or of the last search, or None.
+        """
+        return self._tree
+
+    def root_child_statistics(self) -> List[Tuple[List[int], float, float]]:
+        """
+        Returns the state, visits and wins of each tried child of the root of the current tree,
+        in the order in which the children were tried.
+        """
+        if self._tree is None:
+            return []
+        return [(child.state, child.visits, child.wins) for child in self._tree.root.children]
+
+    def close(self):
+        """
+        Releases the resources held by the evaluator, if it holds any, once outstanding requests
+        have completed, and writes its buffered results.
+        """
+        if hasattr(self._eval_function, "close"):
+            self._eval_function.close()
+
+    def _new_tree(self, start: str) -> MCTSTree:
+        state = self._tokenizer.tokenize_to_ids(start).tolist()
+        return MCTSTree(state, self._lm, self._width, self._max_depth, self._newline_id,
+                        tree_builder=self._tree_builder)
+
+    @staticmethod
+    def _most_visited_child(tree: MCTSTree) -> MCTSNode:
+        return sorted(tree.root.children, key=lambda c: c.visits)[-1]
+
+    def _save_checkpoint(self, path: str, tree: MCTSTree, iter_num: int):
+        """
+        Writes a snapshot of the search after the given simulation. Outstanding rewards are awaited
+        first, so that the snapshot is consistent. The file is replaced atomically, so that a crash
+        while writing leaves the previous snapshot intact.
+        """
+        if self._is_async:
+            self._apply_pending(block=True)
+        if hasattr(self._eval_function, "flush"):
+            # the results written so far must match the evaluator's state in the snapshot
+            self._eval_function.flush()
+        snapshot = {
+            "iter_num": iter_num,
+            "tree": tree.state_dict(),
+            "evaluator": self._eval_function.state_dict() if hasattr(self._eval_function, "state_dict") else None,
+            "best_sequence": self._best_sequence,
+            "random_state": random.getstate(),
+            "numpy_random_state": np.random.get_state(),
+            "torch_random_state": torch.get_rng_state(),
+            "cuda_random_state": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        }
+        tmp_path = f"{path}.tmp"
+        torch.save(snapshot, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _load_checkpoint(self, path: str, start: str) -> Tuple[MCTSTree, int]:
+        """
+        Restores the search from a snapshot, and returns the tree together with the number of
+        simulations already performed.
+        """
+        snapshot = torch.load(path, weights_only=False)
+        tree = MCTSTree.from_state_dict(snapshot["tree"], self._lm, self._width, self._max_depth,
+                                        self._newline_id, tree_builder=self._tree_builder)
+        if tree.root.state != self._tokenizer.tokenize_to_ids(start).tolist():
+            raise Exception(f"the checkpoint at {path} is for a different prompt")
+        if snapshot["evaluator"] is not None:
+            self._eval_function.load_state_dict(snapshot["evaluator"])
+        self._best_sequence = snapshot["best_sequence"]
+        random.setstate(snapshot["random_state"])
+        np.random.set_state(snapshot["numpy_random_state"])
+        torch.set_rng_state(snapshot["torch_random_state"])
+        if snapshot["cuda_random_state"] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(snapshot["cuda_random_state"])
+        return tree, snapshot["iter_num"]
+
+    def _simulate(self, tree: MCTSTree, num_simulations: int, n_rollouts: int, first_iter_num: int,
+                  checkpoint_path: str = None, checkpoint_interval: int = 0):
+        root_node = tree.root
+        last_iter_num = first_iter_num + num_simulations - 1
+
         print(f"performing {num_simulations} simulations...")
 
         # Perform simulations
-        for iter_num in range(1, num_simulations+1):
+        for iter_num in range(first_iter_num, first_iter_num + num_simulations):
             print(f"performing simulation {iter_num}...")
             node = root_node
 
             # Select
-            while not node.has_untried_moves() and node.has_children():
-                node = self._node_selector.select_node(node.children)
+            with self._tracer.span("select"):
+                while not node.has_untried_moves() and node.has_children():
+                    node = MCTSNode(tree, self._node_selector.select_child(tree, node.id))
 
             # Expand
             if node.has_untried_moves():
-                move_state = node.select_untried_move()
-                node = node.add_child(move_state, self._lm, self._width, self._max_depth, self._newline_id)
+                with self._tracer.span("expand"):
+                    node = node.add_child(node.select_untried_move())
 
             # Rollout
-            rollout_scores = []
-            for _ in range(n_rollouts):
-                rollout_state = self._lm.rollout(node.state, self._width, self._max_depth, self._newline_id)
-                rollout_score = self._eval_function(rollout_state, iter_num)
-                self._store_best(rollout_state, rollout_score)
-                rollout_scores.append(rollout_score)
-            score = np.mean(rollout_scores)
+            node_state = node.state
+            if self._value_rollout_depth is not None:
+                score = self._estimate_value(node, n_rollouts, iter_num)
+            elif self._is_async:
+                rollout_rewards = []
+                for _ in range(n_rollouts):
+                    rollout_state = self._rollout(node_state, self._max_depth)
+                    if self._is_cut_off():
+                        rollout_rewards.append((rollout_state, PendingReward(reward=-1.0)))
+                    else:
+                        with self._tracer.span("evaluate"):
+                            pending = self._eval_function.submit(rollout_state, iter_num)
+                        rollout_rewards.append((rollout_state, pending))
+                score = self._provisional_score(node, rollout_rewards)
+            else:
+                rollout_states, rollout_scores = [], []
+                for _ in range(n_rollouts):
+                    rollout_states.append(self._rollout(node_state, self._max_depth))
+                    rollout_scores.append(-1.0 if self._is_cut_off() else None)
+                self._evaluate(rollout_states, rollout_scores, iter_num)
+                for rollout_state, rollout_score in zip(rollout_states, rollout_scores):
+                    self._store_best(rollout_state, rollout_score)
+                score = np.mean(rollout_scores)
 
             # Backpropagate from the expanded node and work back to the root node
+            with self._tracer.span("backprop"):
+                while node is not None:
+                    node.visits += 1
+                    node.wins += score
+                    node = node.parent
+
+            if self._is_async:
+                with self._tracer.span("apply_pending"):
+                    self._apply_pending(block=False)
+            self._tracer.count("simulations")
+
+            if checkpoint_path is not None and checkpoint_interval > 0 and \
+                    (iter_num % checkpoint_interval == 0 or iter_num == last_iter_num):
+                self._save_checkpoint(checkpoint_path, tree, iter_num)
+
+        if self._is_async:
+            with self._tracer.span("apply_pending"):
+                self._apply_pending(block=True)
+
+    def _rollout(self, node_state: List[int], max_depth: int) -> List[int]:
+        with self._tracer.span("rollout"):
+            rollout_state = self._lm.rollout(node_state, self._width, max_depth, self._newline_id,
+                                             checker=self._checker)
+        self._tracer.count("rollouts")
+        self._tracer.count("rollout_tokens", len(rollout_state) - len(node_state))
+        return rollout_state
+
+    def _evaluate(self, rollout_states: List[List[int]], rollout_scores: List[Union[float, None]], iter_num: int):
+        """
+        Fills in the missing scores of the given rollouts with the evaluator. The rollouts are evaluated
+        together if the evaluator supports it.
+        """
+        to_evaluate = [i for i, rollout_score in enumerate(rollout_scores) if rollout_score is None]
+        if len(to_evaluate) > 1 and hasattr(self._eval_function, "evaluate_batch"):
+            with self._tracer.span("evaluate"):
+                batch_scores = self._eval_function.evaluate_batch([rollout_states[i] for i in to_evaluate], iter_num)
+            for i, rollout_score in zip(to_evaluate, batch_scores):
+                rollout_scores[i] = rollout_score
+        else:
+            for i in to_evaluate:
+                with self._tracer.span("evaluate"):
+                    rollout_scores[i] = self._eval_function(rollout_states[i], iter_num)
+
+    def _estimate_value(self, node: MCTSNode, n_rollouts: int, iter_num: int) -> float:
+        """
+        Returns the mean value of the given node's state, estimated by the value head after truncated
+        rollouts. A rollout that completes the CIF is evaluated, and its reward used instead of the
+        estimate; with an asynchronous evaluator, it is not waited for, as in a full rollout.
+        """
+        rollout_rewards = []
+        for _ in range(n_rollouts if self._value_rollout_depth > 0 else 1):
+            rollout_state = node.state
+            if self._value_rollout_depth > 0:
+                rollout_state = self._rollout(node.state, self._value_rollout_depth)
+            if self._value_rollout_depth > 0 and self._is_cut_off():
+                rollout_rewards.append((rollout_state, PendingReward(reward=-1.0)))
+            elif MCTSNode.is_complete(rollout_state, self._newline_id):
+                with self._tracer.span("evaluate"):
+                    if self._is_async:
+                        pending = self._eval_function.submit(rollout_state, iter_num)
+                    else:
+                        pending = PendingReward(reward=self._eval_function(rollout_state, iter_num))
+                rollout_rewards.append((rollout_state, pending))
+            else:
+                with self._tracer.span("value_head"):
+                    value = self._lm.value(rollout_state)
+                # an estimate does not make its (incomplete) rollout a candidate for the best sequence
+                rollout_rewards.append((None, PendingReward(reward=value)))
+        return self._provisional_score(node, rollout_rewards)
+
+    def _is_cut_off(self) -> bool:
+        """
+        Returns True if the last rollout was stopped early, because the CIF was known to be invalid.
+        """
+        if self._checker is None or not self._checker.invalid:
+            return False
+        print(f"rollout stopped early: {self._checker.reason}")
+        self._tracer.count("rollouts_cut_off")
+        return True
+
+    def _provisional_score(self, node: MCTSNode, rollout_rewards: List[Tuple[List[int], PendingReward]]) -> float:
+        """
+        Returns the mean reward of the given rollouts, substituting the evaluator's provisional reward
+        for the rewards that are not yet available. If any reward is outstanding, the rollouts are
+        remembered, so that the value backpropagated from the node can be corrected later. A rollout
+        state of None marks an estimate of the value head, which is not a candidate for the best sequence.
+        """
+        if all(pending.done() for _, pending in rollout_rewards):
+            rewards = []
+            for rollout_state, pending in rollout_rewards:
+                reward = pending.result()
+                if rollout_state is not None:
+                    self._store_best(rollout_state, reward)
+                rewards.append(reward)
+            return np.mean(rewards)
+
+        provisional = self._eval_function.provisional_reward
+        self._pending.append((node, rollout_rewards, provisional))
+        return provisional
+
+    def _apply_pending(self, block: bool):
+        """
+        Replaces the provisional rewards backpropagated earlier with the actual rewards, for
+        every simulation whose rollouts have all been scored.
+
+        :param block: whether to wait for all outstanding rewards
+        """
+        still_pending = []
+        for node, rollout_rewards, provisional in self._pending:
+            if not block and not all(pending.done() for _, pending in rollout_rewards):
+                still_pending.append((node, rollout_rewards, provisional))
+                continue
+            rewards = []
+            for rollout_state, pending in rollout_rewards:
+                reward = pending.result()
+                if rollout_state is not None:
+                    self._store_best(rollout_state, reward)
+                rewards.append(reward)
+            correction = np.mean(rewards) - provisional
             while node is not None:
-                node.visits += 1
-                node.wins += score
+                node.wins += correction
                 node = node.parent
-
-        # return the move that was most visited
-        most_visited_node = sorted(root_node.children, key=lambda c: c.visits)[-1]
-        return most_visited_node.state
+        self._pending = still_pending
 
     def _store_best(self, rollout_state: List[int], score: float):
         current_best = self._best_sequence
@@ -497,3 +1791,132 @@ class MCTSSampler:
 
     def get_best_sequence(self) -> Tuple[List[int], float]:
         return self._best_sequence
+
+
+def _root_parallel_worker(worker_id, make_sampler, start, num_simulations, n_rollouts, seed, num_threads, results):
+    try:
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        torch.set_num_threads(num_threads)
+        sampler = make_sampler(worker_id)
+        sampler.search(start, num_simulations, n_rollouts=n_rollouts)
+        sampler.close()
+        results.put((worker_id, sampler.root_child_statistics(), sampler.get_best_sequence(), None))
+    except Exception:
+        results.put((worker_id, None, None, traceback.format_exc()))
+
+
+class RootParallelMCTSSampler:
+
+    def __init__(self, make_sampler: Callable[[int], MCTSSampler], n_workers: int, seed: int = 1337,
+                 threads_per_worker: int = 1, start_method: str = "fork"):
+        """
+        Runs independent searches from the same root in several processes, each with a different seed,
+        and merges the statistics of the children of the root once the searches are complete. Each worker
+        performs the full number of simulations, so the merged statistics reflect `n_workers` times as many
+        simulations in about the same wall-clock time.
+
+        Each worker builds its own sampler, by calling `make_sampler` with its worker id, so that
+        resources that cannot be shared between processes, such as scorer connections, are created in
+        the worker. The model should be placed in shared memory (with `model.share_memory()`) before the
+        search, so that the workers read the same copy of the weights. With the default "fork" start
+        method, `make_sampler` may be any callable; with "spawn" it must be picklable.
+
+        :param make_sampler: a callable that returns an MCTSSampler, given a worker id
+        :param n_workers: the number of worker processes
+        :param seed: the seed of the first worker; worker `i` uses `seed + i`
+        :param threads_per_worker: the number of threads used by PyTorch in each worker
+        :param start_method: the multiprocessing start method
+        """
+        if n_workers < 1:
+            raise ValueError(f"n_workers must be at least 1, got: {n_workers}")
+        self._make_sampler = make_sampler
+        self._n_workers = n_workers
+        self._seed = seed
+        self._threads_per_worker = threads_per_worker
+        self._start_method = start_method
+        self._root_statistics = []
+        self._best_sequence = None
+
+    def search(self, start: str, num_simulations: int, n_rollouts: int = 1) -> List[int]:
+        """
+        Performs `num_simulations` simulations in each worker, and returns the state of the child of the
+        root with the most visits across all workers.
+        """
+        context = torch.multiprocessing.get_context(self._start_method)
+        results = context.Queue()
+        workers = [
+            context.Process(target=_root_parallel_worker,
+                            args=(i, self._make_sampler, start, num_simulations, n_rollouts, self._seed + i,
+                                  self._threads_per_worker, results))
+            for i in range(self._n_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        # the results must be taken from the queue before joining, as a worker does not exit until its
+        #  result has been consumed
+        try:
+            worker_results = sorted(self._collect_results(workers, results), key=lambda r: r[0])
+        except BaseException:
+            for worker in workers:
+                worker.terminate()
+            raise
+        finally:
+            for worker in workers:
+                worker.join()
+
+        errors = [(worker_id, error) for worker_id, _, _, error in worker_results if error is not None]
+        if errors:
+            raise Exception(f"worker {errors[0][0]} failed:\n{errors[0][1]}")
+
+        self._root_statistics = self._merge([stats for _, stats, _, _ in worker_results])
+        for _, _, best_sequence, _ in worker_results:
+            if best_sequence is not None and (self._best_sequence is None or best_sequence[1] > self._best_sequence[1]):
+                self._best_sequence = best_sequence
+
+        # return the move that was most visited
+        return sorted(self._root_statistics, key=lambda c: c[1])[-1][0]
+
+    @staticmethod
+    def _collect_results(workers, results, poll_interval: float = 1.0):
+        # a worker that dies without raising a Python exception (e.g. if it crashes, or is killed when out
+        #  of memory) never posts a result, so the workers are checked whenever no result arrives for a while
+        worker_results = []
+        while len(worker_results) < len(workers):
+            try:
+                worker_results.append(results.get(timeout=poll_interval))
+                continue
+            except queue.Empty:
+                pass
+            reported = {worker_id for worker_id, _, _, _ in worker_results}
+            for worker_id, worker in enumerate(workers):
+                if worker_id not in reported and worker.exitcode is not None:
+                    try:
+                        # the result of a worker that has just exited may not have been read yet
+                        worker_results.append(results.get(timeout=poll_interval))
+                    except queue.Empty:
+                        raise Exception(f"worker {worker_id} exited with code {worker.exitcode} "
+                                        f"without posting a result")
+                    break
+        return worker_results
+
+    @staticmethod
+    def _merge(worker_statistics: List[List[Tuple[List[int], float, float]]]) -> List[Tuple[List[int], float, float]]:
+        merged = {}
+        for statistics in worker_statistics:
+            for state, visits, wins in statistics:
+                key = tuple(state)
+                _, total_visits, total_wins = merged.get(key, (state, 0., 0.))
+                merged[key] = (state, total_visits + visits, total_wins + wins)
+        return list(merged.values())
+
+    def root_child_statistics(self) -> List[Tuple[List[int], float, float]]:
+        """
+        Returns the state, and the visits and wins summed over the workers, of each child of the root
+        tried by any worker.
+        """
+        return self._root_statistics
+
+    def get_best_sequence(self) -> Tuple[List[int], float]:
+        return self._best_sequence
@@ -1,18 +1,98 @@
 import re
+import threading
+import warnings
+from functools import lru_cache
+from typing import Dict, Tuple, Union
 
+import numpy as np
 from pymatgen.analysis.local_env import CrystalNN
-from pymatgen.core import Composition, Structure
+from pymatgen.core import Composition, Element, Structure
 from pymatgen.io.cif import CifParser
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 
-from ._utils import extract_data_formula
-
-
-def bond_length_reasonableness_score(cif_str, tolerance=0.32, h_factor=2.5):
+from ._cache import CacheInfo, LRUCache, SQLiteStore
+from ._tokenizer import ATOMS
+from ._utils import extract_data_formula, get_canonical_structure_hash
+
+
+class CIFAnalysis:
+
+    def __init__(self, cif_str: str):
+        """
+        A CIF, parsed at most once, and only when needed. The parsed data, the structure and the
+        compositions are computed on first access and kept, so that any number of metrics can
+        be evaluated on the same CIF without parsing it again. Each metric function accepts either
+        a CIF string or a CIFAnalysis.
+
+        :param cif_str: the CIF
+        """
+        self._cif_str = cif_str
+        self._parser = None
+        self._data = None
+        self._structure = None
+        self._composition = None
+
+    @property
+    def cif_str(self) -> str:
+        return self._cif_str
+
+    @property
+    def parser(self) -> CifParser:
+        if self._parser is None:
+            self._parser = CifParser.from_string(self._cif_str)
+        return self._parser
+
+    @property
+    def data(self) -> dict:
+        """
+        The parsed CIF, as a dict of data blocks.
+        """
+        if self._data is None:
+            self._data = self.parser.as_dict()
+        return self._data
+
+    @property
+    def block(self) -> dict:
+        """
+        The first data block of the parsed CIF.
+        """
+        return self.data[list(self.data.keys())[0]]
+
+    @property
+    def structure(self) -> Structure:
+        if self._structure is None:
+            # equivalent to Structure.from_str(cif_str, fmt="cif"), without parsing the CIF again
+            self._structure = self.parser.get_structures(primitive=False)[0]
+        return self._structure
+
+    @property
+    def composition(self) -> Composition:
+        """
+        The composition given by the _chemical_formula_sum of the CIF.
+        """
+        if self._composition is None:
+            self._composition = Composition(self.block["_chemical_formula_sum"])
+        return self._composition
+
+
+def _as_analysis(cif: Union[str, CIFAnalysis]) -> CIFAnalysis:
+    return cif if isinstance(cif, CIFAnalysis) else CIFAnalysis(cif)
+
+
+def bond_length_reasonableness_score(cif: Union[str, CIFAnalysis], tolerance=0.32, h_factor=2.5, fast=False):
     """
     If a bond length is 30% shorter or longer than the sum of the atomic radii, the score is lower.
+
+    :param fast: if True, the bonds of each site are taken to be those to its nearest neighbours, found
+                 with a vectorized periodic neighbour search, instead of those found by CrystalNN, and
+                 the expected bond lengths are looked up in a precomputed table. The score is much
+                 faster to compute, and usually, but not always, equal to the CrystalNN score (see
+                 `bin/bond_length_parity.py`).
     """
-    structure = Structure.from_str(cif_str, fmt="cif")
+    structure = _as_analysis(cif).structure
+    if fast:
+        return _fast_bond_length_reasonableness_score(structure, tolerance, h_factor)
+
     crystal_nn = CrystalNN()
 
     min_ratio = 1 - tolerance
@@ -67,19 +147,161 @@ def bond_length_reasonableness_score(cif_str, tolerance=0.32, h_factor=2.5):
     return normalized_score
 
 
-def is_space_group_consistent(cif_str):
-    structure = Structure.from_str(cif_str, fmt="cif")
-    parser = CifParser.from_string(cif_str)
-    cif_data = parser.as_dict()
 
-    # Extract the stated space group from the CIF file
-    stated_space_group = cif_data[list(cif_data.keys())[0]]['_symmetry_space_group_name_H-M']
+@lru_cache(maxsize=None)
+def _element_pair_tables() -> Tuple[Dict[str, int], np.ndarray, np.ndarray]:
+    """
+    Returns the index of each of the elements known to the tokenizer, and, for each pair of elements,
+    the expected bond length and whether the bond involves hydrogen, computed from the same pymatgen
+    element data, and with the same rules, as `bond_length_reasonableness_score`. Missing data
+    results in an expected length of NaN.
+    """
+    with warnings.catch_warnings():
+        # pymatgen warns about the missing electronegativities of the noble gases
+        warnings.simplefilter("ignore")
+        elements = [Element(symbol) for symbol in ATOMS]
+        electronegativity = np.array([e.X for e in elements], dtype=float)
+        atomic_radius = np.array([np.nan if e.atomic_radius is None else float(e.atomic_radius)
+                                  for e in elements])
+        cationic_radius = np.array([float(e.average_cationic_radius) for e in elements])
+        anionic_radius = np.array([float(e.average_anionic_radius) for e in elements])
+
+    is_ionic = np.abs(electronegativity[:, None] - electronegativity[None, :]) >= 1.7
+    ionic_length = np.where(
+        electronegativity[:, None] < electronegativity[None, :],
+        cationic_radius[:, None] + anionic_radius[None, :],
+        anionic_radius[:, None] + cationic_radius[None, :],
+    )
+    covalent_length = atomic_radius[:, None] + atomic_radius[None, :]
+    expected_length = np.where(is_ionic, ionic_length, covalent_length)
+
+    is_hydrogen = np.array([symbol == "H" for symbol in ATOMS])
+    is_hydrogen_bond = is_hydrogen[:, None] | is_hydrogen[None, :]
+
+    return {symbol: i for i, symbol in enumerate(ATOMS)}, expected_length, is_hydrogen_bond
+
+
+def _fast_bond_length_reasonableness_score(structure: Structure, tolerance=0.32, h_factor=2.5,
+                                           shell_tolerance=0.1, max_radius=16.):
+    element_index, expected_length, is_hydrogen_bond = _element_pair_tables()
+    species = np.array([element_index[site.specie.symbol] for site in structure])
+    n_sites = len(structure)
+
+    present = np.unique(species)
+    expected_present = expected_length[np.ix_(present, present)]
+    if np.isnan(expected_present).any():
+        raise ValueError(f"no expected bond length for some of the elements in {structure.composition.formula}")
+
+    # find the neighbours of every site, widening the search until every site has one
+    radius = max(4., 1.5 * expected_present.max())
+    while True:
+        centers, neighbors, _, distances = structure.get_neighbor_list(radius)
+        if len(np.unique(centers)) == n_sites or radius >= max_radius:
+            break
+        radius *= 2
+
+    pairs = species[centers], species[neighbors]
+    bond_ratio = distances / expected_length[pairs]
+
+    # the bonds of a site are those to the neighbours in its nearest shell, with distances measured
+    #  relative to the expected bond lengths (as CrystalNN does with atomic radii), excluding its own images
+    nearest = np.full(n_sites, np.inf)
+    np.minimum.at(nearest, centers, bond_ratio)
+    bonded = (bond_ratio <= nearest[centers] * (1 + shell_tolerance)) & (centers != neighbors)
+
+    is_reasonable = np.where(
+        is_hydrogen_bond[pairs][bonded],
+        bond_ratio[bonded] < h_factor,
+        (1 - tolerance < bond_ratio[bonded]) & (bond_ratio[bonded] < 1 + tolerance),
+    )
+
+    return int(is_reasonable.sum()) / len(is_reasonable)
+
+
+class SpaceGroupDetector:
+
+    def __init__(self, maxsize: int = 10000, db_path: str = None, symprec: float = 0.1, decimal_places: int = 4):
+        """
+        Detects the space group of structures with `SpacegroupAnalyzer`, remembering the result for each
+        structure, so that a structure that recurs, even with different site order or rounding beyond
+        `decimal_places` (see `get_canonical_structure_hash`), is not analyzed again. Results are held in
+        memory, up to `maxsize` of the most recently used, and, if `db_path` is given, in an SQLite database
+        which persists across runs and may be shared by several processes. The detector is safe to use
+        from several threads. A detector sent to another process (e.g. by pickling) arrives with an empty
+        in-memory cache, and uses the same database.
+
+        :param maxsize: the maximum number of results held in memory
+        :param db_path: the path to an SQLite database file for persistent storage (optional)
+        :param symprec: the symmetry tolerance used by `SpacegroupAnalyzer`
+        :param decimal_places: the number of decimal places numbers are rounded to for hashing
+        """
+        self._symprec = symprec
+        self._decimal_places = decimal_places
+        self._db_path = db_path
+        self._memory = LRUCache(maxsize)
+        self._disk = SQLiteStore(db_path, "space_groups") if db_path else None
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def detect(self, structure: Structure) -> str:
+        """
+        Returns the space group symbol of the given structure.
+        """
+        # the tolerance is part of the key, so that detectors with different tolerances may share a database
+        key = f"{self._symprec}:{get_canonical_structure_hash(structure, self._decimal_places)}"
+        symbol = self._memory.get(key)
+        if symbol is not None:
+            with self._lock:
+                self._hits += 1
+            return symbol
+        if self._disk is not None:
+            symbol = self._disk.get(key)
+            if symbol is not None:
+                self._memory.put(key, symbol)
+                with self._lock:
+                    self._hits += 1
+                    self._disk_hits += 1
+                return symbol
+        with self._lock:
+            self._misses += 1
+
+        symbol = SpacegroupAnalyzer(structure, symprec=self._symprec).get_space_group_symbol()
+        self._memory.put(key, symbol)
+        if self._disk is not None:
+            self._disk.put(key, symbol)
+        return symbol
+
+    def cache_info(self) -> CacheInfo:
+        """
+        Returns the cache statistics: the number of hits (including those served from the SQLite
+        database), the number of hits served from the SQLite database, the number of misses, and the
+        maximum and current number of results held in memory.
+        """
+        with self._lock:
+            return CacheInfo(self._hits, self._disk_hits, self._misses, self._memory.maxsize, len(self._memory))
+
+    def close(self):
+        if self._disk is not None:
+            self._disk.close()
+
+    def __reduce__(self):
+        return SpaceGroupDetector, (self._memory.maxsize, self._db_path, self._symprec, self._decimal_places)
+
+
+def is_space_group_consistent(cif: Union[str, CIFAnalysis], space_group_detector: SpaceGroupDetector = None):
+    analysis = _as_analysis(cif)
 
-    # Analyze the symmetry of the structure
-    spacegroup_analyzer = SpacegroupAnalyzer(structure, symprec=0.1)
+    # Extract the stated space group from the CIF file
+    stated_space_group = analysis.block['_symmetry_space_group_name_H-M']
 
-    # Get the detected space group
-    detected_space_group = spacegroup_analyzer.get_space_group_symbol()
+    # Get the detected space group, remembered by the detector if one is given
+    if space_group_detector is not None:
+        detected_space_group = space_group_detector.detect(analysis.structure)
+    else:
+        spacegroup_analyzer = SpacegroupAnalyzer(analysis.structure, symprec=0.1)
+        detected_space_group = spacegroup_analyzer.get_space_group_symbol()
 
     # Check if the detected space group matches the stated space group
     is_match = stated_space_group.strip() == detected_space_group.strip()
@@ -87,27 +309,22 @@ def is_space_group_consistent(cif_str):
     return is_match
 
 
-def is_formula_consistent(cif_str):
-    parser = CifParser.from_string(cif_str)
-    cif_data = parser.as_dict()
+def is_formula_consistent(cif: Union[str, CIFAnalysis]):
+    analysis = _as_analysis(cif)
 
-    formula_data = Composition(extract_data_formula(cif_str))
-    formula_sum = Composition(cif_data[list(cif_data.keys())[0]]["_chemical_formula_sum"])
-    formula_structural = Composition(cif_data[list(cif_data.keys())[0]]["_chemical_formula_structural"])
+    formula_data = Composition(extract_data_formula(analysis.cif_str))
+    formula_sum = analysis.composition
+    formula_structural = Composition(analysis.block["_chemical_formula_structural"])
 
     return formula_data.reduced_formula == formula_sum.reduced_formula == formula_structural.reduced_formula
 
 
-def is_atom_site_multiplicity_consistent(cif_str):
-    # Parse the CIF string
-    parser = CifParser.from_string(cif_str)
-    cif_data = parser.as_dict()
-
-    # Extract the chemical formula sum from the CIF data
-    formula_sum = cif_data[list(cif_data.keys())[0]]["_chemical_formula_sum"]
+def is_atom_site_multiplicity_consistent(cif: Union[str, CIFAnalysis]):
+    analysis = _as_analysis(cif)
+    cif_data = analysis.data
 
-    # Convert the formula sum into a dictionary
-    expected_atoms = Composition(formula_sum).as_dict()
+    # Convert the chemical formula sum into a dictionary
+    expected_atoms = analysis.composition.as_dict()
 
     # Count the atoms provided in the _atom_site_type_symbol section
     actual_atoms = {}
@@ -124,7 +341,8 @@ def is_atom_site_multiplicity_consistent(cif_str):
     return expected_atoms == actual_atoms
 
 
-def is_sensible(cif_str, length_lo=0.5, length_hi=1000., angle_lo=10., angle_hi=170.):
+def is_sensible(cif: Union[str, CIFAnalysis], length_lo=0.5, length_hi=1000., angle_lo=10., angle_hi=170.):
+    cif_str = cif.cif_str if isinstance(cif, CIFAnalysis) else cif
     cell_length_pattern = re.compile(r"_cell_length_[abc]\s+([\d\.]+)")
     cell_angle_pattern = re.compile(r"_cell_angle_(alpha|beta|gamma)\s+([\d\.]+)")
 
@@ -143,15 +361,45 @@ def is_sensible(cif_str, length_lo=0.5, length_hi=1000., angle_lo=10., angle_hi=
     return True
 
 
-def is_valid(cif_str, bond_length_acceptability_cutoff=1.0):
-    if not is_formula_consistent(cif_str):
+def are_sensible(a, b, c, alpha_deg, beta_deg, gamma_deg, length_lo=0.5, length_hi=1000., angle_lo=10.,
+                 angle_hi=170.) -> np.ndarray:
+    """
+    The vectorized form of `is_sensible`, for the cell parameters of many CIFs at once, such as the columns
+    of a CIF table. As with `is_sensible`, a missing (NaN) parameter is not checked; unlike `is_sensible`,
+    only one value of each parameter (e.g. the first, in a CIF table) is checked.
+
+    :param a: an array of the a cell lengths
+    :param b: an array of the b cell lengths
+    :param c: an array of the c cell lengths
+    :param alpha_deg: an array of the alpha cell angles, in degrees
+    :param beta_deg: an array of the beta cell angles, in degrees
+    :param gamma_deg: an array of the gamma cell angles, in degrees
+    :param length_lo: the smallest cell length allowable
+    :param length_hi: the largest cell length allowable
+    :param angle_lo: the smallest cell angle allowable
+    :param angle_hi: the largest cell angle allowable
+    :returns: a boolean array, True for each sensible cell
+    """
+    sensible = np.ones(np.broadcast(a, b, c, alpha_deg, beta_deg, gamma_deg).shape, dtype=bool)
+    for values, lo, hi in ((a, length_lo, length_hi), (b, length_lo, length_hi), (c, length_lo, length_hi),
+                           (alpha_deg, angle_lo, angle_hi), (beta_deg, angle_lo, angle_hi),
+                           (gamma_deg, angle_lo, angle_hi)):
+        values = np.asarray(values, dtype=float)
+        # comparisons with NaN are False, so missing values pass
+        sensible &= ~((values < lo) | (values > hi))
+    return sensible
+
+
+def is_valid(cif: Union[str, CIFAnalysis], bond_length_acceptability_cutoff=1.0, fast_bond_length_score=False,
+             space_group_detector: SpaceGroupDetector = None):
+    analysis = _as_analysis(cif)
+    if not is_formula_consistent(analysis):
         return False
-    if not is_atom_site_multiplicity_consistent(cif_str):
+    if not is_atom_site_multiplicity_consistent(analysis):
         return False
-    bond_length_score = bond_length_reasonableness_score(cif_str)
+    bond_length_score = bond_length_reasonableness_score(analysis, fast=fast_bond_length_score)
     if bond_length_score < bond_length_acceptability_cutoff:
         return False
-    if not is_space_group_consistent(cif_str):
+    if not is_space_group_consistent(analysis, space_group_detector):
         return False
     return True
-
@@ -22,6 +22,7 @@ class GPTConfig:
     n_embd: int = 768
     dropout: float = 0.0
     bias: bool = True
+    value_head: bool = False  # whether the model has a head predicting the reward of a sequence
 
 
 class LayerNorm(nn.Module):
@@ -160,6 +161,12 @@ class GPT(nn.Module):
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
         # https://paperswithcode.com/method/weight-tying
         self.transformer.wte.weight = self.lm_head.weight
+        # an optional small MLP on the final hidden state, estimating the reward, in [-1, 1], of a sequence
+        self.value_head = nn.Sequential(
+            nn.Linear(config.n_embd, config.n_embd, bias=config.bias),
+            nn.GELU(),
+            nn.Linear(config.n_embd, 1, bias=config.bias),
+        ) if config.value_head else None
 
         self.apply(self._init_weights)
         # apply special scaled init to the residual projections, per GPT-2 paper
@@ -191,7 +198,7 @@ class GPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, idx, targets=None):
+    def _hidden_states(self, idx):
         device = idx.device
         b, t = idx.size()
         assert t <= self.config.block_size, f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
@@ -203,7 +210,10 @@ class GPT(nn.Module):
         x = self.transformer.drop(tok_emb + pos_emb)
         for block in self.transformer.h:
             x = block(x)
-        x = self.transformer.ln_f(x)
+        return self.transformer.ln_f(x)
+
+    def forward(self, idx, targets=None):
+        x = self._hidden_states(idx)
 
         if targets is not None:
             # if we are given some desired targets also calculate the loss
@@ -216,6 +226,42 @@ class GPT(nn.Module):
 
         return logits, loss
 
+    def forward_last(self, idx, lengths):
+        """
+        Returns the logits at the last position of each sequence in a batch of sequences of
+        different lengths. Each row of `idx` holds a sequence followed by arbitrary padding;
+        since attention is causal, the padding does not affect the positions before it.
+
+        :param idx: a (b, t) tensor of token ids
+        :param lengths: a (b,) tensor with the length of each sequence, excluding padding
+        :returns: a (b, vocab_size) tensor of logits
+        """
+        x = self._hidden_states(idx)
+        x = x[torch.arange(idx.size(0), device=idx.device), lengths - 1]
+        return self.lm_head(x)
+
+    def value(self, idx, lengths=None, frozen=False):
+        """
+        Returns the value head's estimate of the reward of each sequence in a batch. As with
+        `forward_last`, the sequences may be followed by padding.
+
+        :param idx: a (b, t) tensor of token ids
+        :param lengths: optional: a (b,) tensor with the length of each sequence, excluding padding;
+                        if not given, every sequence has length t
+        :param frozen: if True, the transformer is run without tracking gradients, so that only
+                       the value head is trained
+        :returns: a (b,) tensor of values in [-1, 1]
+        """
+        if self.value_head is None:
+            raise Exception("the model has no value head")
+        with torch.set_grad_enabled(torch.is_grad_enabled() and not frozen):
+            x = self._hidden_states(idx)
+        if lengths is None:
+            x = x[:, -1, :]
+        else:
+            x = x[torch.arange(idx.size(0), device=idx.device), lengths - 1]
+        return torch.tanh(self.value_head(x)).squeeze(-1)
+
     def crop_block_size(self, block_size: int):
         # model surgery to decrease the block size if necessary
         # e.g. we may load the GPT2 pretrained model checkpoint (block size 1024)
@@ -1,7 +1,17 @@
+import bisect
+import math
+import queue
 import random
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Tuple
 
 import zmq
 
+from ._cache import CacheInfo, LRUCache, SQLiteStore
+from ._utils import get_canonical_cif_hash
+
 
 class CIFScorer:
     """
@@ -17,6 +27,16 @@ class CIFScorer:
         """
         pass
 
+    def score_batch(self, cifs: List[str]) -> List[float]:
+        """
+        Returns a score for each of the CIFs. Scorers which can score several CIFs more
+        efficiently than one at a time should override this method.
+
+        :param cifs: the CIFs to be scored
+        :returns: a list of floats representing the scores, in the same order as the CIFs
+        """
+        return [self.score(cif) for cif in cifs]
+
 
 class RandomScorer(CIFScorer):
 
@@ -36,6 +56,12 @@ class RandomScorer(CIFScorer):
     def score(self, cif: str) -> float:
         return self._local_random.uniform(self._min_score, self._max_score)
 
+    def state_dict(self) -> dict:
+        return {"random_state": self._local_random.getstate()}
+
+    def load_state_dict(self, state: dict):
+        self._local_random.setstate(state["random_state"])
+
 
 class ZMQScorer(CIFScorer):
 
@@ -49,15 +75,26 @@ class ZMQScorer(CIFScorer):
         """
         print(f"ZeroMQ CIFScorer using host:port: {host}:{port}")
 
+        self._address = f"tcp://{host}:{port}"
+        self._timeout_ms = timeout_ms
+
         # prepare the ZeroMQ context and REQ socket
-        context = zmq.Context()
-        self._socket = context.socket(zmq.REQ)
+        self._context = zmq.Context()
+        self._socket = None
+        self._connect()
+
+    def _connect(self):
+        # a REQ socket that timed out waiting for a reply cannot send again,
+        #  so any existing socket is discarded and a fresh one is connected
+        if self._socket is not None:
+            self._socket.close(linger=0)
+        self._socket = self._context.socket(zmq.REQ)
 
         # set the socket timeout
-        self._socket.setsockopt(zmq.RCVTIMEO, timeout_ms)
-        self._socket.setsockopt(zmq.SNDTIMEO, timeout_ms)
+        self._socket.setsockopt(zmq.RCVTIMEO, self._timeout_ms)
+        self._socket.setsockopt(zmq.SNDTIMEO, self._timeout_ms)
 
-        self._socket.connect(f"tcp://{host}:{port}")
+        self._socket.connect(self._address)
 
     def score(self, cif: str) -> float:
         try:
@@ -69,4 +106,420 @@ class ZMQScorer(CIFScorer):
             return float(message)
 
         except zmq.Again as e:
+            self._connect()
             raise TimeoutError("ZeroMQ request timed out") from e
+
+
+class LatencyHistogram:
+
+    def __init__(self, bounds_ms: List[float] = None):
+        """
+        A histogram of request latencies, with buckets bounded by the given upper limits in
+        milliseconds. Latencies above the largest bound are counted in an overflow bucket.
+
+        :param bounds_ms: the ascending upper bounds of the buckets, in milliseconds (optional);
+                          by default, the bounds double from 1 ms to about 65 s
+        """
+        self._bounds_ms = list(bounds_ms) if bounds_ms is not None else [2.0**i for i in range(17)]
+        self._counts = [0] * (len(self._bounds_ms) + 1)
+        self._total_ms = 0.
+        self._max_ms = 0.
+        self._lock = threading.Lock()
+
+    def record(self, latency_s: float):
+        latency_ms = latency_s * 1000.
+        with self._lock:
+            self._counts[bisect.bisect_left(self._bounds_ms, latency_ms)] += 1
+            self._total_ms += latency_ms
+            self._max_ms = max(self._max_ms, latency_ms)
+
+    @property
+    def count(self) -> int:
+        return sum(self._counts)
+
+    @property
+    def mean_ms(self) -> float:
+        count = self.count
+        return self._total_ms / count if count > 0 else float("nan")
+
+    @property
+    def max_ms(self) -> float:
+        return self._max_ms
+
+    def buckets(self) -> List[Tuple[float, int]]:
+        """
+        Returns the (upper bound in ms, count) pairs of the histogram; the overflow bucket has
+        an upper bound of infinity.
+        """
+        with self._lock:
+            return list(zip(self._bounds_ms + [float("inf")], self._counts))
+
+    def percentile_ms(self, q: float) -> float:
+        """
+        Returns the upper bound of the bucket containing the q-th percentile latency.
+
+        :param q: the percentile, between 0 and 100
+        """
+        buckets = self.buckets()
+        count = sum(c for _, c in buckets)
+        if count == 0:
+            return float("nan")
+        threshold = q / 100. * count
+        seen = 0
+        for bound, c in buckets:
+            seen += c
+            if seen >= threshold and c > 0:
+                return bound
+        return buckets[-1][0]
+
+    def __str__(self):
+        lines = [f"n={self.count} mean={self.mean_ms:.1f}ms p50<={self.percentile_ms(50):g}ms "
+                 f"p99<={self.percentile_ms(99):g}ms max={self.max_ms:.1f}ms"]
+        lower = 0.
+        for bound, c in self.buckets():
+            if c > 0:
+                lines.append(f"  {lower:>8g} - {bound:<8g} ms: {c}")
+            lower = bound
+        return "\n".join(lines)
+
+
+class _PoolEndpoint:
+    def __init__(self, context: zmq.Context, address: str, timeout_ms: int):
+        self.address = address
+        self.histogram = LatencyHistogram()
+        self._context = context
+        self._timeout_ms = timeout_ms
+        self.socket = None
+        self.reset()
+
+    def reset(self):
+        # a REQ socket that timed out waiting for a reply cannot send again, so it is
+        #  discarded, without waiting for pending messages, and a fresh socket is connected
+        if self.socket is not None:
+            self.socket.close(linger=0)
+        self.socket = self._context.socket(zmq.REQ)
+        self.socket.setsockopt(zmq.SNDTIMEO, self._timeout_ms)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(f"tcp://{self.address}")
+
+
+class PooledZMQScorer(CIFScorer):
+
+    def __init__(self, endpoints: List[str], timeout_ms: int = 10000, batch_size: int = 16, retries: int = 2):
+        """
+        A CIF scorer which obtains scores from a pool of scorer processes via ZMQ, using one REQ socket
+        per endpoint. CIFs are sent in batches: a request is a multipart message with one CIF per frame,
+        and the reply is a multipart message with one score per frame, in the same order. The batches of
+        a call to `score_batch` are spread over the idle endpoints and sent concurrently. A batch that
+        times out is retried, up to `retries` times, after replacing the socket of the endpoint with a
+        fresh one. See `resources/alignn_zmq_batch_example.py` for a matching server.
+
+        The scorer may be used from several threads at once (e.g. by an AsyncScorer with one worker per
+        endpoint), as each endpoint is used by only one thread at a time.
+
+        :param endpoints: the "host:port" addresses of the scorer processes
+        :param timeout_ms: the time to wait for the reply to a batch, in milliseconds
+        :param batch_size: the maximum number of CIFs sent in a single request
+        :param retries: the number of times a batch that timed out is retried
+        """
+        if len(endpoints) == 0:
+            raise ValueError("at least one endpoint must be provided")
+        print(f"ZeroMQ CIFScorer using endpoints: {', '.join(endpoints)}")
+        self._timeout_ms = timeout_ms
+        self._batch_size = batch_size
+        self._retries = retries
+        self._context = zmq.Context()
+        self._endpoints = [_PoolEndpoint(self._context, address, timeout_ms) for address in endpoints]
+        self._idle = queue.Queue()
+        for endpoint in self._endpoints:
+            self._idle.put(endpoint)
+
+    def score(self, cif: str) -> float:
+        return self.score_batch([cif])[0]
+
+    def score_batch(self, cifs: List[str]) -> List[float]:
+        scores = [None] * len(cifs)
+        # (start index, CIFs, attempts made)
+        batches = [(i, cifs[i:i + self._batch_size], 0) for i in range(0, len(cifs), self._batch_size)]
+        in_flight = {}  # socket -> (endpoint, batch, time sent)
+        poller = zmq.Poller()
+
+        try:
+            while batches or in_flight:
+                # send batches to idle endpoints, waiting for one only if nothing is in flight
+                while batches:
+                    try:
+                        endpoint = self._idle.get(block=len(in_flight) == 0)
+                    except queue.Empty:
+                        break
+                    batch = batches.pop()
+                    try:
+                        endpoint.socket.send_multipart([cif.encode("utf-8") for cif in batch[1]])
+                    except zmq.Again:
+                        endpoint.reset()
+                        self._idle.put(endpoint)
+                        batches.append(self._retry(batch))
+                        continue
+                    in_flight[endpoint.socket] = (endpoint, batch, time.monotonic())
+                    poller.register(endpoint.socket, zmq.POLLIN)
+
+                ready = dict(poller.poll(timeout=self._poll_timeout_ms(in_flight)))
+                now = time.monotonic()
+                for socket, (endpoint, batch, sent) in list(in_flight.items()):
+                    if socket in ready:
+                        reply = socket.recv_multipart()
+                        endpoint.histogram.record(now - sent)
+                        poller.unregister(socket)
+                        del in_flight[socket]
+                        self._idle.put(endpoint)
+                        start, batch_cifs, _ = batch
+                        if len(reply) != len(batch_cifs):
+                            raise Exception(f"expected {len(batch_cifs)} scores from {endpoint.address}, "
+                                            f"got {len(reply)}")
+                        for j, frame in enumerate(reply):
+                            scores[start + j] = float(frame.decode("utf-8"))
+                    elif (now - sent) * 1000. >= self._timeout_ms:
+                        print(f"ZeroMQ request to {endpoint.address} timed out; retrying on a fresh socket")
+                        poller.unregister(socket)
+                        del in_flight[socket]
+                        endpoint.reset()
+                        self._idle.put(endpoint)
+                        batches.append(self._retry(batch))
+        finally:
+            # a socket awaiting a reply cannot be reused, e.g. if an exception interrupted the loop
+            for socket, (endpoint, _, _) in in_flight.items():
+                endpoint.reset()
+                self._idle.put(endpoint)
+
+        return scores
+
+    def _retry(self, batch):
+        start, batch_cifs, attempts = batch
+        if attempts >= self._retries:
+            raise TimeoutError(f"ZeroMQ request timed out after {attempts + 1} attempts")
+        return start, batch_cifs, attempts + 1
+
+    def _poll_timeout_ms(self, in_flight) -> int:
+        if not in_flight:
+            return 0
+        oldest = min(sent for _, _, sent in in_flight.values())
+        remaining_ms = self._timeout_ms - (time.monotonic() - oldest) * 1000.
+        return max(0, int(math.ceil(remaining_ms)))
+
+    def latency_histograms(self) -> Dict[str, LatencyHistogram]:
+        """
+        Returns the histogram of request latencies for each endpoint.
+        """
+        return {endpoint.address: endpoint.histogram for endpoint in self._endpoints}
+
+    @property
+    def num_endpoints(self) -> int:
+        return len(self._endpoints)
+
+
+class CachingScorer(CIFScorer):
+
+    def __init__(self, scorer: CIFScorer, maxsize: int = 10000, db_path: str = None, decimal_places: int = 4):
+        """
+        A CIF scorer which remembers the scores returned by another scorer, so that a structure
+        that has been scored before is not sent to the scorer again. CIFs are identified by a
+        canonical hash of the structure they describe (see `get_canonical_cif_hash`), so CIFs which
+        differ only in formatting, site labels, site order, or digits beyond `decimal_places`, share
+        a score. Scores are held in memory, up to `maxsize` of the most recently used, and, if
+        `db_path` is given, in an SQLite database which persists across runs and may be shared by
+        several processes. NaN scores, which indicate a failure of the scorer, are not cached.
+
+        :param scorer: the scorer providing the scores that are not in the cache
+        :param maxsize: the maximum number of scores held in memory
+        :param db_path: the path to an SQLite database file for persistent storage (optional)
+        :param decimal_places: the number of decimal places numbers are rounded to for hashing
+        """
+        self._scorer = scorer
+        self._decimal_places = decimal_places
+        self._memory = LRUCache(maxsize)
+        self._disk = SQLiteStore(db_path, "scores") if db_path else None
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def scorer(self) -> CIFScorer:
+        return self._scorer
+
+    def score(self, cif: str) -> float:
+        return self.score_batch([cif])[0]
+
+    def score_batch(self, cifs: List[str]) -> List[float]:
+        keys = [get_canonical_cif_hash(cif, self._decimal_places) for cif in cifs]
+        scores = [self._lookup(key) for key in keys]
+
+        # score each missing structure once, even if it occurs several times in the batch
+        missing = {}
+        for cif, key, score in zip(cifs, keys, scores):
+            if score is None and key not in missing:
+                missing[key] = cif
+        if missing:
+            new_scores = dict(zip(missing, self._scorer.score_batch(list(missing.values()))))
+            for key, score in new_scores.items():
+                if not math.isnan(score):
+                    self._memory.put(key, score)
+                    if self._disk is not None:
+                        self._disk.put(key, score)
+            scores = [new_scores[key] if score is None else score for key, score in zip(keys, scores)]
+
+        return scores
+
+    def _lookup(self, key):
+        score = self._memory.get(key)
+        if score is not None:
+            with self._lock:
+                self._hits += 1
+            return score
+        if self._disk is not None:
+            score = self._disk.get(key)
+            if score is not None:
+                self._memory.put(key, score)
+                with self._lock:
+                    self._hits += 1
+                    self._disk_hits += 1
+                return score
+        with self._lock:
+            self._misses += 1
+        return None
+
+    def cache_info(self) -> CacheInfo:
+        """
+        Returns the cache statistics: the number of hits (including those served from the SQLite
+        database), the number of hits served from the SQLite database, the number of misses, and the
+        maximum and current number of scores held in memory.
+        """
+        with self._lock:
+            return CacheInfo(self._hits, self._disk_hits, self._misses, self._memory.maxsize, len(self._memory))
+
+    @property
+    def hit_rate(self) -> float:
+        info = self.cache_info()
+        total = info.hits + info.misses
+        return info.hits / total if total > 0 else float("nan")
+
+    def close(self):
+        if self._disk is not None:
+            self._disk.close()
+
+
+class AsyncScorer(CIFScorer):
+
+    def __init__(self, scorer: CIFScorer, max_in_flight: int = 8, workers: int = 1, batch_size: int = 1):
+        """
+        Wraps a CIFScorer so that CIFs can be submitted for scoring without blocking the caller.
+        At most `max_in_flight` requests may be outstanding at any time; a submission made while
+        the limit is reached blocks until an earlier request completes. The wrapped scorer is
+        invoked from `workers` background threads. Scorers that are not thread-safe (such as the
+        ZMQScorer, whose REQ socket must not be shared between threads) must use a single worker.
+        When `batch_size` is greater than 1, a worker takes up to that many queued requests at a
+        time, and scores them with a single call to the scorer's `score_batch`. An AsyncScorer is
+        itself a thread-safe CIFScorer, so several searches can route their requests through one.
+
+        :param scorer: the CIFScorer to wrap
+        :param max_in_flight: the maximum number of requests that may be outstanding
+        :param workers: the number of background threads invoking the scorer
+        :param batch_size: the maximum number of queued requests scored together
+        """
+        if max_in_flight < 1:
+            raise ValueError(f"max_in_flight must be at least 1, got: {max_in_flight}")
+        if workers < 1:
+            raise ValueError(f"workers must be at least 1, got: {workers}")
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be at least 1, got: {batch_size}")
+        self._scorer = scorer
+        self._batch_size = batch_size
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._requests = queue.Queue()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def scorer(self) -> CIFScorer:
+        return self._scorer
+
+    @property
+    def in_flight(self) -> int:
+        """
+        The number of requests that have been submitted but have not yet completed.
+        """
+        with self._lock:
+            return self._in_flight
+
+    def submit(self, cif: str) -> Future:
+        """
+        Submits a CIF for scoring, blocking only if `max_in_flight` requests are already outstanding.
+
+        :param cif: the CIF to be scored
+        :returns: a Future which will hold the score, or the exception raised by the scorer
+        """
+        self._slots.acquire()
+        with self._lock:
+            self._in_flight += 1
+        future = Future()
+        self._requests.put((cif, future))
+        return future
+
+    def score(self, cif: str) -> float:
+        return self.submit(cif).result()
+
+    def score_batch(self, cifs: List[str]) -> List[float]:
+        futures = [self.submit(cif) for cif in cifs]
+        return [future.result() for future in futures]
+
+    def close(self):
+        """
+        Stops the background threads once all outstanding requests have completed.
+        """
+        for _ in self._threads:
+            self._requests.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        stop = False
+        while not stop:
+            request = self._requests.get()
+            if request is None:
+                break
+            requests = [request]
+            while len(requests) < self._batch_size:
+                try:
+                    request = self._requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                requests.append(request)
+            try:
+                self._score(requests)
+            finally:
+                with self._lock:
+                    self._in_flight -= len(requests)
+                for _ in requests:
+                    self._slots.release()
+
+    def _score(self, requests):
+        requests = [(cif, future) for cif, future in requests if future.set_running_or_notify_cancel()]
+        if len(requests) == 0:
+            return
+        try:
+            if len(requests) == 1:
+                scores = [self._scorer.score(requests[0][0])]
+            else:
+                scores = self._scorer.score_batch([cif for cif, _ in requests])
+        except Exception as e:
+            for _, future in requests:
+                future.set_exception(e)
+            return
+        for (_, future), score in zip(requests, scores):
+            future.set_result(score)
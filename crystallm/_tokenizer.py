@@ -1,5 +1,9 @@
 import os
 import re
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+import numpy as np
 
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -55,9 +59,88 @@ EXTENDED_KEYWORDS = [
 
 UNK_TOKEN = "<unk>"
 
+# the patterns used by `CIFTokenizer.tokenize_cif`, compiled once per process
+_SPACE_GROUP_PATTERN = re.compile(fr'(_symmetry_space_group_name_H-M *\b({"|".join(SPACE_GROUPS)}))\n')
+_SPACES_PATTERN = re.compile(r'[ \t]+')
+
+
+@lru_cache(maxsize=None)
+def _compile_token_pattern(escaped_tokens: Tuple[str, ...]) -> re.Pattern:
+    # Create a regex pattern by joining the escaped tokens with '|'
+    token_pattern = '|'.join(escaped_tokens)
+
+    # Add a regex pattern to match any sequence of characters separated by whitespace or punctuation
+    return re.compile(f'({token_pattern}|\\w+|[\\.,;!?])')
+
+
+# the key under which a node of a token trie stores the token that ends at it; no character is the empty string
+_TRIE_TOKEN = ""
+_WORD_PATTERN = re.compile(r'\w+')
+_PUNCTUATION = frozenset(".,;!?")
+
+
+@lru_cache(maxsize=None)
+def _build_token_trie(tokens: Tuple[str, ...]) -> Dict:
+    # a trie of the characters of the tokens, as nested dicts
+    trie = {}
+    for token in tokens:
+        node = trie
+        for ch in token:
+            node = node.setdefault(ch, {})
+        node[_TRIE_TOKEN] = token
+    return trie
+
+
+def _find_tokens_in_trie(trie: Dict, cif_string: str) -> List[str]:
+    """
+    Splits a string into tokens in a single pass, finding the longest token of the trie at each position;
+    where no token starts, a run of word characters, or a punctuation character, is taken instead, and
+    any other character is skipped. The tokens are the same as those found by the pattern of
+    `_compile_token_pattern`, since its alternatives are tried longest first.
+    """
+    tokens = []
+    append = tokens.append
+    word_match = _WORD_PATTERN.match
+    i = 0
+    n = len(cif_string)
+    while i < n:
+        node = trie.get(cif_string[i])
+        if node is not None:
+            token = node.get(_TRIE_TOKEN)
+            end = j = i + 1
+            while j < n:
+                node = node.get(cif_string[j])
+                if node is None:
+                    break
+                j += 1
+                if _TRIE_TOKEN in node:
+                    token = node[_TRIE_TOKEN]
+                    end = j
+            if token is not None:
+                append(token)
+                i = end
+                continue
+        match = word_match(cif_string, i)
+        if match is not None:
+            append(match.group())
+            i = match.end()
+        else:
+            if cif_string[i] in _PUNCTUATION:
+                append(cif_string[i])
+            i += 1
+    return tokens
+
 
 class CIFTokenizer:
-    def __init__(self):
+    def __init__(self, engine="regex"):
+        """
+        :param engine: how a CIF is split into tokens: "regex", with an alternation of the tokens, or
+                       "trie", with a single longest-match pass over a trie of the tokens, which is faster;
+                       both give the same tokens
+        """
+        if engine not in ("regex", "trie"):
+            raise ValueError(f"unknown engine: {engine}")
+        self._engine = engine
         self._tokens = list(self.atoms())
         self._tokens.extend(self.digits())
         self._tokens.extend(self.keywords())
@@ -71,12 +154,16 @@ class CIFTokenizer:
 
         self._escaped_tokens = [re.escape(token) for token in self._tokens]
         self._escaped_tokens.sort(key=len, reverse=True)
+        self._token_pattern = _compile_token_pattern(tuple(self._escaped_tokens)) if engine == "regex" else None
+        self._token_trie = _build_token_trie(tuple(self._tokens)) if engine == "trie" else None
+        self._token_set = frozenset(self._tokens)
 
         self._tokens_with_unk = list(self._tokens)
         self._tokens_with_unk.append(UNK_TOKEN)
 
         # a mapping from characters to integers
         self._token_to_id = {ch: i for i, ch in enumerate(self._tokens_with_unk)}
+        self._unk_id = self._token_to_id[UNK_TOKEN]
         self._id_to_token = {i: ch for i, ch in enumerate(self._tokens_with_unk)}
         # map the id of 'Pm_sg' back to 'Pm', or 'P1_sg' to 'P1',
         #  for decoding convenience
@@ -122,24 +209,37 @@ class CIFTokenizer:
         return ''.join([self._id_to_token[i] for i in ids])
 
     def tokenize_cif(self, cif_string, single_spaces=True):
+        tokens = self._find_tokens(cif_string, single_spaces)
+
+        # Replace unrecognized tokens with the unknown_token
+        token_set = self._token_set
+        tokens = [token if token in token_set else UNK_TOKEN for token in tokens]
+
+        return tokens
+
+    def tokenize_to_ids(self, cif_string, single_spaces=True) -> np.ndarray:
+        """
+        Tokenizes and encodes a CIF at once; the same as `encode(tokenize_cif(cif_string, single_spaces))`,
+        but without making the intermediate list of tokens.
+
+        :param cif_string: the CIF
+        :param single_spaces: whether runs of spaces and tabs are replaced by a single space
+        :returns: a uint16 array of the ids of the tokens of the CIF
+        """
+        tokens = self._find_tokens(cif_string, single_spaces)
+        get_id = self._token_to_id.get
+        unk_id = self._unk_id
+        return np.fromiter((get_id(token, unk_id) for token in tokens), dtype=np.uint16, count=len(tokens))
+
+    def _find_tokens(self, cif_string, single_spaces):
         # Preprocessing step to replace '_symmetry_space_group_name_H-M Pm'
         #  with '_symmetry_space_group_name_H-M Pm_sg',to disambiguate from atom 'Pm',
         #  or any space group symbol to avoid problematic cases, like 'P1'
-        spacegroups = "|".join(SPACE_GROUPS)
-        cif_string = re.sub(fr'(_symmetry_space_group_name_H-M *\b({spacegroups}))\n', r'\1_sg\n', cif_string)
-
-        # Create a regex pattern by joining the escaped tokens with '|'
-        token_pattern = '|'.join(self._escaped_tokens)
-
-        # Add a regex pattern to match any sequence of characters separated by whitespace or punctuation
-        full_pattern = f'({token_pattern}|\\w+|[\\.,;!?])'
+        cif_string = _SPACE_GROUP_PATTERN.sub(r'\1_sg\n', cif_string)
 
         # Tokenize the input string using the regex pattern
         if single_spaces:
-            cif_string = re.sub(r'[ \t]+', ' ', cif_string)
-        tokens = re.findall(full_pattern, cif_string)
-
-        # Replace unrecognized tokens with the unknown_token
-        tokens = [token if token in self._tokens else UNK_TOKEN for token in tokens]
-
-        return tokens
+            cif_string = _SPACES_PATTERN.sub(' ', cif_string)
+        if self._token_trie is not None:
+            return _find_tokens_in_trie(self._token_trie, cif_string)
+        return self._token_pattern.findall(cif_string)
@@ -0,0 +1,147 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List
+
+
+class PhaseStats:
+    def __init__(self):
+        self.count = 0
+        self.total_s = 0.
+        self.max_s = 0.
+
+    def add(self, duration_s: float):
+        self.count += 1
+        self.total_s += duration_s
+        self.max_s = max(self.max_s, duration_s)
+
+    @property
+    def mean_s(self) -> float:
+        return self.total_s / self.count if self.count > 0 else 0.
+
+
+class Tracer:
+
+    def __init__(self, enabled: bool = True, trace_path: str = None, keep_events: bool = False):
+        """
+        Collects the time spent in each named phase of a computation, and named counts, from any
+        number of threads. Each timed phase may also be written as a line of JSON to a trace file,
+        and kept in memory for export in the Chrome trace event format (viewable in chrome://tracing
+        or Perfetto). A disabled tracer records nothing, at almost no cost.
+
+        :param enabled: whether anything is recorded
+        :param trace_path: optional: the path of a JSONL file to which each timed phase is appended
+        :param keep_events: whether the timed phases are kept in memory, for `write_chrome_trace`
+        """
+        self._enabled = enabled
+        self._keep_events = keep_events
+        self._lock = threading.Lock()
+        self._phases: Dict[str, PhaseStats] = {}
+        self._counts: Dict[str, int] = {}
+        self._events: List[tuple] = []
+        self._start = time.perf_counter()
+        self._trace_file = open(trace_path, "wt") if enabled and trace_path else None
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled
+
+    def span(self, name: str):
+        """
+        Returns a context manager that records the time spent within it under the given name.
+        """
+        if not self._enabled:
+            return nullcontext()
+        return self._span(name)
+
+    @contextmanager
+    def _span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, start=start)
+
+    def record(self, name: str, duration_s: float, start: float = None):
+        """
+        Records a phase of the given duration, such as a latency measured elsewhere.
+
+        :param name: the name of the phase
+        :param duration_s: the duration, in seconds
+        :param start: optional: the `time.perf_counter()` value at the start of the phase
+        """
+        if not self._enabled:
+            return
+        if start is None:
+            start = time.perf_counter() - duration_s
+        thread_id = threading.get_ident()
+        with self._lock:
+            self._phases.setdefault(name, PhaseStats()).add(duration_s)
+            if self._keep_events:
+                self._events.append((name, start, duration_s, thread_id))
+            if self._trace_file is not None:
+                self._trace_file.write(json.dumps({
+                    "name": name,
+                    "start_s": round(start - self._start, 6),
+                    "duration_s": round(duration_s, 6),
+                    "thread": thread_id,
+                }) + "\n")
+
+    def count(self, name: str, n: int = 1):
+        """
+        Adds `n` to the count with the given name.
+        """
+        if not self._enabled:
+            return
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + n
+
+    def phases(self) -> Dict[str, PhaseStats]:
+        with self._lock:
+            return dict(self._phases)
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+    def summary(self) -> str:
+        """
+        Returns a table of the number of times each phase was entered, and the time spent in it,
+        followed by the counts. The share is relative to the time elapsed since the tracer was created;
+        since phases may be nested, or run in parallel, the shares need not add up to 100%.
+        """
+        elapsed_s = time.perf_counter() - self._start
+        phases = self.phases()
+        width = max([len(name) for name in list(phases) + list(self._counts)] + [5])
+        lines = [f"{'phase':<{width}}  {'count':>9}  {'total (s)':>10}  {'mean (ms)':>10}  {'max (ms)':>10}  {'share':>6}"]
+        for name, stats in sorted(phases.items(), key=lambda item: -item[1].total_s):
+            lines.append(f"{name:<{width}}  {stats.count:>9}  {stats.total_s:>10.3f}  {stats.mean_s * 1000:>10.3f}  "
+                         f"{stats.max_s * 1000:>10.3f}  {stats.total_s / elapsed_s:>6.1%}")
+        for name, n in sorted(self.counts().items()):
+            lines.append(f"{name:<{width}}  {n:>9}")
+        lines.append(f"elapsed: {elapsed_s:.3f}s")
+        return "\n".join(lines)
+
+    def write_chrome_trace(self, path: str):
+        """
+        Writes the timed phases kept in memory in the Chrome trace event format.
+        """
+        with self._lock:
+            events = [{
+                "name": name,
+                "ph": "X",
+                "ts": (start - self._start) * 1e6,
+                "dur": duration_s * 1e6,
+                "pid": os.getpid(),
+                "tid": thread_id,
+            } for name, start, duration_s, thread_id in self._events]
+        with open(path, "wt") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def close(self):
+        with self._lock:
+            if self._trace_file is not None:
+                self._trace_file.close()
+                self._trace_file = None
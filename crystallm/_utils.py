@@ -1,12 +1,20 @@
+import hashlib
 import math
 import re
+import warnings
+from functools import lru_cache
+from typing import Dict, Tuple, Union
+
+import numpy as np
 import pandas as pd
 
-from pymatgen.core import Composition
+from pymatgen.core import Composition, Element
 from pymatgen.io.cif import CifBlock
 from pymatgen.symmetry.groups import SpaceGroup
 from pymatgen.core.operations import SymmOp
 
+from ._tokenizer import ATOMS
+
 
 def get_unit_cell_volume(a, b, c, alpha_deg, beta_deg, gamma_deg):
     alpha_rad = math.radians(alpha_deg)
@@ -19,70 +27,165 @@ def get_unit_cell_volume(a, b, c, alpha_deg, beta_deg, gamma_deg):
     return volume
 
 
+def _cell_volume_factor(alpha_deg, beta_deg, gamma_deg):
+    # the square of the volume of a cell with unit lengths and the given angles; not positive for a degenerate cell
+    cos_alpha = np.cos(np.radians(alpha_deg))
+    cos_beta = np.cos(np.radians(beta_deg))
+    cos_gamma = np.cos(np.radians(gamma_deg))
+    return 1 - cos_alpha ** 2 - cos_beta ** 2 - cos_gamma ** 2 + 2 * cos_alpha * cos_beta * cos_gamma
+
+
+def get_unit_cell_volumes(a, b, c, alpha_deg, beta_deg, gamma_deg) -> np.ndarray:
+    """
+    The vectorized form of `get_unit_cell_volume`, for the cell parameters of many CIFs at once.
+
+    :param a: an array of the a cell lengths
+    :param b: an array of the b cell lengths
+    :param c: an array of the c cell lengths
+    :param alpha_deg: an array of the alpha cell angles, in degrees
+    :param beta_deg: an array of the beta cell angles, in degrees
+    :param gamma_deg: an array of the gamma cell angles, in degrees
+    :returns: an array of the volumes; NaN where the angles do not form a cell (for which
+              `get_unit_cell_volume` raises a ValueError) or a parameter is NaN
+    """
+    factor = _cell_volume_factor(alpha_deg, beta_deg, gamma_deg)
+    with np.errstate(invalid="ignore"):
+        return np.asarray(a, dtype=float) * b * c * np.sqrt(factor)
+
+
+def are_cells_degenerate(a, b, c, alpha_deg, beta_deg, gamma_deg, tol=1e-6) -> np.ndarray:
+    """
+    Flags the cells that do not enclose a volume: those with a length that is not positive, or with angles
+    for which the cell vectors are (nearly) coplanar, as well as those with a missing (NaN) parameter.
+
+    :param a: an array of the a cell lengths
+    :param b: an array of the b cell lengths
+    :param c: an array of the c cell lengths
+    :param alpha_deg: an array of the alpha cell angles, in degrees
+    :param beta_deg: an array of the beta cell angles, in degrees
+    :param gamma_deg: an array of the gamma cell angles, in degrees
+    :param tol: the smallest volume of the cell with unit lengths and the given angles that is not degenerate
+    :returns: a boolean array, True for each degenerate cell
+    """
+    factor = _cell_volume_factor(alpha_deg, beta_deg, gamma_deg)
+    with np.errstate(invalid="ignore"):
+        enclosing = (np.asarray(a) > 0) & (np.asarray(b) > 0) & (np.asarray(c) > 0) & (factor > tol ** 2)
+    return ~enclosing
+
+
+def get_volumes_per_formula_unit(volumes, formula_units) -> np.ndarray:
+    """
+    Returns the volume per formula unit of many CIFs at once. As in `bin/deduplicate.py`, a Z of 0, which is
+    erroneous, is treated as 1.
+
+    :param volumes: an array of the cell volumes
+    :param formula_units: an array of the formula units (Z); a negative value (such as the missing value of
+                          the "formula_units" column of a CIF table) gives a NaN volume per formula unit
+    :returns: an array of the volumes per formula unit
+    """
+    formula_units = np.asarray(formula_units)
+    divisors = np.where(formula_units == 0, 1, formula_units).astype(float)
+    divisors[divisors < 0] = np.nan
+    return np.asarray(volumes, dtype=float) / divisors
+
+
 def get_atomic_props_block_for_formula(formula, oxi=False):
     comp = Composition(formula)
     return get_atomic_props_block(comp, oxi)
 
 
-def get_atomic_props_block(composition, oxi=False):
-    noble_vdw_radii = {
-        "He": 1.40,
-        "Ne": 1.54,
-        "Ar": 1.88,
-        "Kr": 2.02,
-        "Xe": 2.16,
-        "Rn": 2.20,
-    }
+_NOBLE_VDW_RADII = {
+    "He": 1.40,
+    "Ne": 1.54,
+    "Ar": 1.88,
+    "Kr": 2.02,
+    "Xe": 2.16,
+    "Rn": 2.20,
+}
 
-    allen_electronegativity = {
-        "He": 4.16,
-        "Ne": 4.79,
-        "Ar": 3.24,
-    }
+_ALLEN_ELECTRONEGATIVITY = {
+    "He": 4.16,
+    "Ne": 4.79,
+    "Ar": 3.24,
+}
 
-    def _format(val):
-        return f"{float(val): .4f}"
+_ATOM_TYPE_LOOP = "loop_\n _atom_type_symbol\n _atom_type_electronegativity\n _atom_type_radius\n _atom_type_ionic_radius"
+_ATOM_TYPE_LOOP_OXI = _ATOM_TYPE_LOOP + "\n _atom_type_oxidation_number"
 
-    def _format_X(elem):
-        if math.isnan(elem.X) and str(elem) in allen_electronegativity:
-            return allen_electronegativity[str(elem)]
-        return _format(elem.X)
 
-    def _format_radius(elem):
-        if elem.atomic_radius is None and str(elem) in noble_vdw_radii:
-            return noble_vdw_radii[str(elem)]
-        return _format(elem.atomic_radius)
+def _format_atomic_prop(val):
+    # as written in a CIF loop, without the leading space
+    return f"{float(val): .4f}".strip()
 
-    props = {str(el): (_format_X(el), _format_radius(el), _format(el.average_ionic_radius))
-             for el in sorted(composition.elements)}
 
-    data = {}
-    data["_atom_type_symbol"] = list(props)
-    data["_atom_type_electronegativity"] = [v[0] for v in props.values()]
-    data["_atom_type_radius"] = [v[1] for v in props.values()]
+def _get_element_props(elem) -> Tuple[str, str, str]:
+    if math.isnan(elem.X) and str(elem) in _ALLEN_ELECTRONEGATIVITY:
+        electronegativity = str(_ALLEN_ELECTRONEGATIVITY[str(elem)])
+    else:
+        electronegativity = _format_atomic_prop(elem.X)
+    if elem.atomic_radius is None and str(elem) in _NOBLE_VDW_RADII:
+        radius = str(_NOBLE_VDW_RADII[str(elem)])
+    else:
+        radius = _format_atomic_prop(elem.atomic_radius)
     # use the average ionic radius
-    data["_atom_type_ionic_radius"] = [v[2] for v in props.values()]
-
-    loop_vals = [
-        "_atom_type_symbol",
-        "_atom_type_electronegativity",
-        "_atom_type_radius",
-        "_atom_type_ionic_radius"
-    ]
-
-    if oxi:
-        symbol_to_oxinum = {str(el): (float(el.oxi_state), _format(el.ionic_radius)) for el in sorted(composition.elements)}
-        data["_atom_type_oxidation_number"] = [v[0] for v in symbol_to_oxinum.values()]
-        # if we know the oxidation state of the element, use the ionic radius for the given oxidation state
-        data["_atom_type_ionic_radius"] = [v[1] for v in symbol_to_oxinum.values()]
-        loop_vals.append("_atom_type_oxidation_number")
+    return electronegativity, radius, _format_atomic_prop(elem.average_ionic_radius)
+
+
+@lru_cache(maxsize=None)
+def get_element_props_table() -> Dict[str, Tuple[str, str, str]]:
+    """
+    Returns the electronegativity, radius and average ionic radius of each of the elements known to the
+    tokenizer, as written in the atomic properties block. An element with a missing property (which
+    pymatgen gives as None) is left out, and making a block with it raises the same TypeError as it would
+    if the table did not exist.
+    """
+    table = {}
+    with warnings.catch_warnings():
+        # pymatgen warns about the missing electronegativities of the noble gases
+        warnings.simplefilter("ignore")
+        for symbol in ATOMS:
+            try:
+                table[symbol] = _get_element_props(Element(symbol))
+            except TypeError:
+                # a property is None
+                continue
+    return table
 
-    loops = [loop_vals]
 
-    return str(CifBlock(data, loops, "")).replace("data_\n", "")
-
-
-def replace_symmetry_operators(cif_str, space_group_symbol):
+def get_atomic_props_block(composition, oxi=False):
+    # the block depends only on the elements (or species, with their oxidation states)
+    return _get_atomic_props_block(tuple(sorted(composition.elements)), oxi)
+
+
+@lru_cache(maxsize=4096)
+def _get_atomic_props_block(elements, oxi):
+    table = get_element_props_table()
+    rows = []
+    for el in elements:
+        props = table.get(str(el))
+        if props is None:
+            props = _get_element_props(el)
+        if oxi:
+            # if we know the oxidation state of the element, use the ionic radius for the given oxidation state
+            props = props[:2] + (_format_atomic_prop(el.ionic_radius), str(float(el.oxi_state)))
+        rows.append((str(el),) + props)
+    loop = _ATOM_TYPE_LOOP_OXI if oxi else _ATOM_TYPE_LOOP
+    return loop + "".join(["\n  " + "  ".join(row) for row in rows])
+
+
+# the symmetry operators block of a generated CIF, which contains only the identity operator
+_IDENTITY_SYMMETRY_OPERATORS_BLOCK = "loop_\n_symmetry_equiv_pos_site_id\n_symmetry_equiv_pos_as_xyz\n1 'x, y, z'"
+
+
+@lru_cache(maxsize=None)
+def get_symmetry_operators_block(space_group_symbol):
+    """
+    Returns the loop of the symmetry operators of the given space group, as written in a CIF. The block
+    of each space group is made once, and remembered.
+
+    :param space_group_symbol: the space group symbol, e.g. "Fm-3m"
+    :returns: the symmetry operators block
+    """
     space_group = SpaceGroup(space_group_symbol)
     symmetry_ops = space_group.symmetry_ops
 
@@ -99,25 +202,178 @@ def replace_symmetry_operators(cif_str, space_group_symbol):
 
     loops.append(["_symmetry_equiv_pos_site_id", "_symmetry_equiv_pos_as_xyz"])
 
-    symm_block = str(CifBlock(data, loops, "")).replace("data_\n", "")
+    return str(CifBlock(data, loops, "")).replace("data_\n", "")
 
-    pattern = r"(loop_\n_symmetry_equiv_pos_site_id\n_symmetry_equiv_pos_as_xyz\n1 'x, y, z')"
-    cif_str_updated = re.sub(pattern, symm_block, cif_str)
 
-    return cif_str_updated
+def replace_symmetry_operators(cif_str, space_group_symbol):
+    symm_block = get_symmetry_operators_block(space_group_symbol)
+    return cif_str.replace(_IDENTITY_SYMMETRY_OPERATORS_BLOCK, symm_block)
+
+
+_HEADER_NUMERIC_TAGS = (
+    "_cell_length_a", "_cell_length_b", "_cell_length_c",
+    "_cell_angle_alpha", "_cell_angle_beta", "_cell_angle_gamma",
+    "_cell_volume", "_cell_formula_units_Z",
+)
+_HEADER_TEXT_TAGS = ("_symmetry_space_group_name_H-M", "_chemical_formula_sum", "_chemical_formula_structural")
+_HEADER_TAGS = ("data_",) + _HEADER_TEXT_TAGS + _HEADER_NUMERIC_TAGS
+
+# each alternative matches a field as the corresponding `extract_*` function does; the tags
+#  share their leading underscore, so that most positions are rejected at the first character
+_HEADER_FIELD = (
+    r"data_(?P<data>[A-Za-z0-9]+)\n"
+    r"|_(?:(?P<text_tag>symmetry_space_group_name_H-M|chemical_formula_sum|chemical_formula_structural)"
+    r"\s+(?:'(?P<quoted>[^']+)'|(?P<token>\S+))"
+    r"|(?P<numeric_tag>cell_length_[abc]|cell_angle_(?:alpha|beta|gamma)|cell_volume|cell_formula_units_Z)"
+    r"\s+(?P<number>[.0-9]+))"
+)
+_HEADER_PATTERN = re.compile(_HEADER_FIELD)
+# the same, but finding a match at every position, including within the value of another field
+_OVERLAPPING_HEADER_PATTERN = re.compile(f"(?=(?:{_HEADER_FIELD}))")
+_HEADER_PREFIXES = ("data_", "_symmetry_space_group_name_H-M", "_chemical_formula_", "_cell_")
+
+
+@lru_cache(maxsize=128)
+def _scan_cif_header(cif_str) -> Dict[str, str]:
+    fields, may_hide_fields = _scan_fields(cif_str, _HEADER_PATTERN)
+    if may_hide_fields:
+        # a text value contains what may be another field, which the non-overlapping scan would have missed
+        fields, _ = _scan_fields(cif_str, _OVERLAPPING_HEADER_PATTERN)
+    return fields
+
+
+def _scan_fields(cif_str, pattern) -> Tuple[Dict[str, str], bool]:
+    fields = {}
+    may_hide_fields = False
+    for match in pattern.finditer(cif_str):
+        data, text_tag, quoted, token, numeric_tag, number = match.groups()
+        if numeric_tag is not None:
+            fields.setdefault("_" + numeric_tag, number)
+        elif text_tag is not None:
+            value = quoted if quoted is not None else token
+            fields.setdefault("_" + text_tag, value)
+            # the value of any occurrence of a field, not only the first, may contain another field
+            may_hide_fields = may_hide_fields or any(prefix in value for prefix in _HEADER_PREFIXES)
+        else:
+            fields.setdefault("data_", data)
+        if len(fields) == len(_HEADER_TAGS):
+            break
+    return fields, may_hide_fields
+
+
+class CIFHeader:
+
+    def __init__(self, cif_str: str, fields: Dict[str, str]):
+        """
+        The scalar fields of a CIF: the formula in the data_ line, the space group, the formulas, the cell
+        parameters, the volume and the number of formula units. For each field, the first occurrence in
+        the CIF is used, as with the `extract_*` functions. A field that is missing is None.
+        """
+        self._cif_str = cif_str
+        self._fields = fields
+
+    def get(self, tag: str) -> Union[str, None]:
+        """
+        Returns the text of the value of the given field (e.g. "_cell_length_a", or "data_"), or None.
+        """
+        return self._fields.get(tag)
+
+    def require(self, tag: str, numeric_type=str):
+        """
+        Returns the value of the given field, converted with `numeric_type`, raising an exception if it is missing.
+        """
+        value = self._fields.get(tag)
+        if value is None:
+            raise Exception(f"could not find {tag} in:\n{self._cif_str}")
+        return numeric_type(value)
+
+    def _numeric(self, tag, numeric_type=float):
+        value = self._fields.get(tag)
+        return None if value is None else numeric_type(value)
+
+    @property
+    def data_formula(self) -> Union[str, None]:
+        return self._fields.get("data_")
+
+    @property
+    def space_group(self) -> Union[str, None]:
+        return self._fields.get("_symmetry_space_group_name_H-M")
+
+    @property
+    def formula_sum(self) -> Union[str, None]:
+        return self._fields.get("_chemical_formula_sum")
+
+    @property
+    def formula_structural(self) -> Union[str, None]:
+        return self._fields.get("_chemical_formula_structural")
+
+    @property
+    def a(self) -> Union[float, None]:
+        return self._numeric("_cell_length_a")
+
+    @property
+    def b(self) -> Union[float, None]:
+        return self._numeric("_cell_length_b")
+
+    @property
+    def c(self) -> Union[float, None]:
+        return self._numeric("_cell_length_c")
+
+    @property
+    def alpha(self) -> Union[float, None]:
+        return self._numeric("_cell_angle_alpha")
+
+    @property
+    def beta(self) -> Union[float, None]:
+        return self._numeric("_cell_angle_beta")
+
+    @property
+    def gamma(self) -> Union[float, None]:
+        return self._numeric("_cell_angle_gamma")
+
+    @property
+    def volume(self) -> Union[float, None]:
+        return self._numeric("_cell_volume")
+
+    @property
+    def formula_units(self) -> Union[int, None]:
+        return self._numeric("_cell_formula_units_Z", numeric_type=int)
+
+    def cell_parameters(self) -> Tuple[float, float, float, float, float, float]:
+        """
+        Returns the cell lengths and angles, raising an exception if any is missing.
+        """
+        return tuple(self.require(tag, float) for tag in _HEADER_NUMERIC_TAGS[:6])
+
+
+def scan_cif_header(cif_str) -> CIFHeader:
+    """
+    Returns the scalar fields of the given CIF, found in a single pass over the text, which stops once
+    every field has been found. The result of the most recent scans is remembered, so the `extract_*`
+    functions, which use it, can be called on the same CIF repeatedly at little cost.
+
+    :param cif_str: the CIF
+    :returns: a CIFHeader
+    """
+    return CIFHeader(cif_str, _scan_cif_header(cif_str))
 
 
 def extract_space_group_symbol(cif_str):
-    match = re.search(r"_symmetry_space_group_name_H-M\s+('([^']+)'|(\S+))", cif_str)
-    if match:
-        return match.group(2) if match.group(2) else match.group(3)
+    space_group = _scan_cif_header(cif_str).get("_symmetry_space_group_name_H-M")
+    if space_group is not None:
+        return space_group
     raise Exception(f"could not extract space group from:\n{cif_str}")
 
 
 def extract_numeric_property(cif_str, prop, numeric_type=float):
-    match = re.search(rf"{prop}\s+([.0-9]+)", cif_str)
-    if match:
-        return numeric_type(match.group(1))
+    if prop in _HEADER_NUMERIC_TAGS:
+        value = _scan_cif_header(cif_str).get(prop)
+        if value is not None:
+            return numeric_type(value)
+    else:
+        match = re.search(rf"{prop}\s+([.0-9]+)", cif_str)
+        if match:
+            return numeric_type(match.group(1))
     raise Exception(f"could not find {prop} in:\n{cif_str}")
 
 
@@ -130,16 +386,16 @@ def extract_formula_units(cif_str):
 
 
 def extract_data_formula(cif_str):
-    match = re.search(r"data_([A-Za-z0-9]+)\n", cif_str)
-    if match:
-        return match.group(1)
+    data_formula = _scan_cif_header(cif_str).get("data_")
+    if data_formula is not None:
+        return data_formula
     raise Exception(f"could not find data_ in:\n{cif_str}")
 
 
 def extract_formula_nonreduced(cif_str):
-    match = re.search(r"_chemical_formula_sum\s+('([^']+)'|(\S+))", cif_str)
-    if match:
-        return match.group(2) if match.group(2) else match.group(3)
+    formula = _scan_cif_header(cif_str).get("_chemical_formula_sum")
+    if formula is not None:
+        return formula
     raise Exception(f"could not extract _chemical_formula_sum value from:\n{cif_str}")
 
 
@@ -192,25 +448,220 @@ def remove_atom_props_block(cif):
     return new_cif
 
 
+# a floating point number in the CIF file, including numbers in scientific notation
+_NUMBER_PATTERN = re.compile(r"([-+]?\d*\.\d+(?:[eE][-+]?\d+)?)")
+
+
 def round_numbers(cif_str, decimal_places=4):
-    # Pattern to match a floating point number in the CIF file
-    # It also matches numbers in scientific notation
-    pattern = r"[-+]?\d*\.\d+([eE][-+]?\d+)?"
-
-    # Function to round the numbers
-    def round_number(match):
-        number_str = match.group()
-        number = float(number_str)
-        # Check if number of digits after decimal point is less than 'decimal_places'
-        if len(number_str.split('.')[-1]) <= decimal_places:
-            return number_str
-        rounded = round(number, decimal_places)
-        return format(rounded, '.{}f'.format(decimal_places))
-
-    # Replace all occurrences of the pattern using a regex sub operation
-    cif_string_rounded = re.sub(pattern, round_number, cif_str)
-
-    return cif_string_rounded
+    # the text is split around the numbers, which are at the odd positions
+    parts = _NUMBER_PATTERN.split(cif_str)
+    number_format = f".{decimal_places}f"
+    # a number is rounded only if it has more than `decimal_places` digits after the decimal point
+    parts[1::2] = [
+        number_str if len(number_str) - number_str.index(".") - 1 <= decimal_places
+        else format(round(float(number_str), decimal_places), number_format)
+        for number_str in parts[1::2]
+    ]
+    return "".join(parts)
+
+
+_FORMULA_UNITS_PATTERN = re.compile(r"_cell_formula_units_Z\s+([.0-9]+)")
+_FORMULA_SUM_LINE_PATTERN = re.compile(r"_chemical_formula_sum\s+(.+)\n")
+_FORMULA_SUM_PATTERN = re.compile(r"_chemical_formula_sum\s+('([^']+)'|(\S+))")
+# where the symmetry operators replaced by `semisymmetrize_cif` end
+_SYMMETRY_OPERATORS_END_PATTERN = re.compile(r"\n(?:\S| \S)")
+
+
+def preprocess_cif(cif_str, oxi=False, decimal_places=4):
+    """
+    Pre-processes a CIF for training: replaces the formula in the data_ line with the cell composition,
+    keeps only the identity symmetry operator, adds the atomic properties block, and rounds the numbers.
+    The result is the same as that of `replace_data_formula_with_nonreduced_formula`, `semisymmetrize_cif`,
+    `add_atomic_props_block` and `round_numbers`, applied in that order, but the text replaced by each step
+    is located in the original CIF, which is then rewritten once, rather than once by each step.
+
+    :param cif_str: the CIF
+    :param oxi: whether the CIF contains oxidation state information
+    :param decimal_places: the number of decimal places the numbers are rounded to
+    :returns: the pre-processed CIF
+    :raises Exception: if the CIF has no formula units (Z), or Z is 0, or any of the steps fails
+    """
+    match = _FORMULA_UNITS_PATTERN.search(cif_str)
+    if not match:
+        raise Exception(f"could not find _cell_formula_units_Z in:\n{cif_str}")
+    # CIFs with formula units (Z) = 0 are erroneous
+    if int(match.group(1)) == 0:
+        raise Exception(f"_cell_formula_units_Z is 0 in:\n{cif_str}")
+
+    preprocessed = _preprocess_cif_in_one_pass(cif_str, oxi)
+    if preprocessed is not None:
+        cif_str = preprocessed
+    else:
+        # the CIF is laid out unusually, so the steps are applied one at a time
+        cif_str = replace_data_formula_with_nonreduced_formula(cif_str)
+        cif_str = semisymmetrize_cif(cif_str)
+        cif_str = add_atomic_props_block(cif_str, oxi)
+    return round_numbers(cif_str, decimal_places=decimal_places)
+
+
+def _overlaps(span, other):
+    return span[0] < other[1] and other[0] < span[1]
+
+
+def _preprocess_cif_in_one_pass(cif_str, oxi):
+    # the text replaced by each of the steps is located in the original CIF, and the CIF is then rewritten
+    #  once; if the steps could interfere with each other (e.g. a tag looked for by one step is in text
+    #  replaced by another), None is returned
+    if cif_str.count("data_") != 1 or cif_str.count("_chemical_formula_sum") != 1 or \
+            cif_str.count("_symmetry_equiv_pos_as_xyz") > 1:
+        return None
+
+    formula_line_match = _FORMULA_SUM_LINE_PATTERN.search(cif_str)
+    formula_match = _FORMULA_SUM_PATTERN.search(cif_str)
+    space_group_start = cif_str.find("_symmetry_space_group_name_H-M")
+    if not formula_line_match or not formula_match or space_group_start == -1:
+        return None
+    data_formula = formula_line_match.group(1).replace("'", "").replace(" ", "")
+    # the formula must not add any of the tags looked for, nor be read as a regex group reference
+    if "_" in data_formula or "\\" in data_formula or data_formula[:1].isdigit():
+        return None
+    if cif_str[formula_match.start(1)] == "'" and formula_match.group(2) is None:
+        # an unclosed quote could be closed by the text added by the steps
+        return None
+
+    # the (start, end, replacement) of each span of text that is replaced
+    edits = []
+    data_start = cif_str.index("data_") + len("data_")
+    data_end = cif_str.find("\n", data_start)
+    if data_end != -1:
+        edits.append((data_start, data_end, data_formula))
+    xyz_start = cif_str.find("_symmetry_equiv_pos_as_xyz\n")
+    if xyz_start != -1:
+        ops_start = xyz_start + len("_symmetry_equiv_pos_as_xyz\n")
+        ops_end = _SYMMETRY_OPERATORS_END_PATTERN.search(cif_str, ops_start)
+        if ops_end:
+            if data_end != -1 and _overlaps((xyz_start, ops_end.start()), (data_start, data_end)):
+                return None
+            edits.append((ops_start, ops_end.start(), "  1  'x, y, z'"))
+
+    kept = [formula_match.span(), (space_group_start, space_group_start + len("_symmetry_space_group_name_H-M"))]
+    if any(_overlaps(span, edit) for span in kept for edit in edits):
+        return None
+
+    formula = formula_match.group(2) if formula_match.group(2) else formula_match.group(3)
+    block = get_atomic_props_block(Composition(formula), oxi)
+    edits.append((space_group_start, space_group_start, block + "\n"))
+
+    pieces = []
+    pos = 0
+    for start, end, replacement in sorted(edits):
+        pieces.append(cif_str[pos:start])
+        pieces.append(replacement)
+        pos = end
+    pieces.append(cif_str[pos:])
+    return "".join(pieces)
+
+
+def extract_atom_site_rows(cif_str, columns):
+    """
+    Returns the values of the given `_atom_site_` columns for each row of the atom site loop.
+
+    :param cif_str: the CIF
+    :param columns: the names of the columns to extract, e.g. ["_atom_site_type_symbol", "_atom_site_fract_x"];
+                    a column that is not present in the loop is given a value of None
+    :returns: a list of tuples, one per atom site
+    """
+    rows = []
+    headers = None
+    in_loop = False
+    for line in cif_str.split("\n"):
+        line = line.strip()
+        if line == "loop_":
+            if headers is not None and rows:
+                break
+            in_loop = True
+            headers = []
+            continue
+        if not in_loop:
+            continue
+        if line.startswith("_") and not rows:
+            headers.append(line)
+        elif len(line) == 0 or line.startswith("_"):
+            in_loop = False
+        elif len(headers) > 0 and headers[0].startswith("_atom_site_"):
+            values = line.split()
+            rows.append(tuple(values[headers.index(c)] if c in headers and headers.index(c) < len(values)
+                              else None for c in columns))
+        else:
+            in_loop = False
+    return rows
+
+
+def get_canonical_cif_hash(cif_str, decimal_places=4):
+    """
+    Returns a hash identifying the structure described by the CIF, independent of formatting details
+    such as whitespace, site labels and the order of the atom sites. The hash covers the cell composition,
+    the space group, the cell parameters, and the species, fractional coordinates and occupancy of each
+    atom site, with all numbers rounded to the given number of decimal places.
+
+    :param cif_str: the CIF
+    :param decimal_places: the number of decimal places numbers are rounded to
+    :returns: a hexadecimal SHA-256 digest
+    """
+    def _round(value):
+        # remove any standard uncertainty, e.g. 0.5(1), and avoid distinguishing 0.0 from -0.0
+        value = float(value.split("(")[0]) if isinstance(value, str) else float(value)
+        return f"{round(value, decimal_places) + 0.:.{decimal_places}f}"
+
+    formula = " ".join(sorted(extract_formula_nonreduced(cif_str).split()))
+    space_group = extract_space_group_symbol(cif_str)
+    cell = [_round(extract_numeric_property(cif_str, prop)) for prop in (
+        "_cell_length_a", "_cell_length_b", "_cell_length_c",
+        "_cell_angle_alpha", "_cell_angle_beta", "_cell_angle_gamma",
+    )]
+    rows = extract_atom_site_rows(cif_str, [
+        "_atom_site_type_symbol", "_atom_site_fract_x", "_atom_site_fract_y", "_atom_site_fract_z",
+        "_atom_site_occupancy",
+    ])
+    sites = sorted(
+        # a site without an occupancy is fully occupied
+        " ".join([symbol] + [_round(v) for v in (x, y, z)] + [_round(occ if occ is not None else 1.0)])
+        for symbol, x, y, z, occ in rows
+    )
+
+    canonical = "\n".join([formula, space_group, " ".join(cell)] + sites)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def get_canonical_structure_hash(structure, decimal_places=4):
+    """
+    Returns a hash identifying the given pymatgen Structure, independent of the order of its sites.
+    The hash covers the cell parameters, and the species, occupancies and fractional coordinates
+    of each site, with all numbers rounded to the given number of decimal places, and the
+    fractional coordinates wrapped into the unit cell.
+
+    :param structure: the pymatgen Structure
+    :param decimal_places: the number of decimal places numbers are rounded to
+    :returns: a hexadecimal SHA-256 digest
+    """
+    def _round(value):
+        # avoid distinguishing 0.0 from -0.0
+        return f"{round(float(value), decimal_places) + 0.:.{decimal_places}f}"
+
+    def _wrap(coord):
+        # a coordinate that rounds to 1 is the same as one that rounds to 0
+        return _round(round(coord % 1., decimal_places) % 1.)
+
+    lattice = structure.lattice
+    cell = [_round(v) for v in (lattice.a, lattice.b, lattice.c, lattice.alpha, lattice.beta, lattice.gamma)]
+    sites = sorted(
+        " ".join([f"{species}:{_round(occupancy)}" for species, occupancy in sorted(site.species.items(), key=str)] +
+                 [_wrap(coord) for coord in site.frac_coords])
+        for site in structure
+    )
+
+    canonical = "\n".join([" ".join(cell)] + sites)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
 
 
 def array_split(arr, num_splits):
@@ -0,0 +1,274 @@
+import multiprocessing as mp
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from multiprocessing.connection import wait
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Union
+
+import pandas as pd
+
+from ._metrics import (
+    CIFAnalysis,
+    SpaceGroupDetector,
+    bond_length_reasonableness_score,
+    is_atom_site_multiplicity_consistent,
+    is_formula_consistent,
+    is_sensible,
+    is_space_group_consistent,
+)
+
+CHECKS = ("sensible", "formula", "multiplicity", "bond_length", "space_group")
+
+# the checks of `is_valid`, in the same order
+DEFAULT_CHECKS = ("formula", "multiplicity", "bond_length", "space_group")
+
+
+@dataclass
+class ValidationResult:
+    """
+    The outcome of validating a CIF with `validate_many`.
+
+    :param index: the position of the CIF in the input
+    :param valid: whether the CIF passed every check
+    :param failed_check: the name of the first check that failed, raised an exception, or ran out of time
+    :param error: the exception raised by the failed check, or a description of the timeout
+    :param outcomes: the outcome of each check that completed: a bool, or the score for "bond_length"
+    :param timings: the time, in seconds, spent in each check that was started
+    """
+    index: int
+    valid: bool
+    failed_check: str = None
+    error: str = None
+    outcomes: Dict[str, Union[bool, float]] = field(default_factory=dict)
+    timings: Dict[str, float] = field(default_factory=dict)
+
+
+def _run_check(name, check, analysis, options, detector) -> Tuple[Union[bool, float], bool]:
+    if check is not None:
+        outcome = bool(check(analysis))
+        return outcome, outcome
+    if name == "sensible":
+        outcome = is_sensible(analysis)
+    elif name == "formula":
+        outcome = is_formula_consistent(analysis)
+    elif name == "multiplicity":
+        outcome = is_atom_site_multiplicity_consistent(analysis)
+    elif name == "bond_length":
+        score = bond_length_reasonableness_score(analysis, fast=options["fast_bond_length_score"])
+        return score, score >= options["bond_length_acceptability_cutoff"]
+    elif name == "space_group":
+        outcome = is_space_group_consistent(analysis, detector)
+    else:
+        raise ValueError(f"unknown check: {name}")
+    return outcome, outcome
+
+
+def _validate(index, cif, options, detector, current_check=None) -> ValidationResult:
+    analysis = CIFAnalysis(cif)
+    result = ValidationResult(index=index, valid=True)
+    for i, (name, check) in enumerate(options["checks"]):
+        if current_check is not None:
+            current_check.value = i
+        start = time.perf_counter()
+        try:
+            outcome, passed = _run_check(name, check, analysis, options, detector)
+        except Exception as e:
+            result.timings[name] = time.perf_counter() - start
+            result.valid = False
+            result.failed_check = result.failed_check or name
+            result.error = result.error or f"{type(e).__name__}: {e}"
+            # the remaining checks would most likely fail the same way
+            break
+        result.timings[name] = time.perf_counter() - start
+        result.outcomes[name] = outcome
+        if not passed:
+            result.valid = False
+            result.failed_check = result.failed_check or name
+            if options["stop_at_first_failure"]:
+                break
+    return result
+
+
+def _validation_worker(conn, options, current_check):
+    detector = SpaceGroupDetector(db_path=options["space_group_cache_path"])
+    try:
+        while True:
+            chunk = conn.recv()
+            if chunk is None:
+                break
+            for index, cif in chunk:
+                conn.send(_validate(index, cif, options, detector, current_check))
+    finally:
+        detector.close()
+
+
+class _Worker:
+    def __init__(self, context, options):
+        self.conn, worker_conn = context.Pipe()
+        self.current_check = context.Value("i", 0, lock=False)
+        self.process = context.Process(target=_validation_worker, args=(worker_conn, options, self.current_check),
+                                       daemon=True)
+        self.process.start()
+        worker_conn.close()
+        self.remaining = []
+        self.item_start = None
+
+    def assign(self, chunk):
+        self.remaining = list(chunk)
+        self.item_start = time.monotonic()
+        self.conn.send(chunk)
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+def _validate_in_workers(items, options, workers, chunk_size, timeout_per_cif, start_method):
+    context = mp.get_context(start_method)
+    check_names = [name for name, _ in options["checks"]]
+    chunks = deque(items[i:i + chunk_size] for i in range(0, len(items), chunk_size))
+    pool = [_Worker(context, options) for _ in range(min(workers, len(chunks)))]
+
+    def replace(worker):
+        worker.kill()
+        pool[pool.index(worker)] = _Worker(context, options)
+
+    def fail_current(worker, error):
+        # the remaining items of the worker's chunk are handed to the next idle worker
+        index, _ = worker.remaining[0]
+        if len(worker.remaining) > 1:
+            chunks.appendleft(worker.remaining[1:])
+        name = check_names[worker.current_check.value] if check_names else None
+        timings = {name: time.monotonic() - worker.item_start} if name is not None else {}
+        return ValidationResult(index=index, valid=False, failed_check=name, error=error, timings=timings)
+
+    try:
+        while chunks or any(worker.remaining for worker in pool):
+            for worker in pool:
+                if not worker.remaining and chunks:
+                    worker.assign(chunks.popleft())
+
+            busy = [worker for worker in pool if worker.remaining]
+            wait_s = None
+            if timeout_per_cif is not None:
+                now = time.monotonic()
+                wait_s = max(0., min(worker.item_start + timeout_per_cif - now for worker in busy))
+            ready = wait([worker.conn for worker in busy], timeout=wait_s)
+
+            for worker in busy:
+                if worker.conn in ready:
+                    try:
+                        result = worker.conn.recv()
+                    except EOFError:
+                        yield fail_current(worker, f"the worker process exited with code {worker.process.exitcode}")
+                        replace(worker)
+                        continue
+                    worker.remaining.pop(0)
+                    worker.item_start = time.monotonic()
+                    yield result
+                elif timeout_per_cif is not None and time.monotonic() - worker.item_start > timeout_per_cif:
+                    yield fail_current(worker, f"timed out after {timeout_per_cif}s")
+                    replace(worker)
+    finally:
+        for worker in pool:
+            if worker.remaining:
+                worker.kill()
+            else:
+                worker.stop()
+
+
+def validate_many(
+    cifs: Iterable[str],
+    checks: List[Union[str, Tuple[str, Callable[[CIFAnalysis], bool]]]] = DEFAULT_CHECKS,
+    workers: int = 0,
+    timeout_per_cif: float = None,
+    chunk_size: int = 16,
+    bond_length_acceptability_cutoff: float = 1.0,
+    fast_bond_length_score: bool = False,
+    space_group_cache_path: str = None,
+    stop_at_first_failure: bool = True,
+    start_method: str = "fork",
+    as_dataframe: bool = False,
+) -> Union[Iterator[ValidationResult], pd.DataFrame]:
+    """
+    Validates many CIFs, optionally across several worker processes, each CIF being parsed once
+    for all checks. With workers, the CIFs are sent in chunks, and a worker that spends more than
+    `timeout_per_cif` seconds on a single CIF is killed and replaced, and the CIF is reported as
+    having failed the check it was running; the rest of its chunk is validated by another worker.
+
+    :param cifs: the CIFs
+    :param checks: the checks to run, in order: names from `CHECKS`, and/or (name, function) pairs, where
+                   the function takes a CIFAnalysis and returns whether the CIF passes (with workers, the
+                   function must be picklable); by default, the checks of `is_valid`
+    :param workers: the number of worker processes; if 0, the CIFs are validated in this process
+    :param timeout_per_cif: optional: the maximum time, in seconds, spent on a CIF; requires workers
+    :param chunk_size: the number of CIFs sent to a worker at a time
+    :param bond_length_acceptability_cutoff: the smallest bond length reasonableness score that passes
+    :param fast_bond_length_score: whether to use the fast approximation of the bond length score
+    :param space_group_cache_path: optional: path to an SQLite database of detected space groups,
+                                   shared by the workers
+    :param stop_at_first_failure: if True, the remaining checks of a CIF are skipped once one fails;
+                                  a check that raises an exception always ends the validation of the CIF
+    :param start_method: the multiprocessing start method of the workers
+    :param as_dataframe: if True, all CIFs are validated, and a DataFrame is returned, in the order of
+                         the CIFs, with the columns "valid", "failed_check" and "error", and an "<check>"
+                         outcome column and a "<check>_time" column for each check
+    :returns: an iterator over the ValidationResult of each CIF, yielded as they complete (with workers,
+              not necessarily in the order of the CIFs), or a DataFrame
+    """
+    if timeout_per_cif is not None and workers < 1:
+        raise ValueError("timeout_per_cif requires at least one worker")
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size must be at least 1, got: {chunk_size}")
+    checks = [(check, None) if isinstance(check, str) else tuple(check) for check in checks]
+    for name, check in checks:
+        if check is None and name not in CHECKS:
+            raise ValueError(f"unknown check: {name}")
+    options = {
+        "checks": checks,
+        "bond_length_acceptability_cutoff": bond_length_acceptability_cutoff,
+        "fast_bond_length_score": fast_bond_length_score,
+        "space_group_cache_path": space_group_cache_path,
+        "stop_at_first_failure": stop_at_first_failure,
+    }
+
+    items = list(enumerate(cifs))
+    if workers > 0:
+        results = _validate_in_workers(items, options, workers, chunk_size, timeout_per_cif, start_method)
+    else:
+        results = _validate_here(items, options)
+
+    if not as_dataframe:
+        return results
+
+    rows = {}
+    for result in results:
+        row = {"valid": result.valid, "failed_check": result.failed_check, "error": result.error}
+        for name, _ in checks:
+            row[name] = result.outcomes.get(name)
+            row[f"{name}_time"] = result.timings.get(name)
+        rows[result.index] = row
+    return pd.DataFrame([rows[index] for index in sorted(rows)], index=sorted(rows))
+
+
+def _validate_here(items, options):
+    detector = SpaceGroupDetector(db_path=options["space_group_cache_path"]) \
+        if options["space_group_cache_path"] else None
+    try:
+        for index, cif in items:
+            yield _validate(index, cif, options, detector)
+    finally:
+        if detector is not None:
+            detector.close()
@@ -0,0 +1,116 @@
+"""
+This file is intended as an example of setting up an ALIGNN model to listen
+for and respond to batched prediction requests using ZMQ. It implements the
+batch protocol used by the PooledZMQScorer: each request is a multipart
+message containing one CIF per frame, and the reply is a multipart message
+containing one score per frame, in the same order. A request with a single
+frame is also answered with a single frame, so the ZMQScorer can use this
+server too.
+
+To spread the load over several processes, start one per port, e.g.:
+python resources/alignn_zmq_batch_example.py --port 5555
+python resources/alignn_zmq_batch_example.py --port 5556
+
+With the --stand-in flag, the server replies with random scores after the
+given delay, and ALIGNN is not required. This is useful for testing the
+MCTS pipeline locally.
+
+A minimal set of dependencies required for this example would be:
+Python 3.9
+pyzmq = 25.1.1
+alignn = 2023.8.1
+
+It may be best, and even necessary, to create a separate Python environment
+for this process when interoperating with a process running the MCTS code in
+this repository, for example, since there could be conflicting dependency
+requirements.
+"""
+import argparse
+import random
+import time
+
+import zmq
+
+
+def alignn_predictor(model_name, device):
+    # noinspection PyUnresolvedReferences
+    from jarvis.core.atoms import Atoms
+    # noinspection PyUnresolvedReferences
+    from alignn.pretrained import get_prediction
+
+    def predict(cif):
+        try:
+            atoms = Atoms.from_cif(from_string=cif, get_primitive_atoms=True)
+        except Exception as e:
+            print(f"exception getting atoms: {e}")
+            print("trying with get_primitive_atoms=False...")
+            atoms = Atoms.from_cif(from_string=cif, get_primitive_atoms=False)
+
+        out_data = get_prediction(
+            model_name,
+            device,
+            atoms=atoms,
+            cutoff=8,
+            max_neighbors=12
+        )
+        return out_data[0]
+
+    return predict
+
+
+def stand_in_predictor(delay_s, seed):
+    local_random = random.Random(seed)
+
+    def predict(cif):
+        time.sleep(delay_s)
+        return local_random.uniform(-5., 5.)
+
+    return predict
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve batched CIF score predictions over ZMQ.")
+    parser.add_argument("--port", type=int, default=5555, help="The port to listen on.")
+    parser.add_argument("--device", type=str, default="cpu", help="The device used by ALIGNN.")
+    parser.add_argument("--model", type=str, default="jv_formation_energy_peratom_alignn",
+                        help="The name of the pretrained ALIGNN model.")
+    parser.add_argument("--stand-in", action="store_true",
+                        help="Include this flag to reply with random scores instead of ALIGNN predictions.")
+    parser.add_argument("--delay", type=float, default=0.2,
+                        help="The time, in seconds, the stand-in takes to score each CIF.")
+    parser.add_argument("--seed", type=int, default=None, help="The random seed of the stand-in.")
+    args = parser.parse_args()
+
+    if args.stand_in:
+        print(f"using stand-in predictor with delay: {args.delay}s")
+        predict = stand_in_predictor(args.delay, args.seed)
+    else:
+        print(f"using device: {args.device}")
+        print(f"using model: {args.model}")
+        predict = alignn_predictor(args.model, args.device)
+
+    print(f"using port: {args.port}")
+
+    # Prepare the ZeroMQ context and REP socket
+    context = zmq.Context()
+    socket = context.socket(zmq.REP)
+    socket.bind(f"tcp://*:{args.port}")
+
+    print("listening for requests...")
+
+    while True:
+        # Wait for the next batch of CIFs from the client
+        frames = socket.recv_multipart()
+        print(f"received request with {len(frames)} CIF(s)")
+
+        replies = []
+        for frame in frames:
+            try:
+                reply = f"{predict(frame.decode('utf-8'))}"
+            except Exception as ex:
+                print(f"exception making prediction: {ex}")
+                reply = "nan"
+            replies.append(reply.encode("utf-8"))
+
+        print(f"sending reply: {[r.decode('utf-8') for r in replies]}")
+        socket.send_multipart(replies)
@@ -0,0 +1,93 @@
+import unittest
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from crystallm import (
+    CIF_TABLE_COLUMNS,
+    CIFTokenizer,
+    build_cif_table,
+    extract_formula_nonreduced,
+    extract_formula_units,
+    extract_space_group_symbol,
+    extract_volume,
+    get_cif_table_geometry,
+    get_cif_table_path,
+    get_unit_cell_volume,
+    is_sensible,
+    load_cif_table,
+    save_cif_table,
+)
+
+from tests.test_metrics import CIF_NACL
+
+BENCHMARKS_DIR = os.path.join(os.path.dirname(__file__), "..", "resources", "benchmarks")
+
+
+class TestCIFTable(unittest.TestCase):
+
+    def test_build(self):
+        cifs = [("nacl", CIF_NACL), ("bad", "garbage"), ("no_volume", CIF_NACL.replace("_cell_volume", "_vol"))]
+        table = build_cif_table(cifs)
+
+        assert list(table) == list(CIF_TABLE_COLUMNS)
+        assert table["id"].tolist() == ["nacl", "bad", "no_volume"]
+        assert table["formula"].tolist() == ["Na4 Cl4", "", "Na4 Cl4"]
+        assert table["reduced_formula"].tolist() == ["NaCl", "", "NaCl"]
+        assert table["space_group"].tolist() == ["Fm-3m", "", "Fm-3m"]
+        assert table["formula_units"].tolist() == [4, -1, 4]
+        assert table["a"][0] == 5.691 and np.isnan(table["a"][1])
+        assert table["volume"][0] == 184.316997 and np.isnan(table["volume"][2])
+        assert table["n_tokens"][0] == len(CIFTokenizer().tokenize_cif(CIF_NACL))
+
+    def test_same_as_extracted_in_parallel(self):
+        df = pd.read_csv(os.path.join(BENCHMARKS_DIR, "perov_5", "test.csv"))
+        cifs = list(zip(df["material_id"].astype(str), df["cif"]))[:60]
+
+        table = build_cif_table(cifs, workers=2, chunk_size=16, count_tokens=False)
+
+        assert table["id"].tolist() == [id for id, _ in cifs]
+        assert (table["n_tokens"] == -1).all()
+        for i, (_, cif) in enumerate(cifs):
+            assert table["formula"][i] == extract_formula_nonreduced(cif)
+            assert table["space_group"][i] == extract_space_group_symbol(cif)
+            assert table["formula_units"][i] == extract_formula_units(cif)
+            assert table["volume"][i] == extract_volume(cif)
+
+    def test_geometry(self):
+        cifs = [
+            ("nacl", CIF_NACL),
+            ("bad", "garbage"),
+            ("zero_z", CIF_NACL.replace("_cell_formula_units_Z   4", "_cell_formula_units_Z   0")),
+            ("flat", CIF_NACL.replace("_cell_angle_gamma   90.00000000", "_cell_angle_gamma   180.00000000")),
+            ("small", CIF_NACL.replace("_cell_length_a   5.69100000", "_cell_length_a   0.10000000")),
+        ]
+        table = build_cif_table(cifs, count_tokens=False)
+
+        geometry = get_cif_table_geometry(table)
+
+        assert geometry["implied_volume"][0] == get_unit_cell_volume(5.691, 5.691, 5.691, 90., 90., 90.)
+        assert np.isnan(geometry["implied_volume"][1])
+        assert geometry["vpfu"][0] == 184.316997 / 4
+        assert np.isnan(geometry["vpfu"][1])
+        assert geometry["vpfu"][2] == 184.316997
+        assert geometry["sensible"].tolist() == [is_sensible(cif) for _, cif in cifs]
+        assert geometry["degenerate"].tolist() == [False, True, False, True, False]
+
+    def test_save_and_load(self):
+        cifs = [("nacl", CIF_NACL), ("bad", "garbage")]
+        table = build_cif_table(cifs)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = get_cif_table_path(os.path.join(tmp_dir, "cifs.pkl.gz"))
+            assert path == os.path.join(tmp_dir, "cifs.table.npz")
+
+            save_cif_table(table, path)
+            loaded = load_cif_table(path, cifs)
+
+            for column in CIF_TABLE_COLUMNS:
+                np.testing.assert_array_equal(loaded[column], table[column])
+            with self.assertRaises(Exception):
+                load_cif_table(path, [("bad", "garbage"), ("nacl", CIF_NACL)])
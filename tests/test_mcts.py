@@ -0,0 +1,830 @@
+import unittest
+import inspect
+import os
+import random
+import tempfile
+import threading
+import time
+
+import numpy as np
+from pymatgen.io.cif import CifParser
+
+import torch
+
+from crystallm import (
+    AsyncMCTSEvaluator,
+    CachingScorer,
+    CIFScorer,
+    CIFTokenizer,
+    ForwardBatcher,
+    GPT,
+    GPTConfig,
+    MCTSEvaluator,
+    MCTSSampler,
+    MCTSTree,
+    PUCTSelector,
+    RandomScorer,
+    RootParallelMCTSSampler,
+    RolloutChecker,
+    RunningStats,
+    SpaceGroupDetector,
+    Tracer,
+    UCTSelector,
+)
+
+
+class LengthScorer(CIFScorer):
+    def __init__(self, delay_s=0.):
+        self._delay_s = delay_s
+
+    def score(self, cif):
+        time.sleep(self._delay_s)
+        return float(len(cif))
+
+
+class AcceptingEvaluator(AsyncMCTSEvaluator):
+    """
+    An AsyncMCTSEvaluator that treats every rollout as a valid CIF, so that
+    the scoring path can be exercised with an untrained model.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rewards = []
+
+    def _prepare(self, token_sequence):
+        return self._tokenizer.decode(token_sequence), None
+
+    def _finish(self, cif, score, id, iter_num):
+        reward = super()._finish(cif, score, id, iter_num)
+        self.rewards.append(reward)
+        return reward
+
+
+def tiny_sampler(eval_function, tokenizer, max_depth=12, width=3):
+    torch.manual_seed(0)
+    config = GPTConfig(block_size=32, vocab_size=len(tokenizer.token_to_id), n_layer=1, n_head=1, n_embd=8)
+    model = GPT(config)
+    return MCTSSampler(
+        model=model,
+        config=config,
+        width=width,
+        max_depth=max_depth,
+        eval_function=eval_function,
+        node_selector=PUCTSelector(cpuct=1.0),
+        tokenizer=tokenizer,
+        temperature=1.0,
+        device="cpu",
+    )
+
+
+class TestAsyncMCTS(unittest.TestCase):
+
+    def test_async_search_applies_all_rewards(self):
+        tokenizer = CIFTokenizer()
+        evaluator = AcceptingEvaluator(LengthScorer(delay_s=0.01), tokenizer, max_in_flight=2)
+        sampler = tiny_sampler(evaluator, tokenizer)
+
+        sampler.search("data_", num_simulations=6, n_rollouts=2)
+        evaluator.close()
+
+        assert len(evaluator.rewards) == 12
+        assert sampler._pending == []
+        _, best_reward = sampler.get_best_sequence()
+        assert best_reward == max(evaluator.rewards)
+
+    def test_provisional_reward_is_corrected(self):
+        tokenizer = CIFTokenizer()
+        evaluator = AcceptingEvaluator(LengthScorer(delay_s=0.2), tokenizer, max_in_flight=4,
+                                       provisional_reward=0.25)
+        sampler = tiny_sampler(evaluator, tokenizer)
+
+        class Node:
+            def __init__(self, parent=None):
+                self.parent = parent
+                self.visits = 0.
+                self.wins = 0.
+
+        root = Node()
+        leaf = Node(parent=root)
+        rollout_rewards = [([1, 2], evaluator.submit([1, 2], 1)), ([3], evaluator.submit([3], 1))]
+
+        score = sampler._provisional_score(leaf, rollout_rewards)
+        assert score == 0.25
+        for node in (leaf, root):
+            node.visits += 1
+            node.wins += score
+
+        sampler._apply_pending(block=True)
+        evaluator.close()
+
+        expected = sum(evaluator.rewards) / 2
+        assert abs(leaf.wins - expected) < 1e-12
+        assert abs(root.wins - expected) < 1e-12
+        assert root.visits == 1
+
+
+class FixedLanguageModel:
+    """
+    A stand-in for the MCTSLanguageModel, which proposes the same tokens, with the
+    same weights, after every sequence.
+    """
+    def __init__(self, child_ids, weights):
+        self._child_ids = child_ids
+        self._weights = weights
+        self.calls = 0
+
+    def top_n_vocab_with_weights(self, n, token_sequence):
+        self.calls += 1
+        return self._child_ids[:n], self._weights[:n]
+
+
+class TestMCTSTree(unittest.TestCase):
+
+    def test_states_are_reconstructed(self):
+        lm = FixedLanguageModel([5, 6, 7], [0.5, 0.3, 0.2])
+        tree = MCTSTree([1, 2], lm, width=3, max_depth=6, newline_id=0, capacity=2)
+        root = tree.root
+
+        assert root.untried_moves == [[1, 2, 5], [1, 2, 6], [1, 2, 7]]
+        assert root.prob is None
+
+        child = root.add_child(root.select_untried_move())
+        grandchild = child.add_child(child.select_untried_move())
+
+        assert grandchild.state[:3] == child.state
+        assert len(grandchild.state) == 4
+        assert grandchild.parent == child
+        assert child.parent == root
+        assert root.parent is None
+        assert child.prob in (0.5, 0.3, 0.2)
+        assert len(root.untried_moves) == 2
+        assert child.state not in root.untried_moves
+        # the root and the two nodes added have each been expanded once
+        assert lm.calls == 3
+        assert len(tree) == 1 + 3 + 3 + 3
+
+    def test_children_keep_the_order_in_which_they_were_tried(self):
+        lm = FixedLanguageModel([5, 6, 7, 8], [0.4, 0.3, 0.2, 0.1])
+        tree = MCTSTree([1], lm, width=4, max_depth=3, newline_id=0)
+        root = tree.root
+
+        tried = []
+        while root.has_untried_moves():
+            tried.append(root.add_child(root.select_untried_move()).state)
+
+        assert [c.state for c in root.children] == tried
+        assert sorted(tried) == [[1, 5], [1, 6], [1, 7], [1, 8]]
+
+    def test_visits_and_wins(self):
+        lm = FixedLanguageModel([5, 6], [0.6, 0.4])
+        tree = MCTSTree([1], lm, width=2, max_depth=3, newline_id=0)
+        child = tree.root.add_child(tree.root.select_untried_move())
+
+        node = child
+        while node is not None:
+            node.visits += 1
+            node.wins += 0.75
+            node = node.parent
+
+        assert tree.root.visits == 1 and tree.root.wins == 0.75
+        assert child.visits == 1 and child.wins == 0.75
+        assert tree.visits.sum() == 2
+
+    def test_nodes_are_not_expanded_beyond_max_depth_or_completion(self):
+        lm = FixedLanguageModel([0], [1.])
+        tree = MCTSTree([1], lm, width=1, max_depth=5, newline_id=0)
+        child = tree.root.add_child(tree.root.select_untried_move())
+        complete = child.add_child(child.select_untried_move())
+
+        assert complete.state == [1, 0, 0]
+        assert not complete.has_untried_moves()
+
+        lm = FixedLanguageModel([3], [1.])
+        tree = MCTSTree([1, 2, 3], lm, width=1, max_depth=3, newline_id=0)
+        assert not tree.root.has_untried_moves()
+        assert lm.calls == 0
+
+    def test_subtree(self):
+        lm = FixedLanguageModel([5, 6, 7], [0.5, 0.3, 0.2])
+        tree = MCTSTree([1], lm, width=3, max_depth=6, newline_id=0)
+        random.seed(0)
+        for _ in range(12):
+            node = tree.root
+            while not node.has_untried_moves() and node.has_children():
+                node = node.children[-1]
+            if node.has_untried_moves():
+                node = node.add_child(node.select_untried_move())
+            while node is not None:
+                node.visits += 1
+                node.wins += len(node.state) / 10
+                node = node.parent
+
+        child = tree.root.children[0]
+        calls = lm.calls
+        subtree = tree.subtree(child.id)
+
+        def describe(node):
+            return (node.state, node.visits, node.wins, node.untried_moves,
+                    [describe(c) for c in node.children])
+
+        assert describe(subtree.root) == describe(child)
+        assert subtree.root.parent is None
+        assert subtree.root.prob is None
+        assert [c.prob for c in subtree.root.children] == [c.prob for c in child.children]
+        assert len(subtree) < len(tree)
+        assert lm.calls == calls
+
+
+class TestVectorizedSelection(unittest.TestCase):
+
+    def _tree_with_stats(self, width, rng):
+        lm = FixedLanguageModel(list(range(10, 10 + width)), [rng.random() for _ in range(width)])
+        tree = MCTSTree([1], lm, width=width, max_depth=2, newline_id=0)
+        root = tree.root
+        while root.has_untried_moves():
+            root.add_child(root.select_untried_move())
+        for child in root.children:
+            # coarse values, so that ties are common
+            child.visits = rng.randint(1, 4)
+            child.wins = rng.randint(0, 4) / 2
+            root.visits += child.visits
+        return tree
+
+    def test_select_child_matches_select_node(self):
+        rng = random.Random(7)
+        for selector in (PUCTSelector(cpuct=1.4), UCTSelector(c=0.7)):
+            for _ in range(200):
+                tree = self._tree_with_stats(rng.randint(1, 12), rng)
+                expected = selector.select_node(tree.root.children)
+                assert selector.select_child(tree, tree.root.id) == expected.id
+
+    def test_first_unvisited_child_is_selected(self):
+        rng = random.Random(3)
+        tree = self._tree_with_stats(5, rng)
+        children = tree.root.children
+        children[2].visits = 0
+        children[4].visits = 0
+
+        for selector in (PUCTSelector(cpuct=1.0), UCTSelector(c=1.0)):
+            assert selector.select_child(tree, tree.root.id) == children[2].id
+
+
+class TestStepwiseSearch(unittest.TestCase):
+
+    def test_step_promotes_the_chosen_subtree(self):
+        tokenizer = CIFTokenizer()
+        sampler = tiny_sampler(lambda token_sequence, iter_num: len(set(token_sequence)) / 10, tokenizer,
+                               max_depth=8)
+        random.seed(0)
+
+        tree = sampler.start_stepwise("data_")
+        prompt = tree.root.state
+        state = sampler.step(num_simulations=8)
+
+        most_visited = sorted(tree.root.children, key=lambda c: c.visits)[-1]
+        assert state == most_visited.state
+        assert len(state) == len(prompt) + 1
+        root = sampler.tree.root
+        assert root.state == state
+        assert root.visits == most_visited.visits > 0
+        assert root.wins == most_visited.wins
+        assert [c.state for c in root.children] == [c.state for c in most_visited.children]
+
+        # the search ends once a root without children is reached
+        steps = 0
+        while state is not None:
+            assert state[:len(prompt)] == prompt
+            state = sampler.step(num_simulations=2)
+            steps += 1
+            assert steps < 10
+        assert sampler.step(num_simulations=2) is None
+
+
+class RecordingEvaluator:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, token_sequence, iter_num):
+        self.calls += 1
+        return (sum(token_sequence) % 11) / 10 + random.random() / 100
+
+    def state_dict(self):
+        return {"calls": self.calls}
+
+    def load_state_dict(self, state):
+        self.calls = state["calls"]
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def _search(self, checkpoint_path, num_simulations, resume=False):
+        tokenizer = CIFTokenizer()
+        evaluator = RecordingEvaluator()
+        sampler = tiny_sampler(evaluator, tokenizer, max_depth=10)
+        if not resume:
+            random.seed(0)
+        sampler.search("data_", num_simulations, checkpoint_path=checkpoint_path, checkpoint_interval=3,
+                       resume=resume)
+        return sampler, evaluator
+
+    def test_resumed_search_matches_uninterrupted_search(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            uninterrupted_path = os.path.join(tmp_dir, "uninterrupted.pt")
+            interrupted_path = os.path.join(tmp_dir, "interrupted.pt")
+
+            sampler, evaluator = self._search(uninterrupted_path, 10)
+            expected = sampler.get_best_sequence()
+            assert evaluator.calls == 10
+
+            self._search(interrupted_path, 6)
+            # a later random draw must not affect the resumed search
+            random.random()
+            resumed, resumed_evaluator = self._search(interrupted_path, 10, resume=True)
+
+            assert resumed.get_best_sequence() == expected
+            assert resumed_evaluator.calls == 10
+
+            expected_tree = torch.load(uninterrupted_path, weights_only=False)["tree"]
+            resumed_tree = torch.load(interrupted_path, weights_only=False)["tree"]
+            assert expected_tree.keys() == resumed_tree.keys()
+            for name in expected_tree:
+                assert np.array_equal(expected_tree[name], resumed_tree[name], equal_nan=name == "prior"), name
+            assert expected_tree["visits"][0] == 10
+            assert not os.path.exists(f"{interrupted_path}.tmp")
+
+    def test_resume_rejects_a_different_prompt(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            checkpoint_path = os.path.join(tmp_dir, "checkpoint.pt")
+            self._search(checkpoint_path, 3)
+
+            tokenizer = CIFTokenizer()
+            sampler = tiny_sampler(RecordingEvaluator(), tokenizer)
+            with self.assertRaises(Exception):
+                sampler.search("data_Na", 6, checkpoint_path=checkpoint_path, resume=True)
+
+
+class TestForwardBatcher(unittest.TestCase):
+
+    def test_batched_logits_match_unbatched_logits(self):
+        torch.manual_seed(0)
+        config = GPTConfig(block_size=32, vocab_size=50, n_layer=2, n_head=2, n_embd=16, dropout=0.)
+        model = GPT(config)
+        model.eval()
+        batcher = ForwardBatcher(model, max_batch_size=8, max_wait_ms=50.)
+
+        sequences = [torch.randint(0, 50, (1, n)) for n in (3, 9, 1, 17, 5, 9)]
+        results = [None] * len(sequences)
+
+        def request(i):
+            results[i] = batcher.next_token_logits(sequences[i])
+
+        threads = [threading.Thread(target=request, args=(i,)) for i in range(len(sequences))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        batcher.close()
+
+        assert batcher.mean_batch_size > 1
+        with torch.no_grad():
+            for idx, logits in zip(sequences, results):
+                expected, _ = model(idx)
+                assert logits.shape == (1, 50)
+                assert torch.allclose(logits, expected[:, -1, :], atol=1e-5)
+
+    def test_concurrent_searches_share_a_batcher(self):
+        tokenizer = CIFTokenizer()
+        torch.manual_seed(0)
+        config = GPTConfig(block_size=32, vocab_size=len(tokenizer.token_to_id), n_layer=1, n_head=1, n_embd=8)
+        model = GPT(config)
+        batcher = ForwardBatcher(model, max_batch_size=4)
+        evaluators = [RecordingEvaluator() for _ in range(4)]
+        samplers = [MCTSSampler(model=model, config=config, width=3, max_depth=10, eval_function=evaluator,
+                                node_selector=PUCTSelector(cpuct=1.0), tokenizer=tokenizer, temperature=1.0,
+                                device="cpu", batcher=batcher) for evaluator in evaluators]
+
+        threads = [threading.Thread(target=sampler.search, args=(prompt, 5))
+                   for sampler, prompt in zip(samplers, ["data_", "data_Na", "data_Cl", "data_K"])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        batcher.close()
+
+        assert [evaluator.calls for evaluator in evaluators] == [5, 5, 5, 5]
+        assert all(sampler.get_best_sequence() is not None for sampler in samplers)
+
+
+class TestRootParallel(unittest.TestCase):
+
+    def test_merge(self):
+        merged = RootParallelMCTSSampler._merge([
+            [([1, 5], 3., 1.5), ([1, 6], 1., 0.5)],
+            [([1, 6], 4., 2.), ([1, 7], 1., 1.)],
+        ])
+        assert merged == [([1, 5], 3., 1.5), ([1, 6], 5., 2.5), ([1, 7], 1., 1.)]
+
+    def test_search(self):
+        tokenizer = CIFTokenizer()
+        torch.manual_seed(0)
+        config = GPTConfig(block_size=32, vocab_size=len(tokenizer.token_to_id), n_layer=1, n_head=1, n_embd=8)
+        model = GPT(config)
+        model.share_memory()
+
+        def make_sampler(worker_id):
+            return MCTSSampler(model=model, config=config, width=3, max_depth=10, eval_function=RecordingEvaluator(),
+                               node_selector=PUCTSelector(cpuct=1.0), tokenizer=tokenizer, temperature=1.0,
+                               device="cpu")
+
+        sampler = RootParallelMCTSSampler(make_sampler, n_workers=3, seed=11)
+        state = sampler.search("data_", num_simulations=6)
+
+        statistics = sampler.root_child_statistics()
+        assert sum(visits for _, visits, _ in statistics) == 18
+        assert dict((tuple(s), v) for s, v, _ in statistics)[tuple(state)] == max(v for _, v, _ in statistics)
+        assert sampler.get_best_sequence() is not None
+
+    def test_worker_failure_is_raised(self):
+        def make_sampler(worker_id):
+            raise ValueError(f"worker {worker_id} cannot build a sampler")
+
+        sampler = RootParallelMCTSSampler(make_sampler, n_workers=2)
+        with self.assertRaises(Exception) as context:
+            sampler.search("data_", num_simulations=2)
+        assert "cannot build a sampler" in str(context.exception)
+
+    def test_worker_exit_is_raised(self):
+        def make_sampler(worker_id):
+            # a worker that dies without raising an exception, as when it crashes or is killed
+            os._exit(3)
+
+        sampler = RootParallelMCTSSampler(make_sampler, n_workers=2)
+        with self.assertRaises(Exception) as context:
+            sampler.search("data_", num_simulations=2)
+        assert "exited with code 3" in str(context.exception)
+
+
+class TestValueHead(unittest.TestCase):
+
+    def _model(self, vocab_size):
+        torch.manual_seed(0)
+        config = GPTConfig(block_size=32, vocab_size=vocab_size, n_layer=1, n_head=1, n_embd=8, value_head=True)
+        return GPT(config), config
+
+    def test_value_ignores_padding(self):
+        model, _ = self._model(50)
+        model.eval()
+        short = torch.randint(1, 50, (1, 4))
+        long = torch.randint(1, 50, (1, 9))
+        padded = torch.cat([torch.cat([short, torch.zeros(1, 5, dtype=torch.long)], dim=1), long])
+
+        with torch.no_grad():
+            values = model.value(padded, torch.tensor([4, 9]))
+            assert values.shape == (2,)
+            assert torch.allclose(values[0], model.value(short)[0], atol=1e-6)
+            assert torch.allclose(values[1], model.value(long)[0], atol=1e-6)
+        assert values.abs().max() <= 1.
+
+    def test_frozen_value_only_trains_the_value_head(self):
+        model, _ = self._model(50)
+        idx = torch.randint(1, 50, (2, 6))
+        value = model.value(idx, frozen=True)
+        assert value.requires_grad
+        value.sum().backward()
+        assert all(p.grad is not None for p in model.value_head.parameters())
+        assert all(p.grad is None for name, p in model.named_parameters() if not name.startswith("value_head."))
+
+    def test_leaves_are_evaluated_by_the_value_head(self):
+        tokenizer = CIFTokenizer()
+        model, config = self._model(len(tokenizer.token_to_id))
+        evaluator = RecordingEvaluator()
+        sampler = MCTSSampler(model=model, config=config, width=3, max_depth=12, eval_function=evaluator,
+                              node_selector=PUCTSelector(cpuct=1.0), tokenizer=tokenizer, temperature=1.0,
+                              device="cpu", value_rollout_depth=0)
+
+        sampler.search("data_", 6)
+
+        # the random model does not complete a CIF, so no leaf needs the evaluator
+        assert evaluator.calls == 0
+        root = sampler.tree.root
+        assert root.visits == 6
+        assert -6. <= root.wins <= 6.
+
+    def test_complete_rollouts_are_not_waited_for(self):
+        tokenizer = CIFTokenizer()
+        model, config = self._model(len(tokenizer.token_to_id))
+        evaluator = AcceptingEvaluator(LengthScorer(delay_s=0.2), tokenizer, provisional_reward=0.25)
+        sampler = MCTSSampler(model=model, config=config, width=3, max_depth=12, eval_function=evaluator,
+                              node_selector=PUCTSelector(cpuct=1.0), tokenizer=tokenizer, temperature=1.0,
+                              device="cpu", value_rollout_depth=0)
+
+        class Node:
+            def __init__(self, state, parent=None):
+                self.state = state
+                self.parent = parent
+                self.visits = 0.
+                self.wins = 0.
+
+        newline_id = tokenizer.token_to_id["\n"]
+        complete = Node(tokenizer.encode(tokenizer.tokenize_cif("data_Na")) + [newline_id, newline_id])
+        score = sampler._estimate_value(complete, n_rollouts=1, iter_num=1)
+        assert score == 0.25
+        assert len(sampler._pending) == 1
+        complete.wins += score
+
+        sampler._apply_pending(block=True)
+        evaluator.close()
+        assert complete.wins == evaluator.rewards[0]
+        assert sampler.get_best_sequence() == (complete.state, evaluator.rewards[0])
+
+    def test_value_head_is_required(self):
+        tokenizer = CIFTokenizer()
+        config = GPTConfig(block_size=32, vocab_size=len(tokenizer.token_to_id), n_layer=1, n_head=1, n_embd=8)
+        with self.assertRaises(ValueError):
+            MCTSSampler(model=GPT(config), config=config, width=3, max_depth=12, eval_function=RecordingEvaluator(),
+                        node_selector=PUCTSelector(cpuct=1.0), tokenizer=tokenizer, temperature=1.0, device="cpu",
+                        value_rollout_depth=0)
+
+
+CIF_NACL = inspect.cleandoc('''
+data_Na4Cl4
+_symmetry_space_group_name_H-M Fm-3m
+_cell_length_a 5.6910
+_cell_length_b 5.6910
+_cell_length_c 5.6910
+_cell_angle_alpha 90.0000
+_cell_angle_beta 90.0000
+_cell_angle_gamma 90.0000
+_symmetry_Int_Tables_number 225
+_chemical_formula_structural NaCl
+_chemical_formula_sum 'Na4 Cl4'
+_cell_volume 184.3170
+_cell_formula_units_Z 4
+loop_
+ _symmetry_equiv_pos_site_id
+ _symmetry_equiv_pos_as_xyz
+  1  'x, y, z'
+loop_
+ _atom_site_type_symbol
+ _atom_site_label
+ _atom_site_symmetry_multiplicity
+ _atom_site_fract_x
+ _atom_site_fract_y
+ _atom_site_fract_z
+ _atom_site_occupancy
+  Na  Na0  4  0.0000  0.0000  0.0000  1
+  Cl  Cl1  4  0.5000  0.5000  0.5000  1
+''') + "\n\n"
+
+
+class TestRolloutChecker(unittest.TestCase):
+
+    def _check(self, cif):
+        tokenizer = CIFTokenizer()
+        token_ids = tokenizer.encode(tokenizer.tokenize_cif(cif))
+        checker = RolloutChecker(tokenizer)
+        n_tokens = 0
+        for token_id in token_ids:
+            n_tokens += 1
+            if checker.update(token_id):
+                break
+        return checker, tokenizer.decode(token_ids[:n_tokens])
+
+    def test_valid_cif_is_not_cut_off(self):
+        checker, _ = self._check(CIF_NACL)
+        assert not checker.invalid
+
+    def test_inconsistent_formula(self):
+        checker, seen = self._check(CIF_NACL.replace("'Na4 Cl4'", "'Na4 Cl3'"))
+        assert checker.invalid
+        assert "composition" in checker.reason
+        # decided at the end of the _chemical_formula_sum line
+        assert seen.endswith("_chemical_formula_sum 'Na4 Cl3'\n")
+
+    def test_multiplicity_overflow(self):
+        checker, seen = self._check(CIF_NACL.replace("Na  Na0  4", "Na  Na0  8"))
+        assert checker.invalid
+        assert "multiplicity" in checker.reason
+        assert seen.endswith("Na0 8 0.0000 0.0000 0.0000 1\n")
+        assert "Cl1" not in seen
+
+    def test_unexpected_element(self):
+        checker, _ = self._check(CIF_NACL.replace("Cl  Cl1  4", "K  K1  4"))
+        assert checker.invalid
+
+    def test_missing_atoms_are_left_to_the_evaluator(self):
+        checker, _ = self._check(CIF_NACL.replace("Cl  Cl1  4", "Cl  Cl1  2"))
+        assert not checker.invalid
+
+    def test_search_skips_evaluating_rollouts_known_to_be_invalid(self):
+        tokenizer = CIFTokenizer()
+        evaluator = RecordingEvaluator()
+        prompt = CIF_NACL[:CIF_NACL.index("_cell_volume")].replace("'Na4 Cl4'", "'Na4 Cl3'")
+        torch.manual_seed(0)
+        config = GPTConfig(block_size=256, vocab_size=len(tokenizer.token_to_id), n_layer=1, n_head=1, n_embd=8)
+        sampler = MCTSSampler(model=GPT(config), config=config, width=3, max_depth=400, eval_function=evaluator,
+                              node_selector=PUCTSelector(cpuct=1.0), tokenizer=tokenizer, temperature=1.0,
+                              device="cpu", early_cutoff=True)
+
+        sampler.search(prompt, 4)
+
+        assert evaluator.calls == 0
+        assert sampler.tree.root.wins == -4.
+
+
+class TestSearchTracing(unittest.TestCase):
+
+    def test_phases_are_recorded(self):
+        tokenizer = CIFTokenizer()
+        tracer = Tracer()
+        torch.manual_seed(0)
+        config = GPTConfig(block_size=32, vocab_size=len(tokenizer.token_to_id), n_layer=1, n_head=1, n_embd=8)
+        sampler = MCTSSampler(model=GPT(config), config=config, width=3, max_depth=10,
+                              eval_function=RecordingEvaluator(), node_selector=PUCTSelector(cpuct=1.0),
+                              tokenizer=tokenizer, temperature=1.0, device="cpu", tracer=tracer)
+
+        sampler.search("data_", 5, n_rollouts=2)
+
+        phases = tracer.phases()
+        counts = tracer.counts()
+        assert counts["simulations"] == 5
+        assert counts["rollouts"] == 10
+        assert phases["rollout"].count == 10
+        assert phases["evaluate"].count == 10
+        assert phases["backprop"].count == 5
+        # each rollout token needs a forward pass, as does each expansion
+        assert phases["lm_forward"].count >= counts["rollout_tokens"] + phases["expand"].count
+
+
+class ValidatingEvaluator(MCTSEvaluator):
+    """
+    An MCTSEvaluator that treats every rollout as a valid CIF, except rollouts containing "<unk>".
+    """
+    def _postprocess(self, cif_str):
+        return cif_str
+
+    def _is_valid(self, generated_cif):
+        return "<unk>" not in generated_cif, "unknown token", None
+
+
+class TestMCTSEvaluator(unittest.TestCase):
+
+    def test_running_stats(self):
+        rng = np.random.RandomState(0)
+        stats = RunningStats()
+        values = []
+        for x in rng.normal(3., 2., size=500):
+            stats.add(float(x))
+            values.append(float(x))
+            assert abs(stats.mean - np.mean(values)) < 1e-9
+            assert abs(stats.std - np.std(values)) < 1e-9
+        assert not stats.all_equal()
+
+        restored = RunningStats()
+        restored.load_state_dict(stats.state_dict())
+        assert restored.state_dict() == stats.state_dict()
+
+    def test_rewards_match_full_history(self):
+        evaluator = MCTSEvaluator(LengthScorer(), CIFTokenizer(), reward_k=2.0)
+        scores = [1., 1., 5., 2., 9., 4., 4.]
+        for i, score in enumerate(scores):
+            history = scores[:i + 1]
+            if len(np.unique(history)) == 1:
+                expected = 0.5
+            else:
+                expected = 1 / (1 + np.exp(2.0 * (score - np.mean(history)) / np.std(history)))
+            assert abs(evaluator._get_reward(score) - expected) < 1e-9
+
+    def test_load_state_dict_with_score_history(self):
+        evaluator = MCTSEvaluator(LengthScorer(), CIFTokenizer())
+        evaluator.load_state_dict({"all_scores": np.array([1., 2., 6.]), "num_valid": 3})
+        state = evaluator.state_dict()
+        assert state["num_valid"] == 3
+        assert state["score_stats"]["count"] == 3
+        assert abs(state["score_stats"]["mean"] - 3.) < 1e-12
+
+    def test_evaluate_batch_matches_sequential_calls(self):
+        tokenizer = CIFTokenizer()
+        valid_1 = tokenizer.encode(tokenizer.tokenize_cif("data_Na\n"))
+        valid_2 = tokenizer.encode(tokenizer.tokenize_cif("data_NaCl\n_cell_length_a 5.0\n"))
+        invalid = valid_1 + [tokenizer.token_to_id["<unk>"]]
+        sequences = [valid_1, invalid, valid_2, valid_1]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sequential = ValidatingEvaluator(LengthScorer(), tokenizer, out_dir=os.path.join(tmp_dir, "a"))
+            expected = [sequential(sequence, 1) for sequence in sequences]
+            sequential.close()
+
+            batched = ValidatingEvaluator(LengthScorer(), tokenizer, out_dir=os.path.join(tmp_dir, "b"))
+            assert batched.evaluate_batch(sequences, 1) == expected
+            batched.close()
+            assert expected[1] == -1.0
+            assert batched.state_dict()["num_valid"] == 3
+
+            with open(os.path.join(tmp_dir, "a", "results.csv")) as f:
+                expected_results = f.read()
+            with open(os.path.join(tmp_dir, "b", "results.csv")) as f:
+                assert f.read() == expected_results
+
+    def test_evaluate_batch_across_processes(self):
+        tokenizer = CIFTokenizer()
+        sequences = [
+            tokenizer.encode(tokenizer.tokenize_cif(CIF_NACL)),
+            tokenizer.encode(tokenizer.tokenize_cif("data_Na\n")),
+        ]
+        serial = MCTSEvaluator(LengthScorer(), tokenizer)
+        pooled = MCTSEvaluator(LengthScorer(), tokenizer, n_processes=2)
+
+        expected = [serial(sequence, 1) for sequence in sequences]
+        assert pooled.evaluate_batch(sequences, 1) == expected
+        assert pooled.state_dict() == serial.state_dict()
+        pooled.close()
+
+    @unittest.skipUnless(hasattr(CifParser, "from_string"), "requires the pymatgen version in requirements.txt")
+    def test_pool_workers_use_the_space_group_detector(self):
+        tokenizer = CIFTokenizer()
+        sequences = [tokenizer.encode(tokenizer.tokenize_cif(CIF_NACL))] * 2
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            detector = SpaceGroupDetector(db_path=os.path.join(tmp_dir, "space_groups.sqlite"))
+            pooled = MCTSEvaluator(LengthScorer(), tokenizer, n_processes=2, space_group_detector=detector)
+            pooled.evaluate_batch(sequences, 1)
+            pooled.close()
+
+            # the space group detected in a worker was stored in the database
+            serial = MCTSEvaluator(LengthScorer(), tokenizer, space_group_detector=detector)
+            serial(sequences[0], 1)
+            assert detector.cache_info().disk_hits == 1
+            detector.close()
+
+    def test_pool_cannot_be_used_with_overridden_validation(self):
+        with self.assertRaises(ValueError):
+            ValidatingEvaluator(LengthScorer(), CIFTokenizer(), n_processes=2)
+
+    def test_results_are_buffered(self):
+        tokenizer = CIFTokenizer()
+        sequence = tokenizer.encode(tokenizer.tokenize_cif("data_Na\n"))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            evaluator = ValidatingEvaluator(LengthScorer(), tokenizer, out_dir=tmp_dir, results_buffer_size=2)
+            results_path = os.path.join(tmp_dir, "results.csv")
+
+            def n_rows():
+                with open(results_path) as f:
+                    return len(f.readlines()) - 1
+
+            for _ in range(3):
+                evaluator(sequence, 1)
+            assert n_rows() == 2
+            assert len([name for name in os.listdir(tmp_dir) if name.endswith(".cif")]) == 3
+            evaluator.close()
+            assert n_rows() == 3
+
+    def test_load_state_dict_discards_results_after_snapshot(self):
+        tokenizer = CIFTokenizer()
+        sequences = [tokenizer.encode(tokenizer.tokenize_cif(f"data_Na{i}\n")) for i in range(1, 5)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            uninterrupted_dir = os.path.join(tmp_dir, "uninterrupted")
+            uninterrupted = ValidatingEvaluator(RandomScorer(seed=0), tokenizer, out_dir=uninterrupted_dir)
+            expected = [uninterrupted(sequence, 1) for sequence in sequences]
+            uninterrupted.close()
+
+            interrupted_dir = os.path.join(tmp_dir, "interrupted")
+            interrupted = ValidatingEvaluator(RandomScorer(seed=0), tokenizer, out_dir=interrupted_dir)
+            rewards = [interrupted(sequence, 1) for sequence in sequences[:2]]
+            interrupted.flush()
+            state = interrupted.state_dict()
+            # rows and CIFs written after the snapshot, before a crash
+            for sequence in sequences[2:]:
+                interrupted(sequence, 1)
+            interrupted.close()
+
+            resumed = ValidatingEvaluator(RandomScorer(seed=1), tokenizer, out_dir=interrupted_dir)
+            resumed.load_state_dict(state)
+            assert sorted(os.listdir(interrupted_dir)) == ["generated_1.cif", "generated_2.cif", "results.csv"]
+            rewards += [resumed(sequence, 1) for sequence in sequences[2:]]
+            resumed.close()
+
+            assert rewards == expected
+            for fname in os.listdir(uninterrupted_dir):
+                with open(os.path.join(uninterrupted_dir, fname)) as f, \
+                        open(os.path.join(interrupted_dir, fname)) as g:
+                    assert f.read() == g.read()
+
+        # the state of a scorer is found through the scorers wrapping it
+        assert "scorer" in MCTSEvaluator(CachingScorer(RandomScorer(seed=0)), tokenizer).state_dict()
+
+    def test_search_evaluates_rollouts_together(self):
+        tokenizer = CIFTokenizer()
+        evaluator = ValidatingEvaluator(LengthScorer(), tokenizer)
+        batch_sizes = []
+        evaluate_batch = evaluator.evaluate_batch
+
+        def recording_evaluate_batch(token_sequences, iter_num):
+            batch_sizes.append(len(token_sequences))
+            return evaluate_batch(token_sequences, iter_num)
+
+        evaluator.evaluate_batch = recording_evaluate_batch
+        sampler = tiny_sampler(evaluator, tokenizer)
+        sampler.search("data_", 4, n_rollouts=3)
+        sampler.close()
+
+        assert batch_sizes == [3] * 4
@@ -0,0 +1,189 @@
+import unittest
+import inspect
+import os
+import pickle
+import tempfile
+from unittest import mock
+
+import numpy as np
+from pymatgen.core import Lattice, Structure
+from pymatgen.io.cif import CifParser
+
+from crystallm import (
+    CIFAnalysis,
+    SpaceGroupDetector,
+    are_sensible,
+    bond_length_reasonableness_score,
+    get_canonical_structure_hash,
+    is_atom_site_multiplicity_consistent,
+    is_formula_consistent,
+    is_sensible,
+    is_space_group_consistent,
+    is_valid,
+    replace_symmetry_operators,
+)
+
+
+CIF_NACL = inspect.cleandoc('''
+data_NaCl
+_symmetry_space_group_name_H-M   Fm-3m
+_cell_length_a   5.69100000
+_cell_length_b   5.69100000
+_cell_length_c   5.69100000
+_cell_angle_alpha   90.00000000
+_cell_angle_beta   90.00000000
+_cell_angle_gamma   90.00000000
+_symmetry_Int_Tables_number   225
+_chemical_formula_structural   NaCl
+_chemical_formula_sum   'Na4 Cl4'
+_cell_volume   184.31699700
+_cell_formula_units_Z   4
+loop_
+_symmetry_equiv_pos_site_id
+_symmetry_equiv_pos_as_xyz
+1 'x, y, z'
+loop_
+_atom_site_type_symbol
+_atom_site_label
+_atom_site_symmetry_multiplicity
+_atom_site_fract_x
+_atom_site_fract_y
+_atom_site_fract_z
+_atom_site_occupancy
+Na Na0 4 0.00000000 0.00000000 0.00000000 1
+Cl Cl1 4 0.50000000 0.50000000 0.50000000 1
+''')
+
+
+@unittest.skipUnless(hasattr(CifParser, "from_string"), "requires the pymatgen version in requirements.txt")
+class TestCIFAnalysis(unittest.TestCase):
+
+    def setUp(self):
+        self.cif = replace_symmetry_operators(CIF_NACL, "Fm-3m")
+
+    def test_metrics_accept_an_analysis(self):
+        analysis = CIFAnalysis(self.cif)
+        for metric in (is_formula_consistent, is_atom_site_multiplicity_consistent, is_space_group_consistent,
+                       bond_length_reasonableness_score, is_sensible, is_valid):
+            assert metric(analysis) == metric(self.cif)
+        assert is_valid(analysis)
+
+        inconsistent = self.cif.replace("'Na4 Cl4'", "'Na4 Cl8'")
+        assert not is_atom_site_multiplicity_consistent(CIFAnalysis(inconsistent))
+        assert not is_valid(CIFAnalysis(inconsistent))
+
+    def test_cif_is_parsed_once(self):
+        with mock.patch.object(CifParser, "from_string", side_effect=CifParser.from_string) as from_string:
+            analysis = CIFAnalysis(self.cif)
+            assert from_string.call_count == 0
+            assert is_valid(analysis)
+            assert is_atom_site_multiplicity_consistent(analysis)
+            assert bond_length_reasonableness_score(analysis) == 1.0
+            assert from_string.call_count == 1
+
+    def test_lazy_properties(self):
+        analysis = CIFAnalysis(self.cif)
+        assert analysis.composition.reduced_formula == "NaCl"
+        assert analysis.structure is analysis.structure
+        assert len(analysis.structure) == 8
+        assert analysis.block["_symmetry_space_group_name_H-M"] == "Fm-3m"
+
+
+@unittest.skipUnless(hasattr(CifParser, "from_string"), "requires the pymatgen version in requirements.txt")
+class TestFastBondLengthScore(unittest.TestCase):
+
+    def test_matches_crystal_nn_score(self):
+        cif = replace_symmetry_operators(CIF_NACL, "Fm-3m")
+        analysis = CIFAnalysis(cif)
+        assert bond_length_reasonableness_score(analysis, fast=True) == \
+            bond_length_reasonableness_score(analysis) == 1.0
+        assert is_valid(cif, fast_bond_length_score=True)
+
+        compressed = cif.replace("5.69100000", "3.60000000")
+        assert bond_length_reasonableness_score(compressed, fast=True) == \
+            bond_length_reasonableness_score(compressed) == 0.0
+        assert not is_valid(compressed, fast_bond_length_score=True)
+
+
+def rock_salt(a=5.691):
+    return Structure.from_spacegroup("Fm-3m", Lattice.cubic(a), ["Na", "Cl"], [[0, 0, 0], [0.5, 0.5, 0.5]])
+
+
+class TestSpaceGroupDetector(unittest.TestCase):
+
+    def test_canonical_structure_hash(self):
+        structure = rock_salt()
+        reordered = Structure.from_sites(list(reversed(structure.sites)))
+        rounded = structure.copy()
+        rounded.translate_sites([0], [-0.000001, 0.000001, 0], frac_coords=True, to_unit_cell=False)
+        assert get_canonical_structure_hash(structure) == get_canonical_structure_hash(reordered)
+        assert get_canonical_structure_hash(structure) == get_canonical_structure_hash(rounded)
+        assert get_canonical_structure_hash(structure) != get_canonical_structure_hash(rock_salt(a=5.7))
+
+    def test_detected_space_groups_are_remembered(self):
+        detector = SpaceGroupDetector(maxsize=10)
+        structure = rock_salt()
+
+        assert detector.detect(structure) == "Fm-3m"
+        assert detector.detect(Structure.from_sites(list(reversed(structure.sites)))) == "Fm-3m"
+        assert detector.detect(rock_salt(a=5.7)) == "Fm-3m"
+
+        info = detector.cache_info()
+        assert (info.hits, info.misses, info.currsize) == (1, 2, 2)
+
+    def test_persistent_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, "space_groups.sqlite")
+
+            first = SpaceGroupDetector(db_path=db_path)
+            first.detect(rock_salt())
+            first.close()
+
+            second = SpaceGroupDetector(maxsize=0, db_path=db_path)
+            with mock.patch("crystallm._metrics.SpacegroupAnalyzer") as analyzer:
+                assert second.detect(rock_salt()) == "Fm-3m"
+                analyzer.assert_not_called()
+            assert second.cache_info().disk_hits == 1
+            second.close()
+
+            # a different tolerance may detect a different space group
+            other = SpaceGroupDetector(db_path=db_path, symprec=0.01)
+            other.detect(rock_salt())
+            assert other.cache_info().misses == 1
+            other.close()
+
+    def test_pickled_copy_shares_database(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            detector = SpaceGroupDetector(maxsize=10, db_path=os.path.join(tmp_dir, "space_groups.sqlite"))
+            detector.detect(rock_salt())
+
+            copy = pickle.loads(pickle.dumps(detector))
+            assert copy.cache_info().maxsize == 10
+            assert copy.cache_info().currsize == 0
+            assert copy.detect(rock_salt()) == "Fm-3m"
+            assert copy.cache_info().disk_hits == 1
+            copy.close()
+            detector.close()
+
+
+class TestAreSensible(unittest.TestCase):
+
+    def test_same_as_is_sensible(self):
+        rng = np.random.default_rng(0)
+        cells = np.column_stack([rng.uniform(0, 1200, (300, 3)), rng.uniform(0, 180, (300, 3))])
+        cells[::4, :3] = rng.uniform(1, 20, (75, 3))
+        cells[::3, 3:] = 90.
+        names = ("_cell_length_a", "_cell_length_b", "_cell_length_c",
+                 "_cell_angle_alpha", "_cell_angle_beta", "_cell_angle_gamma")
+
+        for kwargs in ({}, {"length_lo": 2., "length_hi": 15., "angle_lo": 60., "angle_hi": 120.}):
+            sensible = are_sensible(*cells.T, **kwargs)
+            for cell, cell_sensible in zip(cells, sensible):
+                cif = "".join(f"{name}   {value:.8f}\n" for name, value in zip(names, cell))
+                assert cell_sensible == is_sensible(cif, **kwargs), cell
+
+    def test_missing_parameters_are_not_checked(self):
+        cells = np.array([[5., 5., np.nan, 90., 90., 90.], [5., 5., np.nan, 5., 90., 90.]])
+
+        assert are_sensible(*cells.T).tolist() == [True, False]
+        assert is_sensible(CIF_NACL.replace("_cell_length_c", "_cell_len_c"))
@@ -0,0 +1,312 @@
+import unittest
+import inspect
+import os
+import tempfile
+import threading
+import time
+
+import zmq
+
+from crystallm import (
+    AsyncScorer,
+    CachingScorer,
+    CIFScorer,
+    LatencyHistogram,
+    PooledZMQScorer,
+    ZMQScorer,
+)
+
+
+class SlowScorer(CIFScorer):
+    """
+    A local stand-in for an external scorer: the score is the length of the CIF,
+    returned after a delay.
+    """
+    def __init__(self, delay_s=0.05):
+        self._delay_s = delay_s
+        self.max_concurrent = 0
+        self.batch_sizes = []
+        self._concurrent = 0
+        self._lock = threading.Lock()
+
+    def score_batch(self, cifs):
+        self.batch_sizes.append(len(cifs))
+        return super().score_batch(cifs)
+
+    def score(self, cif):
+        with self._lock:
+            self._concurrent += 1
+            self.max_concurrent = max(self.max_concurrent, self._concurrent)
+        time.sleep(self._delay_s)
+        with self._lock:
+            self._concurrent -= 1
+        if cif == "bad":
+            raise ValueError("cannot score")
+        return float(len(cif))
+
+
+class CountingScorer(CIFScorer):
+    def __init__(self, score=1.):
+        self.calls = 0
+        self._score = score
+
+    def score(self, cif):
+        self.calls += 1
+        return self._score
+
+
+CIF_NACL = inspect.cleandoc('''
+data_Na4Cl4
+_symmetry_space_group_name_H-M   Fm-3m
+_cell_length_a   5.69100000
+_cell_length_b   5.69100000
+_cell_length_c   5.69100000
+_cell_angle_alpha   90.00000000
+_cell_angle_beta   90.00000000
+_cell_angle_gamma   90.00000000
+_symmetry_Int_Tables_number   225
+_chemical_formula_structural   NaCl
+_chemical_formula_sum   'Na4 Cl4'
+_cell_volume   184.31699700
+_cell_formula_units_Z   4
+loop_
+ _symmetry_equiv_pos_site_id
+ _symmetry_equiv_pos_as_xyz
+  1  'x, y, z'
+loop_
+ _atom_site_type_symbol
+ _atom_site_label
+ _atom_site_symmetry_multiplicity
+ _atom_site_fract_x
+ _atom_site_fract_y
+ _atom_site_fract_z
+ _atom_site_occupancy
+  Na  Na0  4  0.00000000  0.00000000  0.00000000  1
+  Cl  Cl1  4  0.50000000  0.50000000  0.50000000  1
+''')
+
+
+def serve_lengths(socket, n_requests):
+    for _ in range(n_requests):
+        message = socket.recv_string()
+        socket.send_string(f"{len(message)}")
+
+
+def serve_batches(socket, n_requests, served, stall_first=0.):
+    for i in range(n_requests):
+        frames = socket.recv_multipart()
+        if i == 0 and stall_first > 0:
+            # the client gives up on this request; the late reply is discarded
+            time.sleep(stall_first)
+        served.append(len(frames))
+        socket.send_multipart([f"{len(f)}".encode("utf-8") for f in frames])
+
+
+def start_batch_server(n_requests, served, stall_first=0.):
+    socket = zmq.Context.instance().socket(zmq.REP)
+    port = socket.bind_to_random_port("tcp://127.0.0.1")
+    server = threading.Thread(target=serve_batches, args=(socket, n_requests, served, stall_first), daemon=True)
+    server.start()
+    return port, server, socket
+
+
+class TestAsyncScorer(unittest.TestCase):
+
+    def test_submit_does_not_block(self):
+        scorer = AsyncScorer(SlowScorer(delay_s=0.2), max_in_flight=4)
+
+        start = time.time()
+        futures = [scorer.submit("a" * i) for i in range(1, 4)]
+        assert time.time() - start < 0.2
+
+        assert [f.result() for f in futures] == [1., 2., 3.]
+        assert scorer.in_flight == 0
+        scorer.close()
+
+    def test_max_in_flight(self):
+        scorer = AsyncScorer(SlowScorer(delay_s=0.01), max_in_flight=2, workers=4)
+
+        futures = []
+        for i in range(10):
+            futures.append(scorer.submit("x" * i))
+            assert scorer.in_flight <= 2
+
+        assert [f.result() for f in futures] == [float(i) for i in range(10)]
+        assert scorer.scorer.max_concurrent <= 2
+        scorer.close()
+
+    def test_exception_is_propagated(self):
+        scorer = AsyncScorer(SlowScorer(delay_s=0.), max_in_flight=1)
+
+        future = scorer.submit("bad")
+        with self.assertRaises(ValueError):
+            future.result()
+
+        assert scorer.submit("ok").result() == 2.
+        scorer.close()
+
+    def test_zmq_scorer(self):
+        context = zmq.Context.instance()
+        socket = context.socket(zmq.REP)
+        port = socket.bind_to_random_port("tcp://127.0.0.1")
+        server = threading.Thread(target=serve_lengths, args=(socket, 3), daemon=True)
+        server.start()
+
+        scorer = AsyncScorer(ZMQScorer(host="127.0.0.1", port=port, timeout_ms=5000), max_in_flight=3)
+        futures = [scorer.submit("c" * i) for i in (5, 6, 7)]
+
+        assert [f.result() for f in futures] == [5., 6., 7.]
+        scorer.close()
+        server.join()
+        socket.close()
+
+    def test_batches(self):
+        stand_in = SlowScorer(delay_s=0.)
+        scorer = AsyncScorer(stand_in, max_in_flight=8, workers=1, batch_size=4)
+        # occupy the only worker, so that the following requests are queued together
+        blocker = scorer.submit("b" * 100)
+        futures = [scorer.submit("x" * i) for i in range(6)]
+
+        assert blocker.result() == 100.
+        assert [f.result() for f in futures] == [float(i) for i in range(6)]
+        assert all(n <= 4 for n in stand_in.batch_sizes)
+        scorer.close()
+
+    def test_shared_as_a_scorer(self):
+        scorer = AsyncScorer(SlowScorer(delay_s=0.), max_in_flight=2, batch_size=2)
+        results = [None] * 4
+
+        def score(i):
+            results[i] = scorer.score_batch(["y" * i, "z" * (i + 1)])
+
+        threads = [threading.Thread(target=score, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == [[float(i), float(i + 1)] for i in range(4)]
+        assert scorer.score("abc") == 3.
+        scorer.close()
+
+
+class TestPooledZMQScorer(unittest.TestCase):
+
+    def test_score_batch_across_endpoints(self):
+        served_1, served_2 = [], []
+        port_1, server_1, socket_1 = start_batch_server(2, served_1)
+        port_2, server_2, socket_2 = start_batch_server(2, served_2)
+
+        scorer = PooledZMQScorer([f"127.0.0.1:{port_1}", f"127.0.0.1:{port_2}"], timeout_ms=5000, batch_size=3)
+        cifs = ["a" * i for i in range(1, 13)]
+
+        assert scorer.score_batch(cifs) == [float(i) for i in range(1, 13)]
+        assert sorted(served_1 + served_2) == [3, 3, 3, 3]
+        assert len(served_1) == 2 and len(served_2) == 2
+
+        histograms = scorer.latency_histograms()
+        assert sum(h.count for h in histograms.values()) == 4
+
+        server_1.join()
+        server_2.join()
+        socket_1.close()
+        socket_2.close()
+
+    def test_retry_after_timeout(self):
+        served = []
+        port, server, socket = start_batch_server(2, served, stall_first=0.3)
+
+        scorer = PooledZMQScorer([f"127.0.0.1:{port}"], timeout_ms=250, batch_size=2, retries=1)
+
+        assert scorer.score_batch(["ab", "abc"]) == [2., 3.]
+        assert served == [2, 2]
+
+        server.join()
+        socket.close()
+
+    def test_timeout_raised_when_retries_exhausted(self):
+        socket = zmq.Context.instance().socket(zmq.REP)
+        port = socket.bind_to_random_port("tcp://127.0.0.1")
+
+        scorer = PooledZMQScorer([f"127.0.0.1:{port}"], timeout_ms=100, retries=1)
+
+        with self.assertRaises(TimeoutError):
+            scorer.score("abc")
+        socket.close(linger=0)
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_record(self):
+        histogram = LatencyHistogram(bounds_ms=[1., 10., 100.])
+        for latency_s in (0.0005, 0.005, 0.006, 0.05, 2.):
+            histogram.record(latency_s)
+
+        assert histogram.count == 5
+        assert histogram.buckets() == [(1., 1), (10., 2), (100., 1), (float("inf"), 1)]
+        assert histogram.percentile_ms(50) == 10.
+        assert histogram.max_ms == 2000.
+
+
+class TestCachingScorer(unittest.TestCase):
+
+    def test_equivalent_cifs_are_scored_once(self):
+        inner = CountingScorer()
+        scorer = CachingScorer(inner, maxsize=10)
+
+        reordered = CIF_NACL.replace(
+            "  Na  Na0  4  0.00000000  0.00000000  0.00000000  1\n  Cl  Cl1  4  0.50000000  0.50000000  0.50000000  1",
+            "Cl Cl0 4 0.500000001 0.5 0.5 1\nNa Na1 4 -0.00000001 0.0 0.0 1",
+        )
+        assert reordered != CIF_NACL
+
+        assert scorer.score(CIF_NACL) == 1.
+        assert scorer.score(reordered) == 1.
+        assert inner.calls == 1
+        assert scorer.cache_info().hits == 1
+        assert scorer.cache_info().misses == 1
+
+        shifted = CIF_NACL.replace("0.50000000  0.50000000  0.50000000", "0.50000000  0.50000000  0.50100000")
+        scorer.score(shifted)
+        assert inner.calls == 2
+
+    def test_missing_occupancy_is_full_occupancy(self):
+        inner = CountingScorer()
+        scorer = CachingScorer(inner, maxsize=10)
+
+        without_occupancy = CIF_NACL.replace(" _atom_site_occupancy\n", "").replace("  1\n", "\n")
+        assert "_atom_site_occupancy" not in without_occupancy
+
+        scorer.score(CIF_NACL)
+        scorer.score(without_occupancy)
+        assert inner.calls == 1
+
+    def test_score_batch_deduplicates(self):
+        inner = CountingScorer()
+        scorer = CachingScorer(inner, maxsize=10)
+
+        assert scorer.score_batch([CIF_NACL, CIF_NACL, CIF_NACL]) == [1., 1., 1.]
+        assert inner.calls == 1
+
+    def test_nan_is_not_cached(self):
+        inner = CountingScorer(score=float("nan"))
+        scorer = CachingScorer(inner, maxsize=10)
+
+        scorer.score(CIF_NACL)
+        scorer.score(CIF_NACL)
+        assert inner.calls == 2
+
+    def test_persistent_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, "scores.sqlite")
+
+            first = CachingScorer(CountingScorer(score=3.), maxsize=10, db_path=db_path)
+            first.score(CIF_NACL)
+            first.close()
+
+            inner = CountingScorer(score=4.)
+            second = CachingScorer(inner, maxsize=0, db_path=db_path)
+            assert second.score(CIF_NACL) == 3.
+            assert inner.calls == 0
+            assert second.cache_info().disk_hits == 1
+            second.close()
@@ -1,12 +1,44 @@
 import unittest
 import inspect
+import os
+import random
+import re
+
+import numpy as np
+import pandas as pd
+
 from crystallm import CIFTokenizer
+from crystallm._tokenizer import SPACE_GROUPS, UNK_TOKEN
+
+BENCHMARKS_DIR = os.path.join(os.path.dirname(__file__), "..", "resources", "benchmarks")
+
+
+def reference_tokenize_cif(tokenizer, cif_string, single_spaces=True):
+    # the implementation of `CIFTokenizer.tokenize_cif` that rebuilt its patterns on every call
+    spacegroups = "|".join(SPACE_GROUPS)
+    cif_string = re.sub(fr'(_symmetry_space_group_name_H-M *\b({spacegroups}))\n', r'\1_sg\n', cif_string)
+    token_pattern = '|'.join(tokenizer._escaped_tokens)
+    full_pattern = f'({token_pattern}|\\w+|[\\.,;!?])'
+    if single_spaces:
+        cif_string = re.sub(r'[ \t]+', ' ', cif_string)
+    tokens = re.findall(full_pattern, cif_string)
+    tokens = [token if token in tokenizer._tokens else UNK_TOKEN for token in tokens]
+    return tokens
+
+
+def read_benchmark_cifs():
+    cifs = []
+    for name in ("perov_5", "carbon_24"):
+        cifs.extend(pd.read_csv(os.path.join(BENCHMARKS_DIR, name, "test.csv"))["cif"].tolist()[:250])
+    return cifs
 
 
 class TestSomething(unittest.TestCase):
 
+    engine = "regex"
+
     def test_tokenize_cif(self):
-        tokenizer = CIFTokenizer()
+        tokenizer = CIFTokenizer(engine=self.engine)
 
         cif_str = inspect.cleandoc('''
         data_Np1Co3
@@ -47,7 +79,7 @@ class TestSomething(unittest.TestCase):
         ]
 
     def test_tokenize_cif_atoms_like_spacegroup(self):
-        tokenizer = CIFTokenizer()
+        tokenizer = CIFTokenizer(engine=self.engine)
 
         cif_str = inspect.cleandoc('''
         data_Na1P1
@@ -88,7 +120,7 @@ class TestSomething(unittest.TestCase):
         ]
 
     def test_tokenize_cif_space_group(self):
-        tokenizer = CIFTokenizer()
+        tokenizer = CIFTokenizer(engine=self.engine)
 
         cif_str = "_symmetry_space_group_name_H-M    Pm-3m\n"
         tokens = tokenizer.tokenize_cif(cif_str)
@@ -111,7 +143,7 @@ class TestSomething(unittest.TestCase):
         assert tokens == ['_symmetry_space_group_name_H-M', ' ', 'P1_sg', '\n']
 
     def test_encode_decode(self):
-        tokenizer = CIFTokenizer()
+        tokenizer = CIFTokenizer(engine=self.engine)
 
         cif_str = inspect.cleandoc('''
         data_Np1Co3
@@ -148,7 +180,7 @@ class TestSomething(unittest.TestCase):
         assert "".join(decoded) == cif_str
 
     def test_encode_decode_atoms_like_spacegroup(self):
-        tokenizer = CIFTokenizer()
+        tokenizer = CIFTokenizer(engine=self.engine)
 
         cif_str = inspect.cleandoc('''
         data_Na1P1
@@ -182,3 +214,47 @@ class TestSomething(unittest.TestCase):
         decoded = tokenizer.decode(encoded)
 
         assert "".join(decoded) == cif_str
+
+    def test_tokenize_to_ids(self):
+        tokenizer = CIFTokenizer(engine=self.engine)
+
+        cif_str = "data_Na1P1\n_symmetry_space_group_name_H-M P1\n_cell_length_a  5.0 <unknown> Xx\n"
+        ids = tokenizer.tokenize_to_ids(cif_str)
+
+        assert ids.dtype == np.uint16
+        assert ids.tolist() == tokenizer.encode(tokenizer.tokenize_cif(cif_str))
+        assert tokenizer.token_to_id[UNK_TOKEN] in ids.tolist()
+        assert tokenizer.tokenize_to_ids("").tolist() == []
+
+
+class TestSomethingWithTrie(TestSomething):
+    # the same cases, with the trie engine
+    engine = "trie"
+
+
+class TestTokenizerThroughput(unittest.TestCase):
+
+    def test_same_as_reference(self):
+        cifs = read_benchmark_cifs()
+        cifs.append("_symmetry_space_group_name_H-M \tPm\n\t_cell_angle_alpha\t 90 ~ Qq ; ! ?\n")
+
+        for engine in ("regex", "trie"):
+            tokenizer = CIFTokenizer(engine=engine)
+            for cif in cifs:
+                for single_spaces in (True, False):
+                    expected = reference_tokenize_cif(tokenizer, cif, single_spaces)
+                    assert tokenizer.tokenize_cif(cif, single_spaces) == expected
+                    assert tokenizer.tokenize_to_ids(cif, single_spaces).tolist() == tokenizer.encode(expected)
+
+    def test_trie_same_as_regex_on_fragments(self):
+        regex_tokenizer = CIFTokenizer(engine="regex")
+        trie_tokenizer = CIFTokenizer(engine="trie")
+        # fragments of tokens, and characters that are not part of any token, joined at random
+        tokens = list(regex_tokenizer.token_to_id)
+        fragments = [token[:i] for token in tokens for i in range(1, len(token) + 1)]
+        fragments.extend(["_", "__", "_sg", "\t", "  ", ";", "!", "?", "#", "<", "é", "中", "Qq", "\n"])
+        rng = random.Random(0)
+
+        for _ in range(3000):
+            cif = "".join(rng.choice(fragments) for _ in range(rng.randint(0, 30)))
+            assert trie_tokenizer.tokenize_cif(cif) == regex_tokenizer.tokenize_cif(cif), repr(cif)
@@ -0,0 +1,75 @@
+import unittest
+import json
+import os
+import tempfile
+import threading
+import time
+
+from crystallm import Tracer
+
+
+class TestTracer(unittest.TestCase):
+
+    def test_spans_and_counts(self):
+        tracer = Tracer()
+        for _ in range(3):
+            with tracer.span("select"):
+                time.sleep(0.01)
+        tracer.record("score", 0.5)
+        tracer.count("rollout_tokens", 10)
+        tracer.count("rollout_tokens", 5)
+
+        phases = tracer.phases()
+        assert phases["select"].count == 3
+        assert phases["select"].total_s >= 0.03
+        assert phases["score"].max_s == 0.5
+        assert tracer.counts() == {"rollout_tokens": 15}
+
+        summary = tracer.summary()
+        assert summary.splitlines()[1].startswith("score")
+        assert "rollout_tokens" in summary
+
+    def test_disabled_tracer_records_nothing(self):
+        tracer = Tracer(enabled=False)
+        with tracer.span("select"):
+            pass
+        tracer.record("score", 0.5)
+        tracer.count("rollouts")
+        assert tracer.phases() == {}
+        assert tracer.counts() == {}
+
+    def test_span_is_recorded_when_an_exception_is_raised(self):
+        tracer = Tracer()
+        with self.assertRaises(ValueError):
+            with tracer.span("postprocess"):
+                raise ValueError()
+        assert tracer.phases()["postprocess"].count == 1
+
+    def test_traces(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trace_path = os.path.join(tmp_dir, "trace.jsonl")
+            chrome_trace_path = os.path.join(tmp_dir, "trace.json")
+            tracer = Tracer(trace_path=trace_path, keep_events=True)
+
+            def work():
+                for _ in range(5):
+                    with tracer.span("rollout"):
+                        pass
+
+            threads = [threading.Thread(target=work) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            tracer.close()
+            tracer.write_chrome_trace(chrome_trace_path)
+
+            with open(trace_path) as f:
+                events = [json.loads(line) for line in f]
+            assert len(events) == 20
+            assert {e["name"] for e in events} == {"rollout"}
+
+            with open(chrome_trace_path) as f:
+                chrome_trace = json.load(f)
+            assert len(chrome_trace["traceEvents"]) == 20
+            assert all(e["ph"] == "X" for e in chrome_trace["traceEvents"])
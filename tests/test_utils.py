@@ -0,0 +1,387 @@
+import unittest
+import math
+import os
+import random
+import re
+import warnings
+
+import numpy as np
+import pandas as pd
+from pymatgen.core import Composition, Structure
+from pymatgen.core.operations import SymmOp
+from pymatgen.io.cif import CifBlock, CifWriter
+from pymatgen.symmetry.groups import SpaceGroup
+
+from crystallm import (
+    add_atomic_props_block,
+    are_cells_degenerate,
+    extract_data_formula,
+    extract_formula_nonreduced,
+    extract_formula_units,
+    extract_numeric_property,
+    extract_space_group_symbol,
+    extract_volume,
+    get_atomic_props_block,
+    get_atomic_props_block_for_formula,
+    get_element_props_table,
+    get_symmetry_operators_block,
+    get_unit_cell_volume,
+    get_unit_cell_volumes,
+    get_volumes_per_formula_unit,
+    preprocess_cif,
+    replace_data_formula_with_nonreduced_formula,
+    replace_symmetry_operators,
+    scan_cif_header,
+    semisymmetrize_cif,
+)
+from crystallm._tokenizer import ATOMS, SPACE_GROUPS
+
+from tests.test_metrics import CIF_NACL
+
+BENCHMARKS_DIR = os.path.join(os.path.dirname(__file__), "..", "resources", "benchmarks")
+
+
+def reference_fields(cif_str):
+    """
+    The values found by the `extract_*` functions when each field was searched for separately.
+    """
+    fields = {}
+    match = re.search(r"_symmetry_space_group_name_H-M\s+('([^']+)'|(\S+))", cif_str)
+    fields["space_group"] = (match.group(2) if match.group(2) else match.group(3)) if match else None
+    match = re.search(r"_chemical_formula_sum\s+('([^']+)'|(\S+))", cif_str)
+    fields["formula_sum"] = (match.group(2) if match.group(2) else match.group(3)) if match else None
+    match = re.search(r"data_([A-Za-z0-9]+)\n", cif_str)
+    fields["data_formula"] = match.group(1) if match else None
+    for prop in ("_cell_length_a", "_cell_length_b", "_cell_length_c", "_cell_angle_alpha", "_cell_angle_beta",
+                 "_cell_angle_gamma", "_cell_volume", "_cell_formula_units_Z"):
+        match = re.search(rf"{prop}\s+([.0-9]+)", cif_str)
+        fields[prop] = match.group(1) if match else None
+    return fields
+
+
+def extracted_fields(cif_str):
+    def extract(fn, *args):
+        try:
+            return fn(cif_str, *args)
+        except Exception as e:
+            return type(e)
+    fields = {
+        "space_group": extract(extract_space_group_symbol),
+        "formula_sum": extract(extract_formula_nonreduced),
+        "data_formula": extract(extract_data_formula),
+    }
+    for prop in ("_cell_length_a", "_cell_length_b", "_cell_length_c", "_cell_angle_alpha", "_cell_angle_beta",
+                 "_cell_angle_gamma", "_cell_volume", "_cell_formula_units_Z"):
+        fields[prop] = extract(extract_numeric_property, prop, str)
+    return fields
+
+
+def as_extracted(fields):
+    # a missing field raises an exception
+    return {name: Exception if value is None else value for name, value in fields.items()}
+
+
+def reference_atomic_props_block(composition, oxi=False):
+    """
+    The atomic properties block, as it was made from the pymatgen element data, and a CifBlock, for each CIF.
+    """
+    noble_vdw_radii = {"He": 1.40, "Ne": 1.54, "Ar": 1.88, "Kr": 2.02, "Xe": 2.16, "Rn": 2.20}
+    allen_electronegativity = {"He": 4.16, "Ne": 4.79, "Ar": 3.24}
+
+    def _format(val):
+        return f"{float(val): .4f}"
+
+    def _format_X(elem):
+        if math.isnan(elem.X) and str(elem) in allen_electronegativity:
+            return allen_electronegativity[str(elem)]
+        return _format(elem.X)
+
+    def _format_radius(elem):
+        if elem.atomic_radius is None and str(elem) in noble_vdw_radii:
+            return noble_vdw_radii[str(elem)]
+        return _format(elem.atomic_radius)
+
+    props = {str(el): (_format_X(el), _format_radius(el), _format(el.average_ionic_radius))
+             for el in sorted(composition.elements)}
+    data = {
+        "_atom_type_symbol": list(props),
+        "_atom_type_electronegativity": [v[0] for v in props.values()],
+        "_atom_type_radius": [v[1] for v in props.values()],
+        "_atom_type_ionic_radius": [v[2] for v in props.values()],
+    }
+    loop_vals = list(data)
+    if oxi:
+        symbol_to_oxinum = {str(el): (float(el.oxi_state), _format(el.ionic_radius))
+                            for el in sorted(composition.elements)}
+        data["_atom_type_oxidation_number"] = [v[0] for v in symbol_to_oxinum.values()]
+        data["_atom_type_ionic_radius"] = [v[1] for v in symbol_to_oxinum.values()]
+        loop_vals.append("_atom_type_oxidation_number")
+    return str(CifBlock(data, [loop_vals], "")).replace("data_\n", "")
+
+
+def reference_or_exception(fn, *args, **kwargs):
+    try:
+        return fn(*args, **kwargs)
+    except Exception as e:
+        return type(e)
+
+
+class TestAtomicPropsBlock(unittest.TestCase):
+
+    def test_same_as_cif_block(self):
+        warnings.simplefilter("ignore")
+        rng = random.Random(0)
+        compositions = [Composition(symbol) for symbol in ATOMS]
+        compositions += [Composition({symbol: rng.randint(1, 8) for symbol in rng.sample(ATOMS, rng.randint(2, 5))})
+                         for _ in range(300)]
+        df = pd.read_csv(os.path.join(BENCHMARKS_DIR, "perov_5", "test.csv"))
+        compositions += [Composition(formula) for formula in df["formula"][:100]]
+        assert get_atomic_props_block_for_formula("Na4Cl4") == reference_atomic_props_block(Composition("NaCl"))
+
+        for composition in compositions:
+            expected = reference_or_exception(reference_atomic_props_block, composition)
+            assert reference_or_exception(get_atomic_props_block, composition) == expected, composition
+            # a second time, from the cache
+            assert reference_or_exception(get_atomic_props_block, composition) == expected, composition
+
+    def test_same_as_cif_block_with_oxidation_states(self):
+        warnings.simplefilter("ignore")
+        for formula in ("Fe2O3", "NaCl", "BaTiO3", "LiFePO4", "CsPbI3"):
+            composition = Composition(formula).add_charges_from_oxi_state_guesses()
+            expected = reference_atomic_props_block(composition, oxi=True)
+            assert get_atomic_props_block(composition, oxi=True) == expected
+
+    def test_element_props_table(self):
+        table = get_element_props_table()
+
+        assert table["Na"] == ("0.9300", "1.8000", "1.1600")
+        assert table["He"] == ("4.16", "1.4", "0.0000")
+        assert set(table) <= set(ATOMS)
+
+
+def reference_replace_symmetry_operators(cif_str, space_group_symbol):
+    """
+    The symmetry operators replaced as they were before the blocks were remembered.
+    """
+    symmops = [SymmOp.from_rotation_and_translation(op.rotation_matrix, op.translation_vector)
+               for op in SpaceGroup(space_group_symbol).symmetry_ops]
+    ops = [op.as_xyz_string() for op in symmops]
+    data = {
+        "_symmetry_equiv_pos_site_id": [f"{i}" for i in range(1, len(ops) + 1)],
+        "_symmetry_equiv_pos_as_xyz": ops,
+    }
+    symm_block = str(CifBlock(data, [list(data)], "")).replace("data_\n", "")
+    pattern = r"(loop_\n_symmetry_equiv_pos_site_id\n_symmetry_equiv_pos_as_xyz\n1 'x, y, z')"
+    return re.sub(pattern, symm_block, cif_str)
+
+
+@unittest.skipUnless(hasattr(SymmOp, "as_xyz_string"), "requires the pymatgen version in requirements.txt")
+class TestReplaceSymmetryOperators(unittest.TestCase):
+
+    def test_same_as_regex_substitution(self):
+        for space_group in SPACE_GROUPS:
+            cif = CIF_NACL.replace("Fm-3m", space_group)
+            assert replace_symmetry_operators(cif, space_group) == \
+                reference_replace_symmetry_operators(cif, space_group), space_group
+
+    def test_block_is_made_once(self):
+        get_symmetry_operators_block.cache_clear()
+        replace_symmetry_operators(CIF_NACL, "Fm-3m")
+        replace_symmetry_operators(CIF_NACL, "Fm-3m")
+
+        assert get_symmetry_operators_block.cache_info().misses == 1
+        assert get_symmetry_operators_block.cache_info().hits == 1
+
+    def test_unknown_space_group(self):
+        with self.assertRaises(Exception):
+            replace_symmetry_operators(CIF_NACL, "Xx-9")
+        # a CIF without the identity operator block is left as it is
+        assert replace_symmetry_operators("data_X\n", "P-1") == "data_X\n"
+
+
+def reference_round_numbers(cif_str, decimal_places=4):
+    """
+    The numbers rounded as they were, with a callback for each number.
+    """
+    def round_number(match):
+        number_str = match.group()
+        if len(number_str.split('.')[-1]) <= decimal_places:
+            return number_str
+        return format(round(float(number_str), decimal_places), '.{}f'.format(decimal_places))
+    return re.sub(r"[-+]?\d*\.\d+([eE][-+]?\d+)?", round_number, cif_str)
+
+
+def reference_preprocess(cif_str, oxi=False, decimal_places=4):
+    """
+    The steps of `bin/preprocess.py`, as they were applied one at a time.
+    """
+    if extract_formula_units(cif_str) == 0:
+        raise Exception()
+    cif_str = replace_data_formula_with_nonreduced_formula(cif_str)
+    cif_str = semisymmetrize_cif(cif_str)
+    cif_str = add_atomic_props_block(cif_str, oxi)
+    return reference_round_numbers(cif_str, decimal_places=decimal_places)
+
+
+def read_benchmark_cifs(n):
+    cifs = []
+    for name in ("perov_5", "carbon_24"):
+        cifs.extend(pd.read_csv(os.path.join(BENCHMARKS_DIR, name, "test.csv"))["cif"].tolist()[:n])
+    return cifs
+
+
+class TestPreprocessCIF(unittest.TestCase):
+
+    def assert_same_as_reference(self, cifs, **kwargs):
+        for cif in cifs:
+            expected = reference_or_exception(reference_preprocess, cif, **kwargs)
+            actual = reference_or_exception(preprocess_cif, cif, **kwargs)
+            # when the steps fail, the pre-processing fails, although not necessarily with the same exception
+            assert actual == expected or (isinstance(expected, type) and isinstance(actual, type)), cif
+
+    def test_same_as_separate_steps(self):
+        warnings.simplefilter("ignore")
+        cifs = read_benchmark_cifs(200)
+        # CIFs with all their symmetry operators
+        cifs += [str(CifWriter(Structure.from_str(cif, fmt="cif"), symprec=0.1)) for cif in cifs[::20]]
+
+        self.assert_same_as_reference(cifs)
+        self.assert_same_as_reference(cifs[::10], decimal_places=2)
+
+    def test_same_as_separate_steps_for_unusual_layouts(self):
+        warnings.simplefilter("ignore")
+        cif = str(CifWriter(Structure.from_str(CIF_NACL, fmt="cif"), symprec=0.1))
+        assert cif.count("_symmetry_equiv_pos_as_xyz") == 1 and cif.count("'x, y, z'") == 1
+        cifs = [
+            cif,
+            cif.replace("_cell_formula_units_Z   4", "_cell_formula_units_Z   0"),
+            cif.replace("_cell_formula_units_Z", "_cell_formula_units"),
+            cif.replace("data_", "# data_\ndata_"),
+            cif.replace("data_", " data_"),
+            cif.replace("_chemical_formula_sum   'Na4 Cl4'", "_chemical_formula_sum\n'Na4 Cl4'"),
+            cif.replace("_chemical_formula_sum   'Na4 Cl4'", "_chemical_formula_sum   'Na4 Cl4"),
+            cif.replace("_chemical_formula_sum   'Na4 Cl4'", "_chemical_formula_sum\tNa4Cl4  "),
+            cif.replace("_chemical_formula_sum   'Na4 Cl4'", ""),
+            cif.replace("_symmetry_space_group_name_H-M", "# _symmetry_space_group_name_H-M"),
+            cif.replace("_symmetry_space_group_name_H-M   Fm-3m", ""),
+            cif.replace(" _symmetry_equiv_pos_as_xyz\n", " _symmetry_equiv_pos_as_xyz "),
+            cif.replace("loop_\n _atom_site_type_symbol", "  loop_\n _atom_site_type_symbol"),
+            cif.replace("\n _atom_site_type_symbol", "\n\n _atom_site_type_symbol"),
+            cif + "\n_symmetry_equiv_pos_as_xyz",
+            cif.split("loop_\n _atom_site")[0],
+            CIF_NACL,
+            "data_X",
+            "",
+        ]
+        self.assert_same_as_reference(cifs)
+
+    def test_same_as_separate_steps_with_oxidation_states(self):
+        warnings.simplefilter("ignore")
+        cifs = []
+        for cif in read_benchmark_cifs(10):
+            structure = Structure.from_str(cif, fmt="cif")
+            try:
+                structure.add_oxidation_state_by_guess()
+            except Exception:
+                continue
+            cifs.append(str(CifWriter(structure)))
+        self.assert_same_as_reference(cifs, oxi=True)
+
+
+class TestScanCIFHeader(unittest.TestCase):
+
+    def test_fields(self):
+        header = scan_cif_header(CIF_NACL)
+
+        assert header.data_formula == "NaCl"
+        assert header.space_group == "Fm-3m"
+        assert header.formula_sum == "Na4 Cl4"
+        assert header.formula_structural == "NaCl"
+        assert header.cell_parameters() == (5.691, 5.691, 5.691, 90., 90., 90.)
+        assert header.volume == 184.316997
+        assert header.formula_units == 4
+        assert header.get("_cell_length_a") == "5.69100000"
+
+    def test_missing_fields(self):
+        cif = CIF_NACL.replace("_cell_length_b   5.69100000\n", "").replace("_cell_volume", "_cell_vol")
+        header = scan_cif_header(cif)
+
+        assert header.b is None
+        assert header.volume is None
+        with self.assertRaises(Exception):
+            header.cell_parameters()
+        with self.assertRaises(Exception):
+            extract_volume(cif)
+        assert extract_formula_units(cif) == 4
+
+    def test_same_as_separate_searches(self):
+        cifs = [
+            CIF_NACL,
+            "",
+            "garbage",
+            "data_\n_cell_length_a 1.0\n",
+            "data_Na4Cl4 \n_cell_length_a\n\n 1.0",
+            "_symmetry_space_group_name_H-M 'P 4/m m m'\n_chemical_formula_sum ''\n",
+            "_symmetry_space_group_name_H-M\n_cell_length_a 4.0\n_cell_length_a 5.0\n",
+            "_chemical_formula_sum 'data_X\n_cell_volume 12.0'\n_cell_volume 13.0\n",
+            "_cell_length_a abc _cell_length_a 3. _cell_angle_alpha 90 _cell_angle_alpha 80",
+            "_symmetry_space_group_name_H-M P1\n_cell_volume 5.0_symmetry_space_group_name_H-M\n_cell_formula_units_Z 2",
+            CIF_NACL.replace("Fm-3m", "_cell_length_c").replace("_cell_length_c   5.69100000", ""),
+            CIF_NACL[:200],
+        ]
+        for path in (os.path.join(BENCHMARKS_DIR, "perov_5", "test.csv"),
+                     os.path.join(BENCHMARKS_DIR, "carbon_24", "test.csv")):
+            cifs.extend(pd.read_csv(path)["cif"].tolist()[:200])
+
+        for cif in cifs:
+            assert extracted_fields(cif) == as_extracted(reference_fields(cif)), cif
+
+
+class TestCellGeometry(unittest.TestCase):
+
+    def test_volumes_same_as_get_unit_cell_volume(self):
+        rng = np.random.default_rng(0)
+        cells = np.column_stack([rng.uniform(1, 20, (500, 3)), rng.uniform(30, 150, (500, 3))])
+        cells = np.vstack([cells, [[5.691, 5.691, 5.691, 90., 90., 90.], [3., 3., 3., 90., 90., 120.]]])
+
+        volumes = get_unit_cell_volumes(*cells.T)
+
+        for cell, volume in zip(cells, volumes):
+            try:
+                expected = get_unit_cell_volume(*cell)
+            except ValueError:
+                # the angles do not form a cell
+                assert np.isnan(volume), cell
+                continue
+            assert math.isclose(volume, expected, rel_tol=1e-9, abs_tol=1e-9), cell
+
+    def test_degenerate_cells(self):
+        cells = np.array([
+            [5.691, 5.691, 5.691, 90., 90., 90.],
+            [3., 3., 3., 90., 90., 120.],
+            [0., 3., 3., 90., 90., 90.],
+            [3., -3., 3., 90., 90., 90.],
+            [3., 3., 3., 90., 90., 180.],
+            [3., 3., 3., 60., 60., 120.],
+            [3., 3., 3., 10., 10., 150.],
+            [3., 3., np.nan, 90., 90., 90.],
+            [3., 3., 3., 90., np.nan, 90.],
+        ])
+
+        degenerate = are_cells_degenerate(*cells.T)
+
+        assert degenerate.tolist() == [False, False, True, True, True, True, True, True, True]
+        assert np.isnan(get_unit_cell_volumes(*cells.T)[6])
+
+    def test_volumes_per_formula_unit(self):
+        volumes = np.array([184.316997, 100., 100., 100., np.nan])
+        formula_units = np.array([4, 0, -1, 2, 2])
+
+        vpfus = get_volumes_per_formula_unit(volumes, formula_units)
+
+        assert vpfus[0] == 184.316997 / 4
+        # a Z of 0 is treated as 1
+        assert vpfus[1] == 100.
+        assert np.isnan(vpfus[2])
+        assert vpfus[3] == 50.
+        assert np.isnan(vpfus[4])
@@ -0,0 +1,108 @@
+import unittest
+import os
+import time
+
+from pymatgen.io.cif import CifParser
+
+from crystallm import (
+    ValidationResult,
+    is_valid,
+    replace_symmetry_operators,
+    validate_many,
+)
+from tests.test_metrics import CIF_NACL
+
+
+def mentions_sodium(analysis):
+    return "Na" in analysis.cif_str
+
+
+def slow_on_request(analysis):
+    if "slow" in analysis.cif_str:
+        time.sleep(60)
+    return True
+
+
+def crash_on_request(analysis):
+    if "crash" in analysis.cif_str:
+        os._exit(3)
+    return True
+
+
+def raise_on_request(analysis):
+    if "raise" in analysis.cif_str:
+        raise KeyError("_cell_length_a")
+    return True
+
+
+SENSIBLE = "_cell_length_a 5.0\n_cell_angle_alpha 90.0\n"
+NOT_SENSIBLE = "_cell_length_a 5.0\n_cell_angle_alpha 5.0\n"
+
+
+class TestValidateMany(unittest.TestCase):
+
+    def test_results_record_the_failed_check(self):
+        cifs = [SENSIBLE + "Na", NOT_SENSIBLE + "Na", SENSIBLE + "Cl", SENSIBLE + "raise"]
+        checks = ["sensible", ("sodium", mentions_sodium), ("raises", raise_on_request)]
+
+        results = list(validate_many(cifs, checks=checks))
+
+        assert [r.index for r in results] == [0, 1, 2, 3]
+        assert [r.valid for r in results] == [True, False, False, False]
+        assert [r.failed_check for r in results] == [None, "sensible", "sodium", "sodium"]
+        assert set(results[0].timings) == {"sensible", "sodium", "raises"}
+        assert set(results[1].timings) == {"sensible"}
+
+        results = list(validate_many(cifs, checks=checks, stop_at_first_failure=False))
+        assert results[1].outcomes == {"sensible": False, "sodium": True, "raises": True}
+
+        result = list(validate_many([SENSIBLE + "Na raise"], checks=checks))[0]
+        assert result.failed_check == "raises"
+        assert result.error == "KeyError: '_cell_length_a'"
+
+    def test_workers_are_replaced_after_a_timeout_or_crash(self):
+        cifs = [SENSIBLE + f"Na {i}" for i in range(10)]
+        cifs[2] += " slow"
+        cifs[7] += " crash"
+        checks = ["sensible", ("slow", slow_on_request), ("crash", crash_on_request)]
+
+        start = time.time()
+        results = list(validate_many(cifs, checks=checks, workers=2, timeout_per_cif=1., chunk_size=3))
+        assert time.time() - start < 30
+
+        results = {r.index: r for r in results}
+        assert sorted(results) == list(range(10))
+        assert results[2].failed_check == "slow"
+        assert results[2].error == "timed out after 1.0s"
+        assert results[2].timings["slow"] >= 1.
+        assert results[7].failed_check == "crash"
+        assert "exited" in results[7].error
+        assert all(results[i].valid for i in range(10) if i not in (2, 7))
+
+    def test_dataframe(self):
+        cifs = [NOT_SENSIBLE + "Na", SENSIBLE + "Na", SENSIBLE + "Cl"]
+        df = validate_many(cifs, checks=["sensible", ("sodium", mentions_sodium)], workers=2, chunk_size=1,
+                           as_dataframe=True)
+
+        assert list(df.index) == [0, 1, 2]
+        assert list(df["valid"]) == [False, True, False]
+        assert list(df["failed_check"].fillna("")) == ["sensible", "", "sodium"]
+        assert {"sensible", "sensible_time", "sodium", "sodium_time"} <= set(df.columns)
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            validate_many([SENSIBLE], timeout_per_cif=1.)
+        with self.assertRaises(ValueError):
+            validate_many([SENSIBLE], checks=["no_such_check"])
+
+    @unittest.skipUnless(hasattr(CifParser, "from_string"), "requires the pymatgen version in requirements.txt")
+    def test_default_checks_match_is_valid(self):
+        cif = replace_symmetry_operators(CIF_NACL, "Fm-3m")
+        cifs = [cif, cif.replace("'Na4 Cl4'", "'Na4 Cl8'")]
+
+        results = sorted(validate_many(cifs, workers=1), key=lambda r: r.index)
+
+        assert [r.valid for r in results] == [is_valid(c) for c in cifs] == [True, False]
+        assert results[0].outcomes["bond_length"] == 1.0
+        assert results[1].failed_check == "formula"
+        assert isinstance(results[0], ValidationResult)